@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Benchmark of the whole FARMA workflow on synthetic data. Field
+# segmentations (Voronoi cells or rows of random rectangles) are
+# written as KEA with matching synthetic time-series rasters, then
+# each stage (0_ClumpSegmentation.py, 1_CreateRegGrid.py, each step of
+# 2_BoundingBoxes_Docker.py and 3_PopulatePolys.py) is run at several
+# scales and core counts. Each stage runs in its own process and the
+# wall time, CPU time, peak RSS (largest single process) and the
+# files/bytes written are saved to a JSON report, with the GDAL
+# datasets opened against those asked for by the stages which log
+# them. Scripts 2 (in memory) and 3 are also run with no datasets kept
+# open per worker (--maxhandles 0) to compare, and with the polygons
+# simplified (--simplify) to compare the vertices and bytes of the
+# GPKGs and the time taken to populate them.
+
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+import numpy as np
+import osgeo.gdal as gdal
+from osgeo import ogr
+from osgeo import osr
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code')
+RES = 10.0
+# Rows written at a time
+STRIP = 512
+LOOKUP = 65521
+
+
+def Labels(shape, rows, size, field_px, seed):
+    # Field labels of rows [rows[0], rows[1]) of a size x size image
+    rng = np.random.default_rng(seed)
+    ncell = int(np.ceil(size / float(field_px))) + 1
+    if shape == 'voronoi':
+        # One seed jittered within each field_px cell, each pixel
+        # takes the nearest seed of the 3x3 cells around it
+        seeds = (np.indices((ncell, ncell)).transpose(1, 2, 0) + rng.uniform(0, 1, (ncell, ncell, 2))) * field_px
+        r = np.arange(rows[0], rows[1])[:, None] + 0.5
+        c = np.arange(size)[None, :] + 0.5
+        ci = np.broadcast_to(r // field_px, (r.size, size)).astype(np.int64)
+        cj = np.broadcast_to(c // field_px, (r.size, size)).astype(np.int64)
+        best = np.full((r.size, size), np.inf)
+        label = np.zeros((r.size, size), dtype=np.uint32)
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                si = np.clip(ci + di, 0, ncell - 1)
+                sj = np.clip(cj + dj, 0, ncell - 1)
+                d = (seeds[si, sj, 0] - r) ** 2 + (seeds[si, sj, 1] - c) ** 2
+                closer = d < best
+                best[closer] = d[closer]
+                label[closer] = (si * ncell + sj + 1)[closer]
+        return label
+    # Rows of rectangles with random heights and widths (all rows are
+    # generated from the seed so each strip is consistent)
+    heights = rng.integers(max(1, field_px // 2), field_px * 3 // 2 + 1, size)
+    tops = np.concatenate(([0], np.cumsum(heights)))
+    label = np.zeros((rows[1] - rows[0], size), dtype=np.uint32)
+    for b in range(np.searchsorted(tops, rows[0], 'right') - 1, np.searchsorted(tops, rows[1], 'left')):
+        brng = np.random.default_rng([seed, b])
+        widths = brng.integers(max(1, field_px // 2), field_px * 3 // 2 + 1, size)
+        ids = np.repeat(np.arange(widths.size), widths)[:size]
+        r0, r1 = max(tops[b], rows[0]), min(tops[b + 1], rows[1])
+        label[r0 - rows[0]:r1 - rows[0]] = (b * size + ids + 1)[None, :]
+    return label
+
+
+def CreateImage(out_img, size, nbands, dtype, driver):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32630)
+    imgDataset = gdal.GetDriverByName(driver).Create(out_img, size, size, nbands, dtype)
+    imgDataset.SetGeoTransform((500000.0, RES, 0, 1000000.0 + size * RES, 0, -RES))
+    imgDataset.SetProjection(srs.ExportToWkt())
+    return imgDataset
+
+
+def SyntheticData(datadir, shape, size, field_px, ndates, seed=42):
+    # Write the segmentation (seg.kea) and ndates rasters (rasters/)
+    # whose values follow a per field seasonal curve plus noise.
+    # Returns (segmentation, raster dir, number of fields).
+    seg = os.path.join(datadir, 'seg.kea')
+    rasterdir = os.path.join(datadir, 'rasters')
+    os.makedirs(rasterdir)
+    segDataset = CreateImage(seg, size, 1, gdal.GDT_UInt32, 'KEA')
+    rng = np.random.default_rng(seed)
+    # Field values are looked up by label modulo a prime
+    phase = rng.uniform(0, 2 * np.pi, LOOKUP).astype(np.float32)
+    base = rng.uniform(0.1, 0.6, LOOKUP).astype(np.float32)
+    imgDatasets = [CreateImage(os.path.join(rasterdir, 'ndvi_{}.tif'.format(20200101 + 100 * (d % 12) + d // 12 * 10000)), size, 1, gdal.GDT_Float32, 'GTiff') for d in range(ndates)]
+    fields = set()
+    for y in range(0, size, STRIP):
+        label = Labels(shape, (y, min(y + STRIP, size)), size, field_px, seed)
+        segDataset.GetRasterBand(1).WriteArray(label, 0, y)
+        fields.update(np.unique(label).tolist())
+        for d, imgDataset in enumerate(imgDatasets):
+            season = np.sin(2 * np.pi * d / 12.0 + phase[label % LOOKUP])
+            values = base[label % LOOKUP] + 0.3 * season + rng.normal(0, 0.05, label.shape).astype(np.float32)
+            imgDataset.GetRasterBand(1).WriteArray(values.astype(np.float32), 0, y)
+    segDataset = None
+    imgDatasets = None
+    return seg, rasterdir, len(fields)
+
+
+def Snapshot(path):
+    files = {}
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            files[os.path.join(root, name)] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+def RunMeasured(cmd, watch_dir):
+    # Run cmd in its own process. Returns its wall/CPU time, peak RSS
+    # and the files (new or changed) and bytes it wrote in watch_dir.
+    before = Snapshot(watch_dir)
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.time() - start
+    after = Snapshot(watch_dir)
+    written = [f for f in after if before.get(f) != after[f]]
+    return {'wall_s': round(wall, 3),
+            'cpu_s': round(usage.ru_utime + usage.ru_stime, 3),
+            'peak_rss_mb': round(usage.ru_maxrss / 1024.0, 1),
+            'files_written': len(written),
+            'bytes_written': int(sum(after[f][0] for f in written)),
+            'returncode': proc.returncode}
+
+
+def LoadScript(name):
+    spec = importlib.util.spec_from_file_location(name.replace('.py', ''), os.path.join(CODE_DIR, name))
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, CODE_DIR)
+    spec.loader.exec_module(module)
+    return module
+
+
+def StepArgs(step, tile, basedir, segs, mode_img):
+    dirs = {'tiles': basedir + '1_base_tiles/', 'msk': basedir + '2_tile_msks/', 'segs': basedir + '3_seg_tiles/',
+            'segs_msk': basedir + '4_seg_msk_tiles/', 'segs_msk_lbl': basedir + '5_seg_msk_lbl_tiles/', 'vec': basedir + '6_GPKGs/'}
+    return {'CreateMasks': (tile, dirs['tiles'], dirs['msk'], mode_img),
+            'MaskTiles': (tile, dirs['segs'], segs, dirs['tiles']),
+            'ExtractObjects': (tile, dirs['segs_msk'], dirs['segs'], dirs['msk'], dirs['tiles']),
+            'RelabelSegs': (tile, dirs['segs_msk_lbl'], dirs['segs_msk'], dirs['msk']),
+            'VectorizeSegs': (tile, dirs['vec'], dirs['segs_msk_lbl'])}[step]
+
+
+# Steps 2-6 of 2_BoundingBoxes_Docker.py and the dir each writes to
+STEPS = [('CreateMasks', '2_tile_msks'), ('MaskTiles', '3_seg_tiles'), ('ExtractObjects', '4_seg_msk_tiles'),
+         ('RelabelSegs', '5_seg_msk_lbl_tiles'), ('VectorizeSegs', '6_GPKGs')]
+
+
+def RunStep(step, basedir, segs, mode_img, cores):
+    # Run one step of 2_BoundingBoxes_Docker.py over every tile (called
+    # in a separate process by --runstep)
+    bbox = LoadScript('2_BoundingBoxes_Docker.py')
+    tiles = [os.path.basename(f)[len('tile_'):-len('.kea')] for f in glob.glob(basedir + '1_base_tiles/tile_*.kea')]
+    with Pool(cores) as pool:
+        pool.starmap(getattr(bbox, step), [StepArgs(step, tile, basedir, segs, mode_img) for tile in tiles])
+
+
+def OpenCounts(log_file):
+    # (datasets opened, datasets asked for) by the latest run in a log
+    sys.path.insert(0, CODE_DIR)
+    import farma_instrument
+    runinfo, units = farma_instrument.ReadLog(log_file)
+    return sum(u.get('gdal_opens', 0) for u in units), sum(u.get('gdal_requests', 0) for u in units)
+
+
+def GPKGSize(gpkg_dir):
+    # (vertices, bytes) of the polygons of the GPKGs in a dir
+    vertices = 0
+    nbytes = 0
+    for gpkg in glob.glob(os.path.join(gpkg_dir, '*.gpkg')):
+        nbytes += os.path.getsize(gpkg)
+        vecDataset = ogr.Open(gpkg)
+        for i in range(vecDataset.GetLayerCount()):
+            for feat in vecDataset.GetLayer(i):
+                geom = feat.GetGeometryRef()
+                vertices += sum(geom.GetGeometryRef(r).GetPointCount() for r in range(geom.GetGeometryCount()))
+        vecDataset = None
+    return vertices, nbytes
+
+
+def CopyInputs(src_dir, dst_dir, names):
+    os.makedirs(dst_dir)
+    for name in names:
+        shutil.copy(os.path.join(src_dir, name), dst_dir)
+
+
+def BenchScale(datadir, rundir, size, cores, args, nfields, rasterdir):
+    # All the stages for one scale and core count
+    py = sys.executable
+    tilesize = int(np.ceil(size / np.sqrt(args.tiles)))
+    results = []
+    def Record(stage, cmd, watch, log_file=None):
+        res = RunMeasured(cmd, watch)
+        res.update({'stage': stage, 'size': size, 'fields': nfields, 'tiles': args.tiles, 'cores': cores})
+        opens = ''
+        if log_file and os.path.isfile(log_file):
+            res['gdal_opens'], res['gdal_requests'] = OpenCounts(log_file)
+            opens = '{}/{}'.format(res['gdal_opens'], res['gdal_requests'])
+        results.append(res)
+        print("{:>7} {:>5} {:<28} {:>9.2f} {:>9.2f} {:>9.1f} {:>6} {:>12} {:>9} {}".format(size, cores, stage, res['wall_s'], res['cpu_s'], res['peak_rss_mb'], res['files_written'], res['bytes_written'], opens, '' if res['returncode'] == 0 else 'FAILED'))
+        return res
+
+    CopyInputs(datadir, rundir, ['seg.kea'])
+    seg = os.path.join(rundir, 'seg.kea')
+    clumps = os.path.join(rundir, 'seg_clumps.kea')
+    mode_img = os.path.join(rundir, 'seg_clumps_modeTileMsk.kea')
+    Record('ClumpSegmentation', [py, os.path.join(CODE_DIR, '0_ClumpSegmentation.py'), '-i', seg, '-m', args.clumpmethod, '-c', str(cores), '-t', str(tilesize)], rundir)
+    Record('PrepareSegmentation', [py, os.path.join(CODE_DIR, '1_CreateRegGrid.py'), '-i', clumps, '-t', str(tilesize)], rundir)
+
+    # Script 2 with the intermediate KEA files in a copy of the
+    # prepared segmentation, then each step rerun on its own
+    keadir = os.path.join(rundir, 'kea') + '/'
+    CopyInputs(rundir, keadir, ['seg_clumps.kea', 'seg_clumps_modeTileMsk.kea'])
+    Record('BoundingBoxes', [py, os.path.join(CODE_DIR, '2_BoundingBoxes_Docker.py'), '-i', keadir + 'seg_clumps.kea', '-m', keadir + 'seg_clumps_modeTileMsk.kea', '-r', str(RES), '-c', str(cores)], keadir)
+    for step, outdir in STEPS:
+        shutil.rmtree(keadir + outdir)
+        os.makedirs(keadir + outdir)
+        Record('BoundingBoxes.' + step, [py, os.path.abspath(__file__), '--runstep', step, '--basedir', keadir, '--segs', keadir + 'seg_clumps.kea', '--modeimg', keadir + 'seg_clumps_modeTileMsk.kea', '-c', str(cores)], keadir)
+
+    # Script 2 extracting each tile in memory, without and with the
+    # datasets kept open by each worker, then with the polygons
+    # simplified
+    memdirs = {}
+    for name, extra in [('inmemory.nohandles', ['--maxhandles', '0']), ('inmemory', []), ('inmemory.simplified', ['--simplify', str(args.simplify)])]:
+        memdir = os.path.join(rundir, name) + '/'
+        memdirs[name] = memdir
+        CopyInputs(rundir, memdir, ['seg_clumps.kea', 'seg_clumps_modeTileMsk.kea'])
+        cmd = [py, os.path.join(CODE_DIR, '2_BoundingBoxes_Docker.py'), '-i', memdir + 'seg_clumps.kea', '-m', memdir + 'seg_clumps_modeTileMsk.kea', '-r', str(RES), '-c', str(cores), '--inmemory']
+        res = Record('BoundingBoxes.' + name, cmd + extra, memdir, memdir + 'farma_log.jsonl')
+        res['gpkg_vertices'], res['gpkg_bytes'] = GPKGSize(memdir + '6_GPKGs')
+
+    populate = {}
+    for name, gpkgs, extra in [('PopulateVectors.nohandles', 'inmemory', ['--maxhandles', '0']), ('PopulateVectors', 'inmemory', []), ('PopulateVectors.simplified', 'inmemory.simplified', [])]:
+        outdir = os.path.join(rundir, name)
+        os.makedirs(outdir)
+        cmd = [py, os.path.join(CODE_DIR, '3_PopulatePolys.py'), '-s', memdirs[gpkgs] + '6_GPKGs', '-r', rasterdir, '-o', outdir, '-c', str(cores), '-z', args.zonal, '--schedule', 'gpkg']
+        populate[name] = Record(name, cmd + extra, outdir, os.path.join(outdir, 'farma_log.jsonl'))
+
+    exact = [r for r in results if r['stage'] == 'BoundingBoxes.inmemory'][0]
+    simple = [r for r in results if r['stage'] == 'BoundingBoxes.inmemory.simplified'][0]
+    print("{:>7} {:>5} simplified to {} px: vertices {} -> {} ({:.1f}x), GPKG bytes {} -> {} ({:.1f}x), populate {:.2f} -> {:.2f} s ({:.2f}x)".format(
+          size, cores, args.simplify, exact['gpkg_vertices'], simple['gpkg_vertices'], exact['gpkg_vertices'] / float(max(simple['gpkg_vertices'], 1)),
+          exact['gpkg_bytes'], simple['gpkg_bytes'], exact['gpkg_bytes'] / float(max(simple['gpkg_bytes'], 1)),
+          populate['PopulateVectors']['wall_s'], populate['PopulateVectors.simplified']['wall_s'],
+          populate['PopulateVectors']['wall_s'] / max(populate['PopulateVectors.simplified']['wall_s'], 1e-9)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", type=str, default="2000,4000", help="Comma separated list of segmentation sizes (pixels per side)")
+    parser.add_argument("-f", "--fieldsize", type=int, default=20, help="Specify the mean field width in pixels")
+    parser.add_argument("--shape", type=str, default="voronoi", choices=["voronoi", "rectangles"], help="Specify the shape of the synthetic fields")
+    parser.add_argument("-t", "--tiles", type=int, default=16, help="Specify the number of regular grid tiles")
+    parser.add_argument("-d", "--dates", type=int, default=4, help="Specify the number of time-series rasters")
+    parser.add_argument("-c", "--cores", type=str, default="1,4", help="Comma separated list of core counts")
+    parser.add_argument("-m", "--clumpmethod", type=str, default="AUTO", help="Specify the 0_ClumpSegmentation.py method")
+    parser.add_argument("-z", "--zonal", type=str, default="raster", help="Specify the 3_PopulatePolys.py zonal stats engine")
+    parser.add_argument("--simplify", type=float, default=1.0, help="Specify the simplification tolerance (pixels) of the simplified run (default 1.0)")
+    parser.add_argument("-o", "--report", type=str, default="bench_pipeline.json", help="Specify the output JSON report")
+    parser.add_argument("-w", "--workdir", type=str, help="Specify the dir for the synthetic data and outputs (default: a temporary dir, removed afterwards)")
+    parser.add_argument("--runstep", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--basedir", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--segs", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--modeimg", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.runstep:
+        RunStep(args.runstep, args.basedir, args.segs, args.modeimg, int(args.cores))
+        return
+
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp()
+    results = []
+    try:
+        print("{:>7} {:>5} {:<28} {:>9} {:>9} {:>9} {:>6} {:>12} {:>9}".format('size', 'cores', 'stage', 'wall_s', 'cpu_s', 'rss_mb', 'files', 'bytes', 'opens'))
+        for size in [int(x) for x in args.sizes.split(',')]:
+            datadir = os.path.join(workdir, 'data_{}'.format(size))
+            os.makedirs(datadir)
+            start = time.time()
+            seg, rasterdir, nfields = SyntheticData(datadir, args.shape, size, args.fieldsize, args.dates)
+            print("Generated {} fields and {} rasters of {} x {} pixels in {:.1f} s".format(nfields, args.dates, size, size, time.time() - start))
+            for cores in [int(x) for x in args.cores.split(',')]:
+                rundir = os.path.join(workdir, 'run_{}_{}'.format(size, cores))
+                results.extend(BenchScale(datadir, rundir, size, cores, args, nfields, rasterdir))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    report = {'config': {k: v for k, v in vars(args).items() if k not in ['runstep', 'basedir', 'segs', 'modeimg']},
+              'machine': {'cpus': os.cpu_count(), 'mem_mb': os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2**20},
+              'results': results}
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("Report written to {}".format(args.report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Benchmark of the approximate (ZoneSketch) median and mode of
+# farma_zonal against the exact default. A synthetic image of square
+# objects of a given size (pixels) gets NDVI like float values, or
+# the same scaled to int16. The exact reduction is given the whole
+# image, as the exact engine is, while the sketch is fed strips of
+# rows (views of the image) as SketchZonalStats reads them. The time
+# and peak memory of each are printed with the median error (against
+# the documented bound, 2 * (max - min) / (bins - 2)) and the fraction
+# of objects with the exact median and mode. With the number of
+# objects fixed and the objects growing, the exact peak grows with
+# the pixels while the sketch peak stays bounded.
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code'))
+import farma_zonal
+
+
+def SyntheticImage(nzones, object_px, dtype, seed=42):
+    # Zones (1..nzones) as squares of about object_px pixels on a grid
+    # of columns, each with a per object mean value plus noise
+    rng = np.random.default_rng(seed)
+    side = max(1, int(round(np.sqrt(object_px))))
+    ncols = int(np.ceil(np.sqrt(nzones)))
+    nrows = int(np.ceil(nzones / float(ncols)))
+    rows = np.arange(nrows * side) // side
+    cols = np.arange(ncols * side) // side
+    zones = (rows[:, None] * ncols + cols[None, :] + 1).astype(np.uint32)
+    zones[zones > nzones] = 0
+    values = rng.uniform(0.1, 0.7, nzones + 1)[zones] + rng.normal(0, 0.08, zones.shape)
+    values = np.clip(values, -0.99, 0.99)
+    if dtype == 'int16':
+        values = np.round(values * 10000).astype(np.int16)
+    else:
+        values = values.astype(np.float32)
+    return zones, values
+
+
+def Exact(zones, values, nzones, bins):
+    return farma_zonal.ZonalStatsArrays(zones, values, nzones)
+
+
+def Sketch(zones, values, nzones, bins):
+    # Strips of rows as SketchZonalStats reads them
+    sketch = farma_zonal.ZoneSketch(nzones, bins)
+    rows = max(1, farma_zonal.SKETCH_STRIP_PX // zones.shape[1])
+    for row in range(0, zones.shape[0], rows):
+        sketch.Add(zones[row:row + rows], values[row:row + rows])
+    return sketch.Stats()
+
+
+def Measure(func, zones, values, nzones, bins, repeats):
+    # (best time, peak traced MB, stats) of one reduction
+    best = None
+    peak = 0
+    for i in range(repeats):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        stats = func(zones, values, nzones, bins)
+        elapsed = time.perf_counter() - t0
+        peak = max(peak, tracemalloc.get_traced_memory()[1] / 2.0**20)
+        tracemalloc.stop()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, peak, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--nzones", type=int, default=400, help="Specify the number of objects")
+    parser.add_argument("-o", "--objectsize", type=str, default="2500,10000,40000", help="Comma separated list of object sizes (pixels)")
+    parser.add_argument("-b", "--bins", type=str, default="64,256,1024", help="Comma separated list of sketch bin counts")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Specify the number of timed repeats (the best is kept)")
+    args = parser.parse_args()
+
+    print("{:>7} {:>9} {:>9} {:>7} {:>8} {:>8} {:>12} {:>9} {:>9} {:>8}".format('dtype', 'obj_px', 'image_MB', 'bins', 'time_s', 'peak_MB', 'med_err_max', 'in_bound', 'med_exact', 'mode_eq'))
+    for dtype in ['float32', 'int16']:
+        for object_px in [int(x) for x in args.objectsize.split(',')]:
+            zones, values = SyntheticImage(args.nzones, object_px, dtype)
+            image_mb = (zones.nbytes + values.nbytes) / 2.0**20
+            exact_s, exact_mb, exact = Measure(Exact, zones, values, args.nzones, None, args.repeats)
+            print("{:>7} {:>9} {:>9.0f} {:>7} {:>8.2f} {:>8.1f}".format(dtype, object_px, image_mb, 'exact', exact_s, exact_mb))
+            ids = np.flatnonzero(exact['count'] > 0)
+            for bins in [int(x) for x in args.bins.split(',')]:
+                sketch_s, sketch_mb, sketch = Measure(Sketch, zones, values, args.nzones, bins, args.repeats)
+                err = np.abs(sketch['median'][ids] - exact['median'][ids])
+                bound = 2 * (exact['max'][ids] - exact['min'][ids]) / (bins - 2)
+                in_bound = np.mean(err <= bound)
+                med_exact = np.mean(err == 0)
+                mode_eq = np.mean(sketch['mode'][ids] == exact['mode'][ids])
+                print("{:>7} {:>9} {:>9.0f} {:>7} {:>8.2f} {:>8.1f} {:>12.5g} {:>8.1f}% {:>8.1f}% {:>7.1f}%".format(dtype, object_px, image_mb, bins, sketch_s, sketch_mb, err.max(), 100 * in_bound, 100 * med_exact, 100 * mode_eq))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Benchmark of the per-tile bounding box computation used in
+# STEP 1 of 2_BoundingBoxes_Docker.py. The original loop (one
+# boolean mask and four reductions per tile) is compared against
+# farma_rat.TileExtents on synthetic RATs.
+# The loop is timed on a sample of tiles and extrapolated to the
+# full tile count, as it takes hours on the largest RATs.
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code'))
+import farma_rat
+
+
+def SyntheticRAT(nrows, ntiles, seed=42):
+    # Random objects spread over a ntiles grid of 1000x1000 unit cells
+    rng = np.random.default_rng(seed)
+    TileID = rng.integers(1, ntiles + 1, size=nrows).astype(np.uint32)
+    ncols = int(np.ceil(np.sqrt(ntiles)))
+    cellX = ((TileID - 1) % ncols) * 1000.0
+    cellY = ((TileID - 1) // ncols) * 1000.0
+    MinXX = cellX + rng.uniform(0, 990, nrows)
+    MinYY = cellY + rng.uniform(0, 990, nrows)
+    MaxXX = MinXX + rng.uniform(0, 50, nrows)
+    MaxYY = MinYY + rng.uniform(0, 50, nrows)
+    return TileID, MinXX, MinYY, MaxXX, MaxYY
+
+
+def LoopTileExtents(TileID, MinXX, MinYY, MaxXX, MaxYY, tiles):
+    # The original STEP 1 implementation
+    out = []
+    for tile in tiles:
+        bin_tiles = TileID==tile
+        minX = np.min(MinXX[bin_tiles])
+        minY = np.min(MinYY[bin_tiles])
+        maxX = np.max(MaxXX[bin_tiles])
+        maxY = np.max(MaxYY[bin_tiles])
+        out.append([minX, maxX, minY, maxY])
+    return np.array(out)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--rows", type=str, default="1000000,10000000,100000000", help="Comma separated list of RAT sizes to benchmark")
+    parser.add_argument("-t", "--tiles", type=int, default=2000, help="Specify the number of tiles")
+    parser.add_argument("-s", "--sample", type=int, default=20, help="Specify the number of tiles the original loop is timed over")
+    args = parser.parse_args()
+
+    print("{:>12} {:>8} {:>14} {:>14} {:>10}".format('rows', 'tiles', 'loop_s (est)', 'grouped_s', 'speedup'))
+    for nrows in [int(x) for x in args.rows.split(',')]:
+        TileID, MinXX, MinYY, MaxXX, MaxYY = SyntheticRAT(nrows, args.tiles)
+
+        t0 = time.perf_counter()
+        tiles, counts, minX, maxX, minY, maxY = farma_rat.TileExtents(TileID, MinXX, MinYY, MaxXX, MaxYY)
+        grouped = time.perf_counter() - t0
+
+        sample = tiles[np.linspace(0, tiles.size - 1, min(args.sample, tiles.size)).astype(int)]
+        t0 = time.perf_counter()
+        looped = LoopTileExtents(TileID, MinXX, MinYY, MaxXX, MaxYY, sample)
+        loop = (time.perf_counter() - t0) * tiles.size / sample.size
+
+        # Check the grouped result matches the loop on the sampled tiles
+        idx = np.searchsorted(tiles, sample)
+        expected = np.column_stack((minX[idx], maxX[idx], minY[idx], maxY[idx]))
+        if not np.array_equal(looped, expected):
+            raise Exception("Grouped extents do not match the original loop for {} rows".format(nrows))
+        if counts.sum() != nrows:
+            raise Exception("Object counts do not sum to the number of rows")
+
+        print("{:>12} {:>8} {:>14.2f} {:>14.3f} {:>10.0f}x".format(nrows, tiles.size, loop, grouped, loop / grouped))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Benchmark of the raster based zonal statistics engine
+# (farma_zonal.CalcZonalBandStats) against the rsgislib point in
+# polygon call used by 3_PopulatePolys.py. A synthetic raster and a
+# grid of square field polygons are generated, both engines populate
+# the same columns and the results are checked to match.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import osgeo.gdal as gdal
+from osgeo import ogr
+from osgeo import osr
+import rsgislib.vectorutils
+import rsgislib.zonalstats
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code'))
+import farma_zonal
+
+
+def SyntheticRaster(out_img, size, res=10.0, seed=42):
+    rng = np.random.default_rng(seed)
+    data = np.round(rng.uniform(-1.2, 1.2, (size, size)), 2).astype(np.float32)
+    imgDataset = gdal.GetDriverByName('GTiff').Create(out_img, size, size, 1, gdal.GDT_Float32)
+    imgDataset.SetGeoTransform((0.0, res, 0, size * res, 0, -res))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32630)
+    imgDataset.SetProjection(srs.ExportToWkt())
+    imgDataset.GetRasterBand(1).WriteArray(data)
+    imgDataset = None
+    return srs
+
+
+def SyntheticFields(out_vec, srs, size, field_px, res=10.0):
+    # A grid of square fields field_px pixels wide, offset by a
+    # fraction of a pixel so edges do not fall on pixel centres
+    vecDataset = ogr.GetDriverByName('GPKG').CreateDataSource(out_vec)
+    lyrname = os.path.basename(out_vec)
+    veclyr = vecDataset.CreateLayer(lyrname, srs, ogr.wkbPolygon)
+    veclyr.CreateField(ogr.FieldDefn('PXLVAL', ogr.OFTInteger))
+    veclyr.StartTransaction()
+    step = field_px * res
+    nfields = 0
+    for i in range(size // field_px):
+        for j in range(size // field_px):
+            x0 = i * step + 0.3 * res
+            y0 = j * step + 0.3 * res
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for x, y in [(x0, y0), (x0 + step, y0), (x0 + step, y0 + step), (x0, y0 + step), (x0, y0)]:
+                ring.AddPoint_2D(x, y)
+            poly = ogr.Geometry(ogr.wkbPolygon)
+            poly.AddGeometry(ring)
+            feat = ogr.Feature(veclyr.GetLayerDefn())
+            feat.SetGeometry(poly)
+            nfields += 1
+            feat.SetField('PXLVAL', nfields)
+            veclyr.CreateFeature(feat)
+    veclyr.CommitTransaction()
+    vecDataset = None
+    return lyrname, nfields
+
+
+def ReadFields(veclyr, fields):
+    veclyr.ResetReading()
+    out = np.array([[feat.GetField(fld) for fld in fields] for feat in veclyr], dtype=np.float64)
+    veclyr.ResetReading()
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--size", type=str, default="1000,4000", help="Comma separated list of raster sizes (pixels per side)")
+    parser.add_argument("-f", "--fieldsize", type=int, default=10, help="Specify the field width in pixels")
+    args = parser.parse_args()
+
+    fields = {'min': 'd_min', 'max': 'd_max', 'mean': 'd_mean', 'std': 'd_std', 'sum': 'd_sum', 'count': 'd_count', 'mode': 'd_mode', 'median': 'd_med'}
+    tmpdir = tempfile.mkdtemp()
+    mismatches = []
+    try:
+        print("{:>8} {:>10} {:>12} {:>12} {:>10}".format('size', 'fields', 'points_s', 'raster_s', 'speedup'))
+        for size in [int(x) for x in args.size.split(',')]:
+            img = os.path.join(tmpdir, 'img_{}.tif'.format(size))
+            vec = os.path.join(tmpdir, 'fields_{}.gpkg'.format(size))
+            srs = SyntheticRaster(img, size)
+            lyrname, nfields = SyntheticFields(vec, srs, size, args.fieldsize)
+
+            mem_ds, veclyr = rsgislib.vectorutils.read_vec_lyr_to_mem(vec, lyrname)
+            t0 = time.perf_counter()
+            rsgislib.zonalstats.calc_zonal_band_stats_test_poly_pts(veclyr, img, 1, -1, 1, min_field=fields['min'], max_field=fields['max'], mean_field=fields['mean'], stddev_field=fields['std'], sum_field=fields['sum'], count_field=fields['count'], mode_field=fields['mode'], median_field=fields['median'], out_no_data_val=0)
+            points = time.perf_counter() - t0
+            expected = ReadFields(veclyr, list(fields.values()))
+            mem_ds = None
+
+            mem_ds, veclyr = rsgislib.vectorutils.read_vec_lyr_to_mem(vec, lyrname)
+            t0 = time.perf_counter()
+            farma_zonal.CalcZonalBandStats(veclyr, img, 1, -1, 1, min_field=fields['min'], max_field=fields['max'], mean_field=fields['mean'], stddev_field=fields['std'], sum_field=fields['sum'], count_field=fields['count'], mode_field=fields['mode'], median_field=fields['median'], out_no_data_val=0)
+            raster = time.perf_counter() - t0
+            result = ReadFields(veclyr, list(fields.values()))
+            mem_ds = None
+
+            if not np.allclose(result, expected, atol=1e-5):
+                bad = np.unique(np.nonzero(~np.isclose(result, expected, atol=1e-5))[1])
+                print("MISMATCH: columns differ from rsgislib: {}".format([list(fields.values())[i] for i in bad]))
+                mismatches.append(size)
+            print("{:>8} {:>10} {:>12.2f} {:>12.2f} {:>10.1f}x".format(size, nfields, points, raster, points / raster))
+    finally:
+        shutil.rmtree(tmpdir)
+    # The raster engine must give the same results as rsgislib
+    if mismatches:
+        print("FAILED: results differ from rsgislib for sizes {}".format(mismatches))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,13 +26,18 @@
 # A script to use RSGISLib to prepare KEA format
 # segmentation clumps for the FARMA workflow.
 # Multiple methods of clumping are avaialable
-# depending upon RAM/CORES available
+# depending upon RAM/CORES available, or AUTO to pick one
+# from estimates of the memory and runtime of each
 
 import rsgislib.segmentation
+import rsgislib.segmentation.tiledclump
 import rsgislib.rastergis
 import rsgislib.tools.filetools
 import argparse
 import os
+import time
+import farma_plan
+import farma_manifest
 
 
 def ClumpSegmentation(args):
@@ -44,21 +49,37 @@ def ClumpSegmentation(args):
     out_img_name = '{}_clumps.kea'.format(basename)
     out_img_path = os.path.join(dir_path, out_img_name)
     print(out_img_path)
-    if not os.path.isfile(out_img_path):
+    # The clumps are written to a temporary file, renamed when complete
+    # and only skipped on a rerun if made from the current input
+    if not farma_manifest.IsDone(out_img_path, [segs]):
         ClumpMethod = args.method
-        
-        if ClumpMethod == "CLUMP_RAM":
-            rsgislib.segmentation.clump(args.input, out_img_path, 'KEA', True, 0, False)
-        elif ClumpMethod == "CLUMP_DISK":
-            rsgislib.segmentation.clump(args.input, out_img_path, 'KEA', False, 0, False)
-        elif ClumpMethod == "TILED_SINGLE":
-            rsgislib.segmentation.tiledclump.perform_clumping_single_thread(segs, out_img_path, tmp_dir='tmp', width=args.tilesize, height=args.tilesize, gdalformat='KEA')
-        elif ClumpMethod == "TILED_MULTI":
-            rsgislib.segmentation.tiledclump.perform_clumping_multi_process(segs, out_img_path, tmp_dir='tmp', width=args.tilesize, height=args.tilesize, gdalformat='KEA', nCores=args.cores)
-        else:
-            raise Exception("Specified method ({}) was not recognised".format(ClumpMethod))
-                
-        rsgislib.rastergis.pop_rat_img_stats(clumps_img=out_img_path, add_clr_tab=True, calc_pyramids=True, ignore_zero=True)
+        plan_log = args.planlog if args.planlog else os.path.join(dir_path, 'clump_plans.jsonl')
+        if ClumpMethod == "AUTO":
+            mem_bytes = args.maxmem * 1024 * 1024 if args.maxmem else None
+            plan = farma_plan.PlanClumping(segs, plan_log, mem_bytes, args.cores)
+            ClumpMethod = plan['method']
+            args.tilesize = plan['tilesize']
+            args.cores = plan['cores']
+        start = time.time()
+
+        with farma_manifest.AtomicOutput(out_img_path) as tmp_img_path:
+            if ClumpMethod == "CLUMP_RAM":
+                rsgislib.segmentation.clump(args.input, tmp_img_path, 'KEA', True, 0, False)
+            elif ClumpMethod == "CLUMP_DISK":
+                rsgislib.segmentation.clump(args.input, tmp_img_path, 'KEA', False, 0, False)
+            elif ClumpMethod == "TILED_SINGLE":
+                rsgislib.segmentation.tiledclump.perform_clumping_single_thread(segs, tmp_img_path, tmp_dir='tmp', width=args.tilesize, height=args.tilesize, gdalformat='KEA')
+            elif ClumpMethod == "TILED_MULTI":
+                rsgislib.segmentation.tiledclump.perform_clumping_multi_process(segs, tmp_img_path, tmp_dir='tmp', width=args.tilesize, height=args.tilesize, gdalformat='KEA', nCores=args.cores)
+            else:
+                raise Exception("Specified method ({}) was not recognised".format(ClumpMethod))
+
+            if args.method == "AUTO":
+                cores = args.cores if ClumpMethod == "TILED_MULTI" else 0
+                farma_plan.LogRun(plan_log, plan, time.time() - start, farma_plan.PeakMemoryMB(cores))
+
+            rsgislib.rastergis.pop_rat_img_stats(clumps_img=tmp_img_path, add_clr_tab=True, calc_pyramids=True, ignore_zero=True)
+        farma_manifest.MarkDone(out_img_path, [segs])
     else:
         print("CLUMP FILE EXISTS: SKIPPING")
 
@@ -69,8 +90,10 @@ def main():
     print("Use 'python 0_ClumpSegmentation.py -h' for help")
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", type=str, help="Specify the input Segmentation")
-    parser.add_argument("-m", "--method", type=str, help="Specify the clumping method from CLUMP_RAM, CLUMP_DISK, TILED_SINGLE, TILED_MULTI")
-    parser.add_argument("-c", "--cores", type=int, help="Specify the number of cores")
+    parser.add_argument("-m", "--method", type=str, help="Specify the clumping method from CLUMP_RAM, CLUMP_DISK, TILED_SINGLE, TILED_MULTI or AUTO")
+    parser.add_argument("-c", "--cores", type=int, help="Specify the number of cores (AUTO: the most cores to use)")
+    parser.add_argument("--maxmem", type=int, help="Specify the memory (MB) AUTO may plan for (default: the memory available)")
+    parser.add_argument("--planlog", type=str, help="Specify the log of AUTO runs used to calibrate the estimates (default: clump_plans.jsonl next to the input)")
     parser.add_argument("-t", "--tilesize", type=int, help="Specify the tilesize in pixels in the X dimension")
     args = parser.parse_args()
 
@@ -78,7 +101,7 @@ def main():
         print("INPUT SEGMENTATION MISSING")
         os._exit(1)
     elif args.method == None:
-        print("Specify the clumping method from CLUMP_RAM, CLUMP_DISK, TILED_SINGLE, TILED_MULTI")
+        print("Specify the clumping method from CLUMP_RAM, CLUMP_DISK, TILED_SINGLE, TILED_MULTI, AUTO")
         os._exit(1)
     else:
         print(args.input, args.method)
@@ -27,41 +27,153 @@
 # segmentation for the FARMA workflow.
 # A Regular grid with a user specifed tile size is generated
 # and is populated into the segmentation, alongside the dimensions
-# (max extent) of each object
+# (max extent) of each object. With --fused this is all done in a
+# single block-wise pass over the segmentation (farma_prepare).
 
 import rsgislib.segmentation
 import rsgislib.rastergis
 import argparse
 import os
+import numpy as np
+import osgeo.gdal as gdal
+from rios import rat
+import farma_rat
+import farma_prepare
+import farma_manifest
+
+
+def AdaptiveTileColumn(segs, max_objects=None, max_pixels=None):
+    # Populate the 'tiles' RAT column with a k-d split of the object
+    # centroids so each tile has at most max_objects objects and/or
+    # max_pixels pixels, rather than a regular grid of fixed size
+    # The centroids and pixel counts are built from the RAT columns
+    # streamed in chunks rather than reading each full column
+    nrows = farma_rat.RATRowCount(segs)
+    cx = np.empty(nrows)
+    cy = np.empty(nrows)
+    pixels = np.empty(nrows)
+    for start, cols in farma_rat.ReadRATChunks(segs, ["MinXX", "MaxXX", "MinYY", "MaxYY", "Histogram"]):
+        end = start + cols["Histogram"].size
+        cx[start:end] = (cols["MinXX"] + cols["MaxXX"]) / 2.0
+        cy[start:end] = (cols["MinYY"] + cols["MaxYY"]) / 2.0
+        pixels[start:end] = cols["Histogram"]
+    # Row 0 is the background (no data) clump and is not tiled, nor
+    # are clumps with no pixels (their extent is not set), which stay
+    # in tile 0
+    TileID = np.zeros(nrows, dtype=np.uint32)
+    present = np.flatnonzero(pixels[1:] > 0) + 1
+    TileID[present] = farma_rat.AdaptiveTiles(cx[present], cy[present], max_objects, pixels[present], max_pixels)
+    cx = cy = pixels = present = None
+    ratDataset = gdal.Open(segs, gdal.GA_Update)
+    rat.writeColumn(ratDataset, "tiles", TileID)
+    ratDataset = None
+    print("Created {} adaptive tiles".format(TileID.max()))
+
+
+def AdaptiveTileIDs(columns, histogram, max_objects=None, max_pixels=None):
+    # The adaptive tile of each clump from the extent columns of a
+    # fused scan (see AdaptiveTileColumn)
+    # Row 0 is the background (no data) clump and is not tiled, nor
+    # are clumps with no pixels, which stay in tile 0
+    TileID = np.zeros(histogram.size, dtype=np.uint32)
+    present = np.flatnonzero(histogram[1:] > 0) + 1
+    cx = (columns["MinXX"][present] + columns["MaxXX"][present]) / 2.0
+    cy = (columns["MinYY"][present] + columns["MaxYY"][present]) / 2.0
+    TileID[present] = farma_rat.AdaptiveTiles(cx, cy, max_objects, histogram[present], max_pixels)
+    print("Created {} adaptive tiles".format(TileID.max()))
+    return TileID
+
+
+def ModeParams(args):
+    # Parameters the image of the tiles is made with
+    return {'tilesize': None if args.adaptive else args.tilesize, 'adaptive': bool(args.adaptive), 'maxobjects': args.maxobjects, 'maxpixels': args.maxpixels, 'fused': bool(args.fused)}
+
+
+def MaxTileID(segs):
+    # Largest value of the 'tiles' RAT column
+    maxtile = 0
+    for start, cols in farma_rat.ReadRATChunks(segs, ["tiles"]):
+        if cols["tiles"].size:
+            maxtile = max(maxtile, int(cols["tiles"].max()))
+    return maxtile
+
+
+def PrepareSegmentationFused(args):
+    # One read of the segmentation gathers the pixel counts, extents
+    # and mode grid cell of every clump (no regular grid image), then
+    # all the RAT columns are written together. A second read writes
+    # the image of the tiles. No colour table or pyramids are added.
+    segs = args.input
+    # Writing the RAT changes the segmentation's fingerprint, so check
+    # whether the image of the tiles is up to date first
+    modeTileMsk = segs.replace('.kea','_modeTileMsk.kea')
+    modeDone = farma_manifest.IsDone(modeTileMsk, [segs], ModeParams(args))
+    print("Scanning segmentation...")
+    scan = farma_prepare.ScanClumps(segs, None if args.adaptive else args.tilesize)
+    if args.adaptive:
+        TileID = AdaptiveTileIDs(farma_prepare.ExtentColumns(scan), scan['count'], args.maxobjects, args.maxpixels)
+    else:
+        TileID = scan['tiles']
+    farma_prepare.WriteClumpColumns(segs, scan, TileID)
+
+    # Create a an image of the tiles.
+    # (written to a temporary file and renamed when complete, and only
+    # skipped if made from the segmentation as it was before the RAT
+    # was written, which is recorded again as it is now)
+    if modeDone:
+        print('File Exists: skipping')
+    else:
+        with farma_manifest.AtomicOutput(modeTileMsk) as tmp_img:
+            farma_prepare.WriteModeImage(segs, TileID, tmp_img)
+    farma_manifest.MarkDone(modeTileMsk, [segs], ModeParams(args))
 
 
 def PrepareSegmentation(args):
 
     segs = args.input
+    # Populating the RAT changes the segmentation's fingerprint, so
+    # check whether the image of the tiles is up to date first
+    modeTileMsk = segs.replace('.kea','_modeTileMsk.kea')
+    modeDone = farma_manifest.IsDone(modeTileMsk, [segs], ModeParams(args))
 
     # Create Regular Grid
-    RegGrid = segs.replace('.kea','_regGrid.kea')
-    if os.path.isfile(RegGrid):
-        print('Regular Grid Exists: Skipping')
-    else:
-        rsgislib.segmentation.generate_regular_grid(segs, RegGrid, 'KEA', args.tilesize, args.tilesize)
+    if not args.adaptive:
+        RegGrid = segs.replace('.kea','_regGrid.kea')
+        # The grid only depends on the segmentation's size, not its values
+        segDataset = gdal.Open(segs, gdal.GA_ReadOnly)
+        params = {'tilesize': args.tilesize, 'size': [segDataset.RasterXSize, segDataset.RasterYSize], 'geotransform': list(segDataset.GetGeoTransform())}
+        segDataset = None
+        if farma_manifest.IsDone(RegGrid, params=params):
+            print('Regular Grid Exists: Skipping')
+        else:
+            with farma_manifest.AtomicOutput(RegGrid) as tmp_img:
+                rsgislib.segmentation.generate_regular_grid(segs, tmp_img, 'KEA', args.tilesize, args.tilesize)
+            farma_manifest.MarkDone(RegGrid, params=params)
 
     # Populate RAT with statistics
     rsgislib.rastergis.pop_rat_img_stats(clumps_img=segs, add_clr_tab=True, calc_pyramids=True, ignore_zero=True)
 
     # Populate RAT with Mode Regular Grid Value
-    rsgislib.rastergis.populate_rat_with_mode(input_img=RegGrid, clumps_img=segs, out_cols_name='tiles', use_no_data=False, no_data_val=0, out_no_data=False, mode_band=1, rat_band=1)
+    if not args.adaptive:
+        rsgislib.rastergis.populate_rat_with_mode(input_img=RegGrid, clumps_img=segs, out_cols_name='tiles', use_no_data=False, no_data_val=0, out_no_data=False, mode_band=1, rat_band=1)
 
     # Populate RAT with spatial extent of each object
     rsgislib.rastergis.clumps_spatial_extent(clumps_img=segs, min_xx='MinXX', min_xy='MinXY', max_xx='MaxXX', max_xy='MaxXY', min_yx='MinYX', min_yy='MinYY', max_yx='MaxYX', max_yy='MaxYY')
+
+    # Populate RAT with the adaptive tile of each object (uses the extents)
+    if args.adaptive:
+        AdaptiveTileColumn(segs, args.maxobjects, args.maxpixels)
     
-    # Create a an image of the tiles.
-    modeTileMsk = segs.replace('.kea','_modeTileMsk.kea')
-    if os.path.isfile(modeTileMsk):
+    # Create a an image of the tiles (32 bit if there are more tiles
+    # than 16 bits hold).
+    if modeDone:
         print('File Exists: skipping')
     else:
-        rsgislib.rastergis.export_col_to_gdal_img(segs, modeTileMsk, 'KEA', rsgislib.TYPE_16UINT, 'tiles')
-        rsgislib.rastergis.pop_rat_img_stats(clumps_img=modeTileMsk, add_clr_tab=True, calc_pyramids=True, ignore_zero=True)
+        datatype = rsgislib.TYPE_16UINT if MaxTileID(segs) <= 65535 else rsgislib.TYPE_32UINT
+        with farma_manifest.AtomicOutput(modeTileMsk) as tmp_img:
+            rsgislib.rastergis.export_col_to_gdal_img(segs, tmp_img, 'KEA', datatype, 'tiles')
+            rsgislib.rastergis.pop_rat_img_stats(clumps_img=tmp_img, add_clr_tab=True, calc_pyramids=True, ignore_zero=True)
+    farma_manifest.MarkDone(modeTileMsk, [segs], ModeParams(args))
 
 
 def main():
@@ -69,6 +181,10 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", type=str, help="Specify the input Segmentation KEA file")
     parser.add_argument("-t", "--tilesize", type=int, help="Specify the tiling size (X dimension) in pixels (e.g. 1000)")
+    parser.add_argument("-a", "--adaptive", action="store_true", help="Split the objects into tiles with a target number of objects/pixels rather than a regular grid")
+    parser.add_argument("--maxobjects", type=int, help="Specify the maximum number of objects per tile (adaptive tiling)")
+    parser.add_argument("--maxpixels", type=int, help="Specify the maximum number of object pixels per tile (adaptive tiling)")
+    parser.add_argument("--fused", action="store_true", help="Prepare the segmentation in a single block-wise pass rather than the separate RSGISLib passes. No regular grid image, colour tables or pyramids are written")
     args = parser.parse_args()
 
     if str(args.input).endswith('.kea'):
@@ -77,11 +193,18 @@ def main():
         print("INPUT SEGMENTATION FILE MUST END '.kea'")
         os._exit(1)
         
-    if args.tilesize == None:
+    if args.adaptive:
+        if (args.maxobjects == None) and (args.maxpixels == None):
+            print("SPECIFY THE MAXIMUM OBJECTS AND/OR PIXELS PER TILE")
+            os._exit(1)
+    elif args.tilesize == None:
         print("SPECIFY THE TILE SIZE IN PIXELS")
         os._exit(1)
 
-    PrepareSegmentation(args)
+    if args.fused:
+        PrepareSegmentationFused(args)
+    else:
+        PrepareSegmentation(args)
 
 
 if __name__ == "__main__":
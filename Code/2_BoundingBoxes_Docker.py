@@ -24,10 +24,11 @@
     SOFTWARE.'''
     
      
-from rios import rat
 import numpy as np
 import os.path
 import osgeo.gdal as gdal
+from osgeo import ogr
+from osgeo import osr
 import rsgislib
 import rsgislib.imageutils
 import rsgislib.rastergis
@@ -40,117 +41,277 @@ from multiprocessing import Pool
 import multiprocessing
 import argparse
 from itertools import product
+import farma_rat
+import farma_pipeline
+import farma_extract
+import farma_vector
+import farma_instrument
+import farma_manifest
+import farma_queue
+import farma_dirty
+import farma_handles
+import farma_storage
+import farma_polygonise
+import time
 
-def CreateMasks(tile, out_tiles_dir, tile_msk_dir, mode_img_file):#, ModeMaskImage, out_tiles_dir, tile_msk_dir):
-    try:
-        #########
-        # STEP 2: MAKE A MASK OF THE VALID OBJECTS PER TILE (All objects are 1 object)
-        # USING EXTENT OF BLANK IMAGE
-        ##########
-        # in tile name (blank image)
-        print(tile)
-        img_tile = os.path.join(out_tiles_dir, "tile_{0}.kea".format(str(tile)))
-        print(img_tile)
-        # output tile mask name
-        out_msk_img = os.path.join(tile_msk_dir, "tile_msk_{0}.kea".format(tile))
-        print("Creating {}".format(out_msk_img))
-        # Hack to export the segs per tile to a new image
-        # Uses bandmath which subsets the resulst to smallest input image
-        # step1: put the bands into the banddefns
-        bandDefnSeq = [rsgislib.imagecalc.BandDefn('b1', mode_img_file, 1), rsgislib.imagecalc.BandDefn('tile', img_tile, 1)]
-        # Makes a binary image if b1 (the number in the tiles image) matches the tile number (based on mode).
-        # Blank mask image used for image extent only
-        if os.path.isfile(out_msk_img):
-            pass
-            print('Out Mask Image Exists...')
-        else:
-            rsgislib.imagecalc.band_math(out_msk_img, 'b1=={}?1:0'.format(tile), 'KEA', rsgislib.TYPE_8UINT, bandDefnSeq)
+# Pyramids and colour tables on the intermediate KEA files (--pyramids)
+PYRAMIDS = False
+
+def CreateBaseTile(tile, out_tiles_dir, bbox, wkt_str, resolution):
+    ###########
+    # STEP 1: CREATE A BLANK IMAGE FROM THE BBOX OF THE OBJECTS OF THE TILE
+    ############
+    img_tile = os.path.join(out_tiles_dir, "tile_{0}.kea".format(tile))
+    params = {'bbox': [float(x) for x in bbox], 'resolution': resolution, 'wkt': wkt_str}
+    if farma_manifest.IsDone(img_tile, params=params):
+        print('Base tile exists...')
+    else:
+        # create a blank image per tile
+        with farma_manifest.AtomicOutput(img_tile) as tmp_img:
+            rsgislib.imageutils.create_blank_img_from_bbox(bbox, wkt_str, tmp_img, resolution, 0, 1, 'KEA', rsgislib.TYPE_32UINT, snap_to_grid=True)
+        farma_manifest.MarkDone(img_tile, params=params)
+
+def ReadTileWindow(img_tile, src_file):
+    # The window of src_file covered by the blank image of a tile (as
+    # band_math, the intersection of the two), read through the
+    # worker's open handles rather than opening the datasets again for
+    # every tile. Returns (array, geotransform, wkt_str).
+    tileDataset = farma_handles.OpenDataset(img_tile)
+    tile_gt = tileDataset.GetGeoTransform()
+    tile_xsize, tile_ysize = tileDataset.RasterXSize, tileDataset.RasterYSize
+    tileDataset = None
+    srcDataset = farma_handles.OpenDataset(src_file)
+    gt = srcDataset.GetGeoTransform()
+    if (tile_gt[1] != gt[1]) or (tile_gt[5] != gt[5]):
+        raise Exception("{} does not have the resolution of {}".format(img_tile, src_file))
+    xoff = int(round((tile_gt[0] - gt[0]) / gt[1]))
+    yoff = int(round((tile_gt[3] - gt[3]) / gt[5]))
+    x0, y0 = max(xoff, 0), max(yoff, 0)
+    x1 = min(xoff + tile_xsize, srcDataset.RasterXSize)
+    y1 = min(yoff + tile_ysize, srcDataset.RasterYSize)
+    if (x1 <= x0) or (y1 <= y0):
+        raise Exception("{} does not overlap {}".format(img_tile, src_file))
+    data = srcDataset.GetRasterBand(1).ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+    geotransform = (gt[0] + x0 * gt[1], gt[1], 0, gt[3] + y0 * gt[5], 0, gt[5])
+    return data, geotransform, srcDataset.GetProjection()
+
+
+def WriteTileImage(out_img, data, geotransform, wkt_str, datatype):
+    # Write a tile image as KEA with the options of the rsgislib outputs
+    driver = gdal.GetDriverByName('KEA')
+    outDataset = driver.Create(out_img, data.shape[1], data.shape[0], 1, datatype, farma_storage.KEACreationOptions())
+    outDataset.SetGeoTransform(geotransform)
+    outDataset.SetProjection(wkt_str)
+    outDataset.GetRasterBand(1).WriteArray(data)
+    outDataset = None
+
+
+def CreateMasks(tile, out_tiles_dir, tile_msk_dir, mode_img_file, fp_file=None):#, ModeMaskImage, out_tiles_dir, tile_msk_dir):
+    #########
+    # STEP 2: MAKE A MASK OF THE VALID OBJECTS PER TILE (All objects are 1 object)
+    # USING EXTENT OF BLANK IMAGE
+    ##########
+    # in tile name (blank image)
+    print(tile)
+    img_tile = os.path.join(out_tiles_dir, "tile_{0}.kea".format(str(tile)))
+    print(img_tile)
+    # output tile mask name
+    out_msk_img = os.path.join(tile_msk_dir, "tile_msk_{0}.kea".format(tile))
+    print("Creating {}".format(out_msk_img))
+    # Makes a binary image if the number in the tiles image matches the tile number (based on mode).
+    # Blank tile image used for image extent only
+    # Outputs are written to a temporary file and renamed when complete,
+    # and only skipped if they were made from the current inputs. With
+    # a tile fingerprint (farma_dirty.py) only a change to the tile's
+    # own objects redoes it, not a rewrite of the mode image
+    inputs = [fp_file if fp_file else mode_img_file, img_tile]
+    if farma_manifest.IsDone(out_msk_img, inputs):
+        print('Out Mask Image Exists...')
+    else:
+        with farma_manifest.AtomicOutput(out_msk_img) as tmp_img:
+            mode, geotransform, wkt_str = ReadTileWindow(img_tile, mode_img_file)
+            WriteTileImage(tmp_img, (mode == int(tile)).astype(np.uint8), geotransform, wkt_str, gdal.GDT_Byte)
             # Populate the stats (stats, pyramids etc)
-            rsgislib.rastergis.pop_rat_img_stats(clumps=out_msk_img, add_clr_tab=True, calc_pyramids=True, ignore_zero=True)
-    except Exception as e:
-        print(e)
+            rsgislib.rastergis.pop_rat_img_stats(clumps=tmp_img, add_clr_tab=PYRAMIDS, calc_pyramids=PYRAMIDS, ignore_zero=True)
+        farma_manifest.MarkDone(out_msk_img, inputs)
             
-def MaskTiles(tile, tile_segs_dir, segfile, out_tiles_dir):
-    try:
-        ########
-        # STEP 3: CUT OUT OBJECTS FROM SEGS BASED ON TILE EXTENT (BLANK IMAGE EXTENT)
-        ###########
-        # set output
-        img_tile = os.path.join(out_tiles_dir, "tile_{0}.kea".format(str(tile)))
-        out_segs_img = os.path.join(tile_segs_dir, "tile_segs_{0}.kea".format(tile))
-        print("Creating {}".format(out_segs_img))
-        # Use the seg file and the blank file
-        bandDefnSeq = [rsgislib.imagecalc.BandDefn('b1', segfile, 1), rsgislib.imagecalc.BandDefn('tile', img_tile, 1)]
-        # create new image (binary) of all segs within tile (will cut objects)
-        if os.path.isfile(out_segs_img):
-            print('out_segs_img exists')
-            pass
-        else:
-            rsgislib.imagecalc.band_math(out_segs_img, 'b1', 'KEA', rsgislib.TYPE_32UINT, bandDefnSeq)
+def MaskTiles(tile, tile_segs_dir, segfile, out_tiles_dir, fp_file=None):
+    ########
+    # STEP 3: CUT OUT OBJECTS FROM SEGS BASED ON TILE EXTENT (BLANK IMAGE EXTENT)
+    ###########
+    # set output
+    img_tile = os.path.join(out_tiles_dir, "tile_{0}.kea".format(str(tile)))
+    out_segs_img = os.path.join(tile_segs_dir, "tile_segs_{0}.kea".format(tile))
+    print("Creating {}".format(out_segs_img))
+    # create new image of all segs within tile extent (will cut objects)
+    inputs = [fp_file if fp_file else segfile, img_tile]
+    if farma_manifest.IsDone(out_segs_img, inputs):
+        print('out_segs_img exists')
+    else:
+        with farma_manifest.AtomicOutput(out_segs_img) as tmp_img:
+            segs, geotransform, wkt_str = ReadTileWindow(img_tile, segfile)
+            WriteTileImage(tmp_img, segs.astype(np.uint32), geotransform, wkt_str, gdal.GDT_UInt32)
             # Add stats
-            rsgislib.rastergis.pop_rat_img_stats(clumps=out_segs_img, add_clr_tab=True, calc_pyramids=True, ignore_zero=True)
-    except Exception as e:
-        print(e)
+            rsgislib.rastergis.pop_rat_img_stats(clumps=tmp_img, add_clr_tab=PYRAMIDS, calc_pyramids=PYRAMIDS, ignore_zero=True)
+        farma_manifest.MarkDone(out_segs_img, inputs)
 
 def ExtractObjects(tile, tile_segs_msk_dir, tile_segs_dir, tile_msk_dir, out_tiles_dir):
-    try:
-        ############
-        # STEP 4: USE MASK (STEP 2) TO MASK SEGS KEEPING ONLY RELEVANT ONES
-        # EACH OBJECT IS ITS OWN OBJECT UNLIKE ALL BEING 1 OBJECT AS IN MASK
-        ##############
-        # set output
-        out_segs_img = os.path.join(tile_segs_dir, "tile_segs_{0}.kea".format(tile))
-        out_msk_img = os.path.join(tile_msk_dir, "tile_msk_{0}.kea".format(tile))
-        out_segs_mskd_img = os.path.join(tile_segs_msk_dir, "tile_segs_mskd_{0}.kea".format(tile))
-        if os.path.isfile(out_segs_mskd_img):
-            print('out_segs_maskd_img exists')
-            pass
-        else:
-            print("Creating {}".format(out_segs_mskd_img))
+    ############
+    # STEP 4: USE MASK (STEP 2) TO MASK SEGS KEEPING ONLY RELEVANT ONES
+    # EACH OBJECT IS ITS OWN OBJECT UNLIKE ALL BEING 1 OBJECT AS IN MASK
+    ##############
+    # set output
+    out_segs_img = os.path.join(tile_segs_dir, "tile_segs_{0}.kea".format(tile))
+    out_msk_img = os.path.join(tile_msk_dir, "tile_msk_{0}.kea".format(tile))
+    out_segs_mskd_img = os.path.join(tile_segs_msk_dir, "tile_segs_mskd_{0}.kea".format(tile))
+    inputs = [out_segs_img, out_msk_img]
+    if farma_manifest.IsDone(out_segs_mskd_img, inputs):
+        print('out_segs_maskd_img exists')
+    else:
+        print("Creating {}".format(out_segs_mskd_img))
+        with farma_manifest.AtomicOutput(out_segs_mskd_img) as tmp_img:
             # Mask the objects in tile (step 3) by valid objects (mask: step 2)
-            rsgislib.imageutils.mask_img(out_segs_img, out_msk_img, out_segs_mskd_img, 'KEA', rsgislib.TYPE_32UINT, 0, 0)
+            rsgislib.imageutils.mask_img(out_segs_img, out_msk_img, tmp_img, 'KEA', rsgislib.TYPE_32UINT, 0, 0)
             # Add stats
-            rsgislib.rastergis.pop_rat_img_stats(clumps=out_segs_mskd_img, add_clr_tab=True, calc_pyramids=True, ignore_zero=True)
-    except Exception as e:
-        print(e)
+            rsgislib.rastergis.pop_rat_img_stats(clumps=tmp_img, add_clr_tab=PYRAMIDS, calc_pyramids=PYRAMIDS, ignore_zero=True)
+        farma_manifest.MarkDone(out_segs_mskd_img, inputs)
 
 
 def RelabelSegs(tile, tile_segs_msk_lbl_dir, tile_segs_msk_dir, tile_msk_dir):
-    try:
-        ############
-        # STEP 5: RELABEL RAT IN EACH ONE SO ID BEGINS AT 0
-        #############
-        out_segs_mskd_img = os.path.join(tile_segs_msk_dir, "tile_segs_mskd_{0}.kea".format(tile))
-        out_msk_img = os.path.join(tile_msk_dir, "tile_msk_{0}.kea".format(tile))
-        out_segs_mskd_lbl_img = os.path.join(tile_segs_msk_lbl_dir, "tile_segs_mskd_lbl_{0}.kea".format(tile))
-        if os.path.isfile(out_segs_mskd_lbl_img):
-            print('out_segs_mskd_lbl_img exists')
-        else:
-            print("Creating {}".format(out_segs_mskd_lbl_img))
+    ############
+    # STEP 5: RELABEL RAT IN EACH ONE SO ID BEGINS AT 0
+    #############
+    out_segs_mskd_img = os.path.join(tile_segs_msk_dir, "tile_segs_mskd_{0}.kea".format(tile))
+    out_msk_img = os.path.join(tile_msk_dir, "tile_msk_{0}.kea".format(tile))
+    out_segs_mskd_lbl_img = os.path.join(tile_segs_msk_lbl_dir, "tile_segs_mskd_lbl_{0}.kea".format(tile))
+    inputs = [out_segs_mskd_img]
+    if farma_manifest.IsDone(out_segs_mskd_lbl_img, inputs):
+        print('out_segs_mskd_lbl_img exists')
+    else:
+        print("Creating {}".format(out_segs_mskd_lbl_img))
+        with farma_manifest.AtomicOutput(out_segs_mskd_lbl_img) as tmp_img:
             # Relabel
-            rsgislib.segmentation.relabel_clumps(out_segs_mskd_img, out_segs_mskd_lbl_img, 'KEA', False)
-            rsgislib.rastergis.pop_rat_img_stats(clumps=out_segs_mskd_lbl_img, add_clr_tab=True, calc_pyramids=True, ignore_zero=True)
-    except Exception as e:
-        print(e)
+            rsgislib.segmentation.relabel_clumps(out_segs_mskd_img, tmp_img, 'KEA', False)
+            rsgislib.rastergis.pop_rat_img_stats(clumps=tmp_img, add_clr_tab=PYRAMIDS, calc_pyramids=PYRAMIDS, ignore_zero=True)
+        farma_manifest.MarkDone(out_segs_mskd_lbl_img, inputs)
         
-def VectorizeSegs(tile, tile_vec_segs_dir, tile_segs_msk_lbl_dir):
-    try:
-        ###############
-        # STEP 6: Vecotrize and add layer to GPKG
-        ###############
-        out_segs_mskd_lbl_img = os.path.join(tile_segs_msk_lbl_dir, "tile_segs_mskd_lbl_{0}.kea".format(tile))
-        out_vec = os.path.join(tile_vec_segs_dir, "tile_segs_mskd_lbl_vec{0}.gpkg".format(tile))
-        if os.path.isfile(out_vec):
-            print('out_vec exists')
-            pass
+def VectorizeSegs(tile, tile_vec_segs_dir, tile_segs_msk_lbl_dir, segfile=None, tolerance=None):
+    ###############
+    # STEP 6: Vecotrize and add layer to GPKG
+    ###############
+    out_segs_mskd_lbl_img = os.path.join(tile_segs_msk_lbl_dir, "tile_segs_mskd_lbl_{0}.kea".format(tile))
+    out_vec = os.path.join(tile_vec_segs_dir, "tile_segs_mskd_lbl_vec{0}.gpkg".format(tile))
+    inputs = [out_segs_mskd_lbl_img]
+    params = None if tolerance is None else {'simplify': float(tolerance)}
+    if farma_manifest.IsDone(out_vec, inputs, params):
+        print('out_vec exists')
+    else:
+        out_vec_segs_lyr = "tile_segs_mskd_lbl_vec{0}.gpkg".format(tile)
+        with farma_manifest.AtomicOutput(out_vec) as tmp_vec:
+            if tolerance is None:
+                rsgislib.vectorutils.createvectors.polygonise_raster_to_vec_lyr(tmp_vec, out_vec_segs_lyr, 'GPKG', out_segs_mskd_lbl_img, img_band=1, mask_img=out_segs_mskd_lbl_img, mask_band=1, replace_file=False, replace_lyr=True, pxl_val_fieldname='PXLVAL')
+            else:
+                VectorizeSimplified(out_segs_mskd_lbl_img, segfile, tmp_vec, out_vec_segs_lyr, tolerance)
+        farma_manifest.MarkDone(out_vec, inputs, params)
+
+
+def VectorizeSimplified(lbl_img, segfile, out_vec, out_lyr, tolerance):
+    # Polygonise the labels of a tile with the boundaries shared with
+    # its neighbours simplified (farma_polygonise.py). The tile must be
+    # on the pixel grid of the segmentation, whose clump IDs give the
+    # nodes of the boundaries.
+    lblDataset = gdal.Open(lbl_img)
+    lbl_gt = lblDataset.GetGeoTransform()
+    lbl = lblDataset.GetRasterBand(1).ReadAsArray()
+    wkt_str = lblDataset.GetProjection()
+    lblDataset = None
+    segDataset = farma_handles.OpenDataset(segfile)
+    geotransform = segDataset.GetGeoTransform()
+    xoff = (lbl_gt[0] - geotransform[0]) / geotransform[1]
+    yoff = (lbl_gt[3] - geotransform[3]) / geotransform[5]
+    if (abs(xoff - round(xoff)) > 1e-6) or (abs(yoff - round(yoff)) > 1e-6) or (lbl_gt[1] != geotransform[1]) or (lbl_gt[5] != geotransform[5]):
+        raise Exception("{} is not on the pixel grid of {}".format(lbl_img, segfile))
+    xoff = int(round(xoff))
+    yoff = int(round(yoff))
+    height, width = lbl.shape
+    ids = farma_polygonise.ReadPadded(segDataset, xoff, yoff, width, height)
+    segDataset = None
+
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(wkt_str)
+    vecDataset = ogr.GetDriverByName('GPKG').CreateDataSource(out_vec)
+    veclyr = vecDataset.CreateLayer(out_lyr, srs, ogr.wkbPolygon)
+    veclyr.CreateField(ogr.FieldDefn('PXLVAL', ogr.OFTInteger))
+    before, after = farma_polygonise.PolygoniseSimplified(lbl, ids, geotransform, (xoff, yoff), veclyr, tolerance)
+    vecDataset = None
+    print("{}: {} vertices simplified to {}".format(out_vec, before, after))
+
+
+def CheckMerged(tile, out_vec, fp_file, merged, merge_id, params):
+    # Stage after the fingerprint with --merged: finish the tile if it
+    # was merged since it last changed
+    if farma_vector.IsMerged(out_vec, [fp_file], merged, merge_id, params):
+        print('{} merged'.format(out_vec))
+        return farma_pipeline.TILE_DONE
+
+
+# Stage functions by name, for the tasks of the work queue
+STAGE_FUNCS = {'CreateMasks': CreateMasks, 'MaskTiles': MaskTiles, 'ExtractObjects': ExtractObjects,
+               'RelabelSegs': RelabelSegs, 'VectorizeSegs': VectorizeSegs,
+               'ExtractTileInMemory': farma_extract.ExtractTileInMemory,
+               'TileFingerprint': farma_dirty.TileFingerprint, 'CreateBaseTile': CreateBaseTile,
+               'CheckTile': farma_storage.CheckTile, 'CleanTile': farma_storage.CleanTile, 'CheckMerged': CheckMerged}
+
+
+def RunTileTask(tile, stages, log_file, run, nobjects):
+    # Run each (stage name, args) of a tile in turn: one task of the
+    # work queue, which may be run on any node
+    for name, stage_args in stages:
+        if farma_instrument.Instrumented(STAGE_FUNCS[name], name, log_file, run, 1, {tile: nobjects})(*stage_args) == farma_pipeline.TILE_DONE:
+            return
+
+
+def PadBBox(bbox, resolution):
+    # Widen a [minX, maxX, minY, maxY] bbox with no width or height
+    # (objects all on one column or row of pixels) by half a pixel
+    minX, maxX, minY, maxY = bbox
+    if minX == maxX:
+        minX -= resolution / 2.0
+        maxX += resolution / 2.0
+    if minY == maxY:
+        minY -= resolution / 2.0
+        maxY += resolution / 2.0
+    return [minX, maxX, minY, maxY]
+
+
+def CoverageReport(tiles_used, tile_counts, tile_vec_segs_dir, nobjects, merged=None):
+    # Count the objects vectorised for each tile (in the merged GPKG
+    # if given) against the RAT
+    nfound = 0
+    missing = []
+    merged_counts = None
+    if merged:
+        merged_counts = farma_vector.CountObjectsByTile(merged, os.path.basename(merged).replace('.gpkg', ''))
+    for tile in tiles_used:
+        if merged_counts is not None:
+            if int(float(tile)) not in merged_counts:
+                missing.append(tile)
+                continue
+            found = merged_counts[int(float(tile))]
         else:
-            out_vec_segs_lyr = "tile_segs_mskd_lbl_vec{0}.gpkg".format(tile)
-            rsgislib.vectorutils.createvectors.polygonise_raster_to_vec_lyr(out_vec, out_vec_segs_lyr, 'GPKG', out_segs_mskd_lbl_img, img_band=1, mask_img=out_segs_mskd_lbl_img, mask_band=1, replace_file=False, replace_lyr=True, pxl_val_fieldname='PXLVAL')
-    except Exception as e:
-        print(e)
-        
-            
-        
+            out_vec = os.path.join(tile_vec_segs_dir, "tile_segs_mskd_lbl_vec{0}.gpkg".format(tile))
+            if not os.path.isfile(out_vec):
+                missing.append(tile)
+                continue
+            found = farma_vector.CountObjects(out_vec, "tile_segs_mskd_lbl_vec{0}.gpkg".format(tile))
+        nfound += found
+        if found != tile_counts[tile]:
+            print("Tile {}: {} of {} objects vectorised".format(tile, found, tile_counts[tile]))
+    print("Coverage: {} of {} RAT objects vectorised ({:.2f}%)".format(nfound, nobjects, 100.0 * nfound / max(nobjects, 1)))
+    if missing:
+        print("{} tiles have no output: {}".format(len(missing), ', '.join(missing)))
+
+
 def main():
     print("Use 'python 2_BoundingBoxes_Docker.py -h' for help")
     parser = argparse.ArgumentParser()
@@ -158,8 +319,40 @@ def main():
     parser.add_argument("-m", "--mode", type=str, help="Specify the mode tiles mask KEA file (from script 1)")
     parser.add_argument("-r", "--resolution", type=float, help="Specify the segmentation KEA resolution")
     parser.add_argument("-c", "--cores", type=int, help="Specify the number of cores to use")
+    parser.add_argument("--inmemory", action="store_true", help="Extract and vectorize each tile in memory without writing the intermediate KEA files")
+    parser.add_argument("--merged", type=str, help="Write the objects of every tile into this single spatially indexed GPKG as tiles finish, instead of a GPKG per tile (which 3_PopulatePolys.py reads: merge its outputs with its own --merged instead). A rerun skips the tiles merged since they last changed")
+    parser.add_argument("--log", type=str, help="Specify the JSON-lines log of the time and resources used per tile and stage (default: farma_log.jsonl next to the input)")
+    parser.add_argument("--queue", type=str, help="Specify a work queue dir on a shared filesystem so workers on other nodes (started with --worker) can process the tiles. Use a new dir per run; rerunning with the same dir resumes it, retrying the failed and changed tasks")
+    parser.add_argument("--worker", action="store_true", help="Only run -c worker processes for the tiles in --queue, until every tile is done")
+    parser.add_argument("--workermem", type=int, help="Specify the memory of each worker in MB, which sets the GDAL block cache (default: a share of the available memory)")
+    parser.add_argument("--maxhandles", type=int, default=farma_handles.MAX_HANDLES, help="Specify the number of datasets each worker keeps open (default {})".format(farma_handles.MAX_HANDLES))
+    parser.add_argument("--cleanup", action="store_true", help="Remove the intermediate files of each tile once its GPKG has every object of the tile")
+    parser.add_argument("--diskbudget", type=float, help="Specify the disk budget (GB) of the intermediate files: new tiles wait while they use {:.0f}% of it (implies --cleanup)".format(100 * farma_storage.HIGH_WATER))
+    parser.add_argument("--deflate", type=int, help="Specify the deflate level (0-9) of the intermediate KEA files (default {}, or as in RSGISLIB_IMG_CRT_OPTS_KEA if set and neither --deflate nor --blocksize is given)".format(farma_storage.DEFLATE))
+    parser.add_argument("--blocksize", type=int, help="Specify the block size of the intermediate KEA files (default {}, or as in RSGISLIB_IMG_CRT_OPTS_KEA if set and neither --deflate nor --blocksize is given)".format(farma_storage.BLOCKSIZE))
+    parser.add_argument("--pyramids", action="store_true", help="Add pyramids and colour tables to the intermediate KEA files")
+    parser.add_argument("--simplify", type=float, nargs='?', const=1.0, help="Merge the collinear pixel edges of the objects and simplify the boundaries shared by neighbouring objects, which stay free of gaps, to this tolerance in pixels (default 1.0)")
+    parser.add_argument("--maxtilesize", type=float, default=50000, help="Specify the maximum tile extent in map units, bigger tiles are split into sub-tiles (default 50000). Sub-tiles are numbered after the last tile of the mode image, so their IDs are only in the lookup (tile_lut.npy) and the TILE of the outputs")
+    parser.add_argument("--maxtilepixels", type=float, help="Specify the maximum number of pixels in the window of a tile, bigger tiles are split into sub-tiles")
+    parser.add_argument("--maxtileobjects", type=int, help="Specify the maximum number of objects per tile, tiles with more are split into sub-tiles")
     args = parser.parse_args()
 
+    # Each worker keeps its datasets open and sizes the GDAL block
+    # cache from its share of the memory
+    initializer, initargs = farma_handles.WorkerInit(int(args.cores), args.workermem, args.maxhandles)
+    # Intermediates are compressed and chunked, without pyramids
+    global PYRAMIDS
+    PYRAMIDS = args.pyramids
+    print("Intermediate KEA options: {}".format(farma_storage.SetKEAOptions(args.deflate, args.blocksize)))
+    cleanup = args.cleanup or (args.diskbudget is not None)
+
+    if args.worker:
+        if args.queue == None:
+            print("SPECIFY THE WORK QUEUE DIR")
+            os._exit(1)
+        farma_queue.RunWorkers(args.queue, {'RunTileTask': RunTileTask}, int(args.cores), initializer=initializer, initargs=initargs)
+        return
+
     segs = args.input
     global ModeImage
     ModeImage = args.mode
@@ -204,98 +397,200 @@ def main():
         pass
     else:
         subprocess.call('mkdir ' + tile_vec_segs_dir, shell=True)
+    # Tile fingerprints
+    fp_dir = basedir + farma_dirty.FINGERPRINT_DIR
+    if os.path.isdir(fp_dir):
+        pass
+    else:
+        subprocess.call('mkdir ' + fp_dir, shell=True)
+    # Partial outputs of killed workers
+    nswept = farma_manifest.SweepTmp([out_tiles_dir, tile_msk_dir, tile_segs_dir, tile_segs_msk_dir, tile_segs_msk_lbl_dir, tile_vec_segs_dir, fp_dir])
+    if nswept:
+        print("Removed {} temporary files of killed workers".format(nswept))
 
 
     # get segmentation projection
     wkt_str = rsgislib.imageutils.get_wkt_proj_from_img(segs)
-    #open segmentation
-    ratDataset = gdal.Open(segs, gdal.GA_Update)
 
     # Import Columns
+    # Only the columns needed are streamed from the RAT in chunks so
+    # memory use does not grow with the number of clumps. The tile
+    # extents are folded up as each chunk is read and the lookup of
+    # clump ID to tile is written to disk, shared by all workers
     print("Importing Columns...")
+    lut_file = basedir + 'tile_lut.npy'
+    # Written beside the current lookup, which is only replaced if it
+    # has changed so the tiles made with it are not redone
+    new_lut_file = basedir + 'tile_lut.new.npy'
     try:
-        TileID = rat.readColumn(ratDataset, "tiles")
-    except:
+        tiles, counts, tileMinX, tileMaxX, tileMinY, tileMaxY, nobjects = farma_rat.StreamTileExtents(segs, new_lut_file)
+    except KeyError as e:
+        print(e)
         print('Run 1_CreateRegGrid.py first')
         os._exit(1)
-    
-    # Get extent per object
-    MinXX = rat.readColumn(ratDataset, "MinXX")
-    MinXY = rat.readColumn(ratDataset, "MinXY")
-    MaxXX = rat.readColumn(ratDataset, "MaxXX")
-    MaxXY = rat.readColumn(ratDataset, "MaxXY")
-    MinYX = rat.readColumn(ratDataset, "MinYX")
-    MinYY = rat.readColumn(ratDataset, "MinYY")
-    MaxYX = rat.readColumn(ratDataset, "MaxYX")
-    MaxYY = rat.readColumn(ratDataset, "MaxYY")
-
-
-    # Reuce tile id numbers to a unique list of ID's
-    tiles = np.unique(TileID)
 
     ###########
     # STEP 1: CREATE A BLANK IMAGE FROM THE BBOX OF EACH OBJECT THAT IS WITHIN BOUNDS OF A TILE
     ############
 
+    # Objects of the tiles too big to extract in one go (by extent,
+    # pixels of their window or objects), which are split into
+    # sub-tiles (each object in exactly one) below
+    bounds = (args.maxtilesize, args.maxtileobjects, args.maxtilepixels, args.resolution)
+    oversized = [tile for tile, count, minX, maxX, minY, maxY in zip(tiles, counts, tileMinX, tileMaxX, tileMinY, tileMaxY) if farma_rat.TileOverBounds(count, maxX-minX, maxY-minY, *bounds)]
+    split_objects = farma_rat.GatherTileObjects(segs, new_lut_file, oversized) if oversized else {}
+    tile_lut = np.load(new_lut_file, mmap_mode='r+')
+    next_tile = int(tiles.max()) + 1 if tiles.size else 1
+
     # Set up blank list to hold files we will use
     tiles_used = []
-    for tile in tiles:
-        # bin_tiles: where the TileID matches the tile number (array of true or false)
-        bin_tiles = TileID==tile
-        # Get MinXX for True values and get their minimum (np.min) X dimension
-        # Gets the overall min per tile extent
-        minX = np.min(MinXX[bin_tiles])
-        minY = np.min(MinYY[bin_tiles])
-        maxX = np.max(MaxXX[bin_tiles])
-        maxY = np.max(MaxYY[bin_tiles])
-        
-        # Set the bounding box dimensions
-        bbox = [minX, maxX, minY, maxY]
-        #print("{0}: [{1}, {2}, {3}, {4}]".format(tile, minX, maxX, minY, maxY))
-        # Check the tile is valid
-        img_check = os.path.join(out_tiles_dir, "tile_{0}.kea".format(tile))
-        if img_check == os.path.join(out_tiles_dir, "tile_1.kea"):
-            pass
-        elif (minX!=maxX) and (minY!=maxY):
-            # Set the tile name
-            img_tile = os.path.join(out_tiles_dir, "tile_{0}.kea".format(tile))
-            if os.path.isfile(img_tile):
-                    tiles_used.append(str(tile))
-            else:
-                #print("Creating {}".format(img_tile))
-                # create a blank image per tile
-                rsgislib.imageutils.create_blank_img_from_bbox(bbox, wkt_str, img_tile, args.resolution, 0, 1, 'KEA', rsgislib.TYPE_32UINT, snap_to_grid=True)
-                # HACK TO REMOVE REALLY BIG TILES: Only appends small tiles
-                # Appends the tile number only
-                if ((maxX-minX) < 50000) and ((maxY-minY) < 50000):
-                    tiles_used.append(str(tile))
-
-    # Close the Seg file
-    ratDataset = None
-    
-    
-    out_tiles_dir_lst = [out_tiles_dir for x in tiles_used]
-    tile_msk_dir_lst = [tile_msk_dir for x in tiles_used]
-    tile_segs_dir_lst = [tile_segs_dir for x in tiles_used]
-    tile_segs_msk_dir_lst = [tile_segs_msk_dir for x in tiles_used]
-    tile_segs_msk_lbl_dir_lst = [tile_segs_msk_lbl_dir for x in tiles_used]
-    tile_vec_segs_dir_lst = [tile_vec_segs_dir for x in tiles_used]
-    modetilelst = [ModeImage for x in tiles_used]
-    seglist = [segs for x in tiles_used]
-    
-    
-    for i in range(len(tiles_used)):
-        print(tiles_used[i], modetilelst[i], out_tiles_dir_lst[i], tile_msk_dir_lst[i])
-    
+    tile_bboxes = {}
+    tile_counts = {}
+    sub_tiles = set()
+    nsplit = 0
+    for tile, count, minX, maxX, minY, maxY in zip(tiles, counts, tileMinX, tileMaxX, tileMinY, tileMaxY):
+        if farma_rat.TileOverBounds(count, maxX-minX, maxY-minY, *bounds):
+            # Split really big tiles into bounded sub-tiles (each object
+            # in exactly one) which are always extracted in memory as
+            # the mode image has no sub-tile IDs. Sub-tile IDs follow
+            # the largest tile ID of the mode image, so they never
+            # clash with a tile; they are written to the lookup (and so
+            # the TILE of the outputs) only. GLOBALID is the clump ID,
+            # whatever the tile.
+            members, MinXX, MinYY, MaxXX, MaxYY = split_objects[int(tile)]
+            labels = farma_rat.SplitTile(MinXX, MinYY, MaxXX, MaxYY, *bounds)
+            tile_lut[members] = next_tile + labels
+            subs, subcounts, subMinX, subMaxX, subMinY, subMaxY = farma_rat.TileExtents(next_tile + labels, MinXX, MinYY, MaxXX, MaxYY)
+            for sub, subcount, sminX, smaxX, sminY, smaxY in zip(subs, subcounts, subMinX, subMaxX, subMinY, subMaxY):
+                tiles_used.append(str(sub))
+                tile_bboxes[str(sub)] = PadBBox([sminX, smaxX, sminY, smaxY], args.resolution)
+                tile_counts[str(sub)] = int(subcount)
+                sub_tiles.add(str(sub))
+            print("Tile {} ({} objects) split into {} sub-tiles".format(tile, count, subs.size))
+            next_tile += subs.size
+            nsplit += 1
+            continue
+
+        # Set the bounding box dimensions, padded if all the objects
+        # fall on one row or column of pixels
+        bbox = PadBBox([minX, maxX, minY, maxY], args.resolution)
+        tiles_used.append(str(tile))
+        tile_bboxes[str(tile)] = bbox
+        tile_counts[str(tile)] = int(count)
+
+    # Write out the sub-tile IDs
+    tile_lut.flush()
+    tile_lut = None
+    farma_manifest.ReplaceIfChanged(new_lut_file, lut_file)
+
+    # Drop the outputs of tiles which no longer exist
+    nremoved = farma_dirty.RemoveStaleTiles(tiles_used, [fp_dir, out_tiles_dir, tile_msk_dir, tile_segs_dir, tile_segs_msk_dir, tile_segs_msk_lbl_dir, tile_vec_segs_dir])
+    if nremoved:
+        print("Removed {} files of tiles no longer in the segmentation".format(nremoved))
 
+    print("{} objects in {} tiles ({} tiles split into {} sub-tiles)".format(nobjects, len(tiles_used), nsplit, len(sub_tiles)))
+    if sum(tile_counts.values()) != nobjects:
+        raise Exception("Only {} of {} objects were assigned to a tile".format(sum(tile_counts.values()), nobjects))
+
+    # Start the tiles with the most objects first so the slowest
+    # tiles are not left running on their own at the end
+    tiles_used.sort(key=lambda x: tile_counts[x], reverse=True)
+
+    # Every (tile, stage) is logged with its time and resources, and
+    # failures are recorded rather than the tile carrying on
     ncores = int(args.cores)
-    #p = Pool(ncores)
-    with multiprocessing.Pool(processes=ncores) as pool:
-        pool.starmap(CreateMasks, zip(tiles_used, out_tiles_dir_lst, tile_msk_dir_lst, modetilelst))
-        pool.starmap(MaskTiles, zip(tiles_used, tile_segs_dir_lst, seglist, out_tiles_dir_lst))
-        pool.starmap(ExtractObjects, zip(tiles_used, tile_segs_msk_dir_lst, tile_segs_dir_lst, tile_msk_dir_lst, out_tiles_dir_lst))
-        pool.starmap(RelabelSegs, zip(tiles_used, tile_segs_msk_lbl_dir_lst, tile_segs_msk_dir_lst, tile_msk_dir_lst))
-        pool.starmap(VectorizeSegs, zip(tiles_used, tile_vec_segs_dir_lst, tile_segs_msk_lbl_dir_lst))
+    log_file = args.log if args.log else basedir + 'farma_log.jsonl'
+    run = farma_instrument.NewRun(log_file, '2_BoundingBoxes_Docker.py', ncores)
+    def Stage(name, func, args_fn):
+        # Instrumented per tile by TileStages
+        return (name, func, args_fn)
+
+    # Each tile starts by fingerprinting its objects, and the steps
+    # reading the segmentation (or mode image) are made from the
+    # fingerprint, so only tiles whose objects changed are redone
+    fingerprint = Stage('TileFingerprint', farma_dirty.TileFingerprint, lambda tile: (tile, tile_bboxes[tile], segs, lut_file, fp_dir))
+    # Steps 2-6 in a single in-memory step per tile using the
+    # lookup of clump ID to tile shared by all workers
+    inmemory_stages = [fingerprint,
+                       Stage('ExtractTileInMemory', farma_extract.ExtractTileInMemory, lambda tile: (tile, tile_bboxes[tile], segs, lut_file, tile_vec_segs_dir, farma_dirty.FingerprintFile(fp_dir, tile), args.simplify))]
+    # With cleanup a tile whose GPKG was checked since it last changed
+    # is finished straight after its fingerprint, and the intermediates
+    # are removed once the GPKG has been checked
+    def TileFiles(tile):
+        return [os.path.join(out_tiles_dir, "tile_{0}.kea".format(tile)), os.path.join(tile_msk_dir, "tile_msk_{0}.kea".format(tile)),
+                os.path.join(tile_segs_dir, "tile_segs_{0}.kea".format(tile)), os.path.join(tile_segs_msk_dir, "tile_segs_mskd_{0}.kea".format(tile)),
+                os.path.join(tile_segs_msk_lbl_dir, "tile_segs_mskd_lbl_{0}.kea".format(tile))]
+    def TileGPKG(tile):
+        return os.path.join(tile_vec_segs_dir, "tile_segs_mskd_lbl_vec{0}.gpkg".format(tile))
+    check = [Stage('CheckTile', farma_storage.CheckTile, lambda tile: (tile, TileGPKG(tile), farma_dirty.FingerprintFile(fp_dir, tile), tile_counts[tile], args.simplify))] if cleanup else []
+    clean = [Stage('CleanTile', farma_storage.CleanTile, lambda tile: (tile, TileGPKG(tile), "tile_segs_mskd_lbl_vec{0}.gpkg".format(tile), tile_counts[tile], farma_dirty.FingerprintFile(fp_dir, tile), TileFiles(tile), args.simplify))] if cleanup else []
+    # With --merged a tile merged since it last changed is finished
+    # straight after its fingerprint, its GPKG having been removed
+    merge_params = {'simplify': args.simplify}
+    writer = farma_vector.MergedVectorWriter(args.merged, wkt_str, lut_file) if args.merged else None
+    if writer is not None:
+        merge_check = [Stage('CheckMerged', CheckMerged, lambda tile: (tile, TileGPKG(tile), farma_dirty.FingerprintFile(fp_dir, tile), args.merged, writer.merge_id, merge_params))]
+        inmemory_stages = [fingerprint] + merge_check + inmemory_stages[1:]
+    else:
+        merge_check = []
+    def MergeTile(tile):
+        # Stream a tile into the merged GPKG, its own GPKG being
+        # removed once merged
+        out_vec = TileGPKG(tile)
+        fp_file = farma_dirty.FingerprintFile(fp_dir, tile)
+        if os.path.isfile(out_vec) and not writer.IsMerged(out_vec, [fp_file], merge_params):
+            writer.Add(tile, out_vec, os.path.basename(out_vec), remove=True, inputs=[fp_file], params=merge_params)
+    kea_stages = [fingerprint] + merge_check + check + [
+                  Stage('CreateBaseTile', CreateBaseTile, lambda tile: (tile, out_tiles_dir, tile_bboxes[tile], wkt_str, args.resolution)),
+                  Stage('CreateMasks', CreateMasks, lambda tile: (tile, out_tiles_dir, tile_msk_dir, ModeImage, farma_dirty.FingerprintFile(fp_dir, tile))),
+                  Stage('MaskTiles', MaskTiles, lambda tile: (tile, tile_segs_dir, segs, out_tiles_dir, farma_dirty.FingerprintFile(fp_dir, tile))),
+                  Stage('ExtractObjects', ExtractObjects, lambda tile: (tile, tile_segs_msk_dir, tile_segs_dir, tile_msk_dir, out_tiles_dir)),
+                  Stage('RelabelSegs', RelabelSegs, lambda tile: (tile, tile_segs_msk_lbl_dir, tile_segs_msk_dir, tile_msk_dir)),
+                  Stage('VectorizeSegs', VectorizeSegs, lambda tile: (tile, tile_vec_segs_dir, tile_segs_msk_lbl_dir, segs, args.simplify))] + clean
+
+    def TileStages(tile):
+        stages = inmemory_stages if (args.inmemory or (tile in sub_tiles)) else kea_stages
+        # Each task only carries the object count of its own tile
+        return [(name, farma_instrument.Instrumented(func, name, log_file, run, 1, {tile: tile_counts[tile]}), args_fn) for name, func, args_fn in stages]
+
+    # New tiles wait while the intermediates use most of the budget
+    budget = None
+    if args.diskbudget is not None:
+        budget = farma_storage.DiskBudget(args.diskbudget * 2**30, [out_tiles_dir, tile_msk_dir, tile_segs_dir, tile_segs_msk_dir, tile_segs_msk_lbl_dir])
+    can_start = budget.CanStart if budget else None
+
+    start = time.time()
+    if args.queue:
+        # One task per tile (all its stages), run by workers on this
+        # and any other node until every tile is done
+        wq = farma_queue.WorkQueue(args.queue)
+        for order, tile in enumerate(tiles_used):
+            stages = [(name, list(args_fn(tile))) for name, func, args_fn in TileStages(tile)]
+            wq.Submit(str(tile), 'RunTileTask', [tile, stages, log_file, run, tile_counts[tile]], order)
+        farma_queue.RunWorkers(args.queue, {'RunTileTask': RunTileTask}, ncores, initializer=initializer, initargs=initargs)
+        failed = farma_queue.WaitDrained(args.queue)
+        for task_id, failure in failed.items():
+            print("Tile {} failed: {}".format(task_id, str((failure or {}).get('error')).split('\n')[0]))
+        if writer is not None:
+            for tile in tiles_used:
+                MergeTile(tile)
+            writer.Close(tiles_used)
+    # Each tile moves through steps 2-6 as soon as its own previous
+    # step has finished rather than waiting on every other tile
+    elif writer is not None:
+        # Stream each tile into the merged GPKG as soon as it is done
+        failed = farma_pipeline.RunTilePipeline(tiles_used, TileStages, ncores, on_done=MergeTile, initializer=initializer, initargs=initargs, can_start=can_start)
+        writer.Close(tiles_used)
+    else:
+        failed = farma_pipeline.RunTilePipeline(tiles_used, TileStages, ncores, initializer=initializer, initargs=initargs, can_start=can_start)
+    farma_instrument.EndRun(log_file, run, len(failed))
+    if budget is not None:
+        print("Intermediates: peak {:.2f} GB of a {:.2f} GB budget, {:.2f} GB left, tile starts held back {} times".format(budget.peak / 2.0**30, args.diskbudget, farma_storage.DirBytes(budget.dirs) / 2.0**30, budget.waits))
+    print("{} of {} tiles changed since the last run".format(len(farma_dirty.ChangedTiles(fp_dir, tiles_used, start)), len(tiles_used)))
+    print("{} tiles failed, see 'python farma_instrument.py -l {}'".format(len(failed), log_file))
+
+    # Check every object made it into the output
+    CoverageReport(tiles_used, tile_counts, tile_vec_segs_dir, nobjects, args.merged)
 
 
 if __name__ == "__main__":
@@ -35,38 +35,236 @@ import os
 from multiprocessing import Pool
 import multiprocessing
 import subprocess
+import farma_zonal
+import farma_coverage
+import farma_vector
+import farma_pipeline
+import farma_reader
+import farma_store
+import farma_instrument
+import farma_manifest
+import farma_queue
+import farma_handles
+import numpy as np
+import osgeo.gdal as gdal
+from osgeo import ogr
 
 
 
-def PopulateVectors(GPKG, rasterDir, outdir):
-    
-        rasters = glob.glob(rasterDir + '/*')
-        
-        outfile = os.path.join(outdir, GPKG.split('/')[-1])
-        if os.path.isfile(outfile):
-            print('FILE EXISTS: SKIPPING')
-        else:
-            layername = GPKG.split('/')[-1]
-            mem_ds, veclyr = rsgislib.vectorutils.read_vec_lyr_to_mem(GPKG, layername)
-
-            for img in rasters:
-                minthresh = -1
-                maxthresh = 1
-                band = 1
-                mean_name = img.split('_')[-1].split('.')[0] + '_mean'
-                min_name = img.split('_')[-1].split('.')[0] + '_min'
-                max_name = img.split('_')[-1].split('.')[0] + '_max'
-                std_name = img.split('_')[-1].split('.')[0] + '_std'
-                sum_name = img.split('_')[-1].split('.')[0] + '_sum'
-                count_name = img.split('_')[-1].split('.')[0] + '_count'
-                mode_name = img.split('_')[-1].split('.')[0] + '_mode'
-                med_name = img.split('_')[-1].split('.')[0] + '_med'
-                
-                rsgislib.zonalstats.calc_zonal_band_stats_test_poly_pts(veclyr, img, band, minthresh, maxthresh, min_field=min_name, max_field=max_name, mean_field=mean_name, stddev_field=std_name, sum_field=sum_name, count_field=count_name, mode_field=mode_name, median_field=med_name, out_no_data_val=0)
-                
-                print('Done')
-
-            rsgislib.vectorutils.write_vec_lyr_to_file(veclyr, outfile, 'LayerName', 'GPKG', options=['OVERWRITE=YES', 'SPATIAL_INDEX=YES'])
+def ImageDate(img):
+    # The date of a raster is the last '_' separated part of its name
+    return img.split('_')[-1].split('.')[0]
+
+
+def TileFromName(GPKG):
+    # The tile number at the end of a tile GPKG name (e.g. tile_segs_mskd_lbl_vec12.gpkg)
+    name = GPKG.split('/')[-1].replace('.gpkg', '')
+    digits = len(name) - len(name.rstrip('0123456789'))
+    return name[len(name) - digits:] if digits else '0'
+
+
+def DateFields(img):
+    # Names of the statistics columns of a raster
+    date = ImageDate(img)
+    return [date + suffix for suffix in farma_vector.STAT_SUFFIXES]
+
+
+def RastersToPopulate(GPKG, rasters, outdir, append=False):
+    # Returns the rasters still to be populated into the GPKG and
+    # whether they are to be appended to an existing output. An output
+    # is only complete if it is in the manifest and was made from the
+    # GPKG and rasters as they are now.
+    outfile = os.path.join(outdir, GPKG.split('/')[-1])
+    if farma_manifest.IsDone(outfile, [GPKG] + rasters):
+        print('FILE EXISTS: SKIPPING')
+        return [], False
+    record = farma_manifest.Record(outfile)
+    if (not append) or (record is None) or (record['inputs'].get(os.path.abspath(GPKG)) != farma_manifest.Fingerprint(GPKG)):
+        # Missing, incomplete or stale: populate from scratch
+        return rasters, False
+    # Only compute the dates which are not already in the output or
+    # whose raster has changed
+    existing = farma_vector.ExistingDates(outfile, 'LayerName')
+    rasters = [img for img in rasters if (ImageDate(img) not in existing) or (record['inputs'].get(os.path.abspath(img)) != farma_manifest.Fingerprint(img))]
+    if len(rasters) == 0:
+        print('NO NEW RASTERS: SKIPPING')
+    else:
+        print('APPENDING {} NEW RASTERS TO {}'.format(len(rasters), outfile))
+    return rasters, True
+
+
+def RemoveStaleOutputs(GPKGDir, GPKGfiles, outdir):
+    # Remove the outputs made from GPKGs in GPKGDir which no longer
+    # exist (tiles dropped by 2_BoundingBoxes_Docker.py when the
+    # segmentation changed). Outputs of GPKGs which were not rewritten
+    # are up to date and left untouched.
+    current = set(os.path.abspath(GPKG) for GPKG in GPKGfiles)
+    GPKGDir = os.path.abspath(GPKGDir)
+    nremoved = 0
+    for name, record in farma_manifest.LoadManifest(os.path.join(outdir, farma_manifest.MANIFEST)).items():
+        sources = [i for i in record['inputs'] if i.endswith('.gpkg') and os.path.dirname(i) == GPKGDir]
+        outfile = os.path.join(outdir, name)
+        if sources and not any(i in current for i in sources) and os.path.isfile(outfile):
+            farma_manifest.RemoveFile(outfile)
+            nremoved += 1
+    return nremoved
+
+
+def CalcImageStats(veclyr, GPKG, img, zonal='points', indexdir=None, fractional=False, reader=None, sketch_bins=None):
+    # Populate the statistics of one raster into the layer. The raster
+    # and index engines read the raster through the reader if given,
+    # and estimate median and mode from sketch_bins bins if given.
+    minthresh = -1
+    maxthresh = 1
+    band = 1
+    mean_name, min_name, max_name, std_name, sum_name, count_name, mode_name, med_name = DateFields(img)
+
+    if zonal == 'index':
+        # Gather and reduce using the object to pixel index for the raster grid (built once per grid)
+        farma_coverage.CalcZonalBandStatsIndexed(veclyr, GPKG, img, band, minthresh, maxthresh, indexdir, fractional, min_field=min_name, max_field=max_name, mean_field=mean_name, stddev_field=std_name, sum_field=sum_name, count_field=count_name, mode_field=mode_name, median_field=med_name, out_no_data_val=0, reader=reader, sketch_bins=sketch_bins)
+    elif zonal == 'raster':
+        # Rasterize the polygons once and reduce all objects together
+        farma_zonal.CalcZonalBandStats(veclyr, img, band, minthresh, maxthresh, min_field=min_name, max_field=max_name, mean_field=mean_name, stddev_field=std_name, sum_field=sum_name, count_field=count_name, mode_field=mode_name, median_field=med_name, out_no_data_val=0, reader=reader, sketch_bins=sketch_bins)
+    else:
+        rsgislib.zonalstats.calc_zonal_band_stats_test_poly_pts(veclyr, img, band, minthresh, maxthresh, min_field=min_name, max_field=max_name, mean_field=mean_name, stddev_field=std_name, sum_field=sum_name, count_field=count_name, mode_field=mode_name, median_field=med_name, out_no_data_val=0)
+
+    print('Done')
+
+
+def WriteOutput(veclyr, outfile, new_fields, appending, inputs=()):
+    # A new output is written to a temporary file which replaces the
+    # output when complete, then recorded in the manifest with its
+    # inputs. New columns are appended to the existing output in place
+    # (in one transaction, matching the features by FID): once changed,
+    # the output no longer matches its manifest record until it is
+    # recorded again, so an append cut short is redone from scratch on
+    # a rerun.
+    if appending:
+        farma_vector.AppendColumns(outfile, 'LayerName', veclyr, new_fields)
+    else:
+        with farma_manifest.AtomicOutput(outfile) as tmpfile:
+            rsgislib.vectorutils.write_vec_lyr_to_file(veclyr, tmpfile, 'LayerName', 'GPKG', options=['OVERWRITE=YES', 'SPATIAL_INDEX=YES'])
+    farma_manifest.MarkDone(outfile, inputs)
+
+
+def PopulateVectors(GPKG, rasterDir, outdir, zonal='points', indexdir=None, fractional=False, append=False, cache_mb=512, sketch_bins=None):
+    # Populate every raster into one GPKG in turn
+    all_rasters = glob.glob(rasterDir + '/*')
+    rasters, appending = RastersToPopulate(GPKG, all_rasters, outdir, append)
+    if len(rasters) == 0:
+        return
+
+    layername = GPKG.split('/')[-1]
+    mem_ds, veclyr = rsgislib.vectorutils.read_vec_lyr_to_mem(GPKG, layername)
+
+    reader = None
+    # The sketch reads strips of the window, not the whole window
+    prefetch = (zonal != 'points') and not sketch_bins
+    if zonal != 'points':
+        reader = farma_reader.GetReader(cache_mb)
+        extent = veclyr.GetExtent()
+    if prefetch:
+        reader.Prefetch(rasters[0], 1, extent)
+
+    new_fields = []
+    for i, img in enumerate(rasters):
+        # Read the next raster's window while this one is reduced
+        if prefetch and (i + 1 < len(rasters)):
+            reader.Prefetch(rasters[i + 1], 1, extent)
+        CalcImageStats(veclyr, GPKG, img, zonal, indexdir, fractional, reader, sketch_bins)
+        new_fields += DateFields(img)
+
+    WriteOutput(veclyr, os.path.join(outdir, layername), new_fields, appending, [GPKG] + all_rasters)
+
+
+def RunGPKGTask(log_file, run, *args):
+    # PopulateVectors for one GPKG: one task of the work queue, which
+    # may be run on any node
+    farma_instrument.Instrumented(PopulateVectors, 'PopulateVectors', log_file, run)(*args)
+
+
+def UnitFile(GPKG, img, unitdir):
+    return os.path.join(unitdir, '{}_{}.npy'.format(GPKG.split('/')[-1].replace('.gpkg', ''), ImageDate(img)))
+
+
+def UnitValues(GPKG, img, zonal='points', indexdir=None, fractional=False, cache_mb=512, sketch_bins=None):
+    # Populate one raster into one GPKG and return the columns as an
+    # array (features x statistics, in feature order)
+    layername = GPKG.split('/')[-1]
+    mem_ds, veclyr = rsgislib.vectorutils.read_vec_lyr_to_mem(GPKG, layername)
+    reader = None
+    if zonal != 'points':
+        # Blocks are cached for later units overlapping the same raster blocks
+        reader = farma_reader.GetReader(cache_mb)
+    CalcImageStats(veclyr, GPKG, img, zonal, indexdir, fractional, reader, sketch_bins)
+    fields = DateFields(img)
+    veclyr.ResetReading()
+    return np.array([[feat.GetField(fld) for fld in fields] for feat in veclyr], dtype=np.float64).reshape(-1, len(fields))
+
+
+def UnitParams(zonal, fractional, sketch_bins=None):
+    return {'zonal': zonal, 'fractional': fractional, 'sketch_bins': sketch_bins}
+
+
+def PopulateUnit(GPKG, img, unitdir, zonal='points', indexdir=None, fractional=False, cache_mb=512, sketch_bins=None):
+    # Populate one raster into one GPKG and save the columns for MergeUnits
+    unitfile = UnitFile(GPKG, img, unitdir)
+    values = UnitValues(GPKG, img, zonal, indexdir, fractional, cache_mb, sketch_bins)
+    with farma_manifest.AtomicOutput(unitfile) as tmpfile:
+        np.save(tmpfile, values)
+    farma_manifest.MarkDone(unitfile, [GPKG, img], UnitParams(zonal, fractional, sketch_bins))
+
+
+def PopulateStoreUnit(GPKG, img, store_dir, zonal='points', indexdir=None, fractional=False, cache_mb=512, sketch_bins=None):
+    # Populate one raster into one GPKG and write the columns to the
+    # GPKG's rows of the time-series store
+    farma_store.WriteBlock(store_dir, GPKG, ImageDate(img), UnitValues(GPKG, img, zonal, indexdir, fractional, cache_mb, sketch_bins))
+
+
+def PrepareStore(store_dir, GPKGfiles, lut_file=None):
+    # Create the time-series store for the GPKGs, keyed by clump ID if
+    # the clump -> tile lookup is given, or rebuild the rows of the
+    # GPKGs whose objects changed
+    tile_clumps = None
+    if lut_file:
+        tile_clumps = farma_vector.TileClumps(lut_file)
+    gpkg_keys = [(GPKG.split('/')[-1], farma_vector.ObjectKeys(GPKG, GPKG.split('/')[-1], TileFromName(GPKG), tile_clumps)) for GPKG in GPKGfiles]
+    sources = {GPKG.split('/')[-1]: farma_manifest.Fingerprint(GPKG) for GPKG in GPKGfiles}
+    return farma_store.CreateStore(store_dir, gpkg_keys, sources=sources)
+
+
+def MergeUnits(GPKG, rasters, unitdir, outdir, appending=False, inputs=()):
+    # Combine the per raster columns of a GPKG into its output, made
+    # from the inputs (the GPKG and all the rasters)
+    layername = GPKG.split('/')[-1]
+    mem_ds, veclyr = rsgislib.vectorutils.read_vec_lyr_to_mem(GPKG, layername)
+    new_fields = []
+    for img in rasters:
+        fields = DateFields(img)
+        values = np.load(UnitFile(GPKG, img, unitdir))
+        for fld in fields:
+            veclyr.CreateField(ogr.FieldDefn(fld, ogr.OFTReal))
+        veclyr.ResetReading()
+        veclyr.StartTransaction()
+        for feat, row in zip(veclyr, values):
+            for fld, val in zip(fields, row):
+                feat.SetField(fld, float(val))
+            veclyr.SetFeature(feat)
+        veclyr.CommitTransaction()
+        new_fields += fields
+    WriteOutput(veclyr, os.path.join(outdir, layername), new_fields, appending, inputs)
+    for img in rasters:
+        os.remove(UnitFile(GPKG, img, unitdir))
+    print('Merged {}'.format(layername))
+
+
+def UnitCost(nfeatures, window):
+    # Relative cost of populating one raster into one GPKG: the pixels
+    # of the raster window read and reduced plus a per feature cost
+    # (about the same as 100 pixels) for testing and writing features
+    if window is None:
+        return nfeatures * 100
+    return nfeatures * 100 + window[2] * window[3]
 
 
 def main():
@@ -76,14 +274,47 @@ def main():
     parser.add_argument("-r", "--rasters", type=str, help="Specify the dir to the rasters to populate into the objects")
     parser.add_argument("-o", "--outdir", type=str, help="Specify the output dir for the populated vectors")
     parser.add_argument("-c", "--cores", type=str, help="Specify the output dir for the populated vectors")
+    parser.add_argument("-z", "--zonal", type=str, default="points", choices=["points", "raster", "index"], help="Specify the zonal stats engine: points (rsgislib point in polygon tests), raster (rasterize the polygons once) or index (raster, reusing a saved object to pixel index per raster grid)")
+    parser.add_argument("--indexdir", type=str, help="Specify the dir for the coverage indexes (default: <outdir>/coverage_index)")
+    parser.add_argument("-a", "--append", action="store_true", help="Add columns for new rasters to existing outputs rather than skipping them")
+    parser.add_argument("--fractional", action="store_true", help="Weight pixels by the fraction covered by each object (index engine only)")
+    parser.add_argument("--store", type=str, help="Write the statistics to this columnar time-series store (objects x dates x statistics) instead of the output GPKGs")
+    parser.add_argument("--merged", type=str, help="Write the populated objects into this single spatially indexed GPKG as they finish, instead of a GPKG per tile in the output dir. A rerun skips the GPKGs merged since they or the rasters last changed")
+    parser.add_argument("--lut", type=str, help="Specify the clump ID to tile lookup (tile_lut.npy from script 2) to add GLOBALID to the merged GPKG (default with --merged: tile_lut.npy next to the segmentation dir, if it exists)")
+    parser.add_argument("--schedule", type=str, default="gpkg", choices=["gpkg", "units"], help="Specify how work is split: gpkg (default, one task per GPKG, prefetching the next raster) or units (one task per GPKG and raster, balancing a few large GPKGs over many cores)")
+    parser.add_argument("--log", type=str, help="Specify the JSON-lines log of the time and resources used per GPKG and raster (default: <outdir>/farma_log.jsonl)")
+    parser.add_argument("--queue", type=str, help="Specify a work queue dir on a shared filesystem so workers on other nodes (started with --worker) can populate the GPKGs (one task per GPKG). Use a new dir per run; rerunning with the same dir resumes it, retrying the failed and changed tasks")
+    parser.add_argument("--worker", action="store_true", help="Only run -c worker processes for the GPKGs in --queue, until every GPKG is done")
+    parser.add_argument("--workermem", type=int, help="Specify the memory of each worker in MB, which less --cachemb sets the GDAL block cache (default: a share of the available memory)")
+    parser.add_argument("--maxhandles", type=int, default=farma_handles.MAX_HANDLES, help="Specify the number of datasets each worker keeps open (default {})".format(farma_handles.MAX_HANDLES))
+    parser.add_argument("--sketch", type=int, nargs='?', const=farma_zonal.SKETCH_BINS, help="Estimate median and mode in one pass over strips of the raster, keeping a histogram of at most this many bins per object rather than every pixel (default {}; raster and index engines). Objects with at most bins distinct values are exact, otherwise the median is within 2 * (max - min) / (bins - 2) of the exact value".format(farma_zonal.SKETCH_BINS))
+    parser.add_argument("--cachemb", type=int, default=512, help="Specify the raster block cache size per worker in MB (raster and index engines)")
     args = parser.parse_args()
 
+    # Each worker keeps its rasters open and sizes the GDAL block cache
+    # from its share of the memory, less the window reader's cache
+    workermem = args.workermem if args.workermem else farma_handles.WorkerMemoryMB(int(args.cores))
+    initializer, initargs = farma_handles.WorkerInit(int(args.cores), max(workermem - args.cachemb, farma_handles.MIN_CACHE_MB), args.maxhandles)
+
+    if args.worker:
+        if args.queue == None:
+            print("SPECIFY THE WORK QUEUE DIR")
+            os._exit(1)
+        farma_queue.RunWorkers(args.queue, {'RunGPKGTask': RunGPKGTask}, int(args.cores), initializer=initializer, initargs=initargs)
+        return
+
     if str(args.segments) == None:
         print("INPUT VECTOR SEGMENTATION DIR MISSING")
         os._exit(1)
     elif args.rasters == None:
         print("SPECIFY THE DIR TO THE RASTERS")
         os._exit(1)
+    elif args.merged and args.append:
+        print("--append NEEDS THE OUTPUT GPKGs, WHICH --merged DOES NOT KEEP")
+        os._exit(1)
+    elif args.sketch and args.zonal == 'points':
+        print("--sketch NEEDS THE raster OR index ZONAL ENGINE")
+        os._exit(1)
     else:
         print(args.segments)
 
@@ -92,19 +323,157 @@ def main():
     print(GPKGfiles)
 
     rastersDir = args.rasters
+    rasters = glob.glob(rastersDir + '/*')
 
-    rasterDirectory = [rastersDir for x in GPKGfiles]
-    outputdirectory = [args.outdir for x in GPKGfiles]
-    
     if os.path.isdir(args.outdir):
         print("OUPUT DIR EXISTS")
     else:
         subprocess.call('mkdir ' + args.outdir, shell=True)
-    
+    # Partial outputs of killed workers
+    nswept = farma_manifest.SweepTmp([args.outdir, os.path.join(args.outdir, 'units')])
+    if nswept:
+        print("Removed {} temporary files of killed workers".format(nswept))
+    if not args.store:
+        nremoved = RemoveStaleOutputs(GPKGDir, GPKGfiles, args.outdir)
+        if nremoved:
+            print("Removed {} outputs of GPKGs no longer in {}".format(nremoved, GPKGDir))
+
+    indexdir = args.indexdir
+    if indexdir == None:
+        indexdir = os.path.join(args.outdir, 'coverage_index')
+    if args.zonal == 'index' and not os.path.isdir(indexdir):
+        os.makedirs(indexdir)
+    writer = None
+    todoGPKGs = GPKGfiles
+    merge_params = UnitParams(args.zonal, args.fractional, args.sketch)
+    if args.merged and GPKGfiles and not args.store:
+        # Script 2 writes its lookup next to the segmentation dir
+        lut_file = args.lut
+        default_lut = os.path.join(os.path.dirname(os.path.abspath(GPKGDir.rstrip('/'))), 'tile_lut.npy')
+        if (lut_file is None) and os.path.isfile(default_lut):
+            lut_file = default_lut
+        if lut_file is None:
+            print("NO TILE LOOKUP (--lut): THE MERGED GPKG GETS NO GLOBALID")
+        vecDataset = ogr.Open(GPKGfiles[0])
+        wkt_str = vecDataset.GetLayer(0).GetSpatialRef().ExportToWkt()
+        vecDataset = None
+        writer = farma_vector.MergedVectorWriter(args.merged, wkt_str, lut_file)
+        # GPKGs merged since they or the rasters last changed are
+        # not repopulated
+        todoGPKGs = [GPKG for GPKG in GPKGfiles if not writer.IsMerged(os.path.join(args.outdir, GPKG.split('/')[-1]), [GPKG] + rasters, merge_params)]
+        print("{} of {} GPKGs already merged".format(len(GPKGfiles) - len(todoGPKGs), len(GPKGfiles)))
+
+    def MergeOutput(GPKG):
+        # Stream a finished output into the merged GPKG, which
+        # replaces it
+        outfile = os.path.join(args.outdir, GPKG.split('/')[-1])
+        if (writer is not None) and os.path.isfile(outfile) and not writer.IsMerged(outfile, [GPKG] + rasters, merge_params):
+            writer.Add(TileFromName(GPKG), outfile, 'LayerName', remove=True, inputs=[GPKG] + rasters, params=merge_params)
 
     ncores = int(args.cores)
-    with multiprocessing.Pool(processes=ncores) as pool:
-        pool.starmap(PopulateVectors, zip(GPKGfiles, rasterDirectory, outputdirectory))
+    # Every (GPKG, raster) unit and merge is logged with its time and resources
+    log_file = args.log if args.log else os.path.join(args.outdir, 'farma_log.jsonl')
+    run = farma_instrument.NewRun(log_file, '3_PopulatePolys.py', ncores)
+
+    if args.store:
+        # One unit per GPKG and date not yet written for it (new dates,
+        # and every date of the GPKGs which changed), each date being
+        # marked complete in the store once all of its units have been
+        # written
+        PrepareStore(args.store, GPKGfiles, args.lut)
+        complete = farma_store.CompleteDates(args.store)
+        rasters = [img for img in rasters if ImageDate(img) not in complete]
+        farma_store.AddDates(args.store, [ImageDate(img) for img in rasters])
+        pending = farma_store.PendingDates(args.store, [ImageDate(img) for img in rasters])
+        units = []
+        for GPKG in GPKGfiles:
+            todo = [img for img in rasters if ImageDate(img) in pending[GPKG.split('/')[-1]]]
+            if len(todo) == 0:
+                continue
+            vecDataset = ogr.Open(GPKG)
+            nfeatures = vecDataset.GetLayerByName(GPKG.split('/')[-1]).GetFeatureCount()
+            vecDataset = None
+            # Each task only carries the object count of its own GPKG
+            unit_func = farma_instrument.Instrumented(PopulateStoreUnit, 'PopulateStoreUnit', log_file, run, 2, {GPKG: nfeatures})
+            for img in todo:
+                units.append((ImageDate(img), UnitCost(nfeatures, None), (GPKG, img, args.store, args.zonal, indexdir, args.fractional, args.cachemb, args.sketch), unit_func))
+        print("{} units for {} incomplete dates".format(len(units), len(rasters)))
+        failed = farma_pipeline.RunUnitsWithMerge(units, None, farma_instrument.Instrumented(farma_store.MarkComplete, 'MarkComplete', log_file, run, 2), {ImageDate(img): (args.store, ImageDate(img)) for img in rasters}, ncores, initializer=initializer, initargs=initargs)
+        farma_instrument.EndRun(log_file, run, len(failed))
+        return
+
+    if args.queue:
+        # One task per GPKG, run by workers on this and any other node
+        wq = farma_queue.WorkQueue(args.queue)
+        for order, GPKG in enumerate(sorted(todoGPKGs)):
+            wq.Submit(GPKG.split('/')[-1].replace('.gpkg', ''), 'RunGPKGTask', [log_file, run, GPKG, rastersDir, args.outdir, args.zonal, indexdir, args.fractional, args.append, args.cachemb, args.sketch], order)
+        farma_queue.RunWorkers(args.queue, {'RunGPKGTask': RunGPKGTask}, ncores, initializer=initializer, initargs=initargs)
+        failed = farma_queue.WaitDrained(args.queue)
+        for task_id, failure in failed.items():
+            print("{} failed: {}".format(task_id, str((failure or {}).get('error')).split('\n')[0]))
+        for GPKG in todoGPKGs:
+            MergeOutput(GPKG)
+        if writer is not None:
+            writer.Close([TileFromName(GPKG) for GPKG in GPKGfiles])
+        farma_instrument.EndRun(log_file, run, len(failed))
+        return
+
+    if args.schedule == 'gpkg':
+        with multiprocessing.Pool(processes=ncores, initializer=initializer, initargs=initargs) as pool:
+            pool.starmap(farma_instrument.Instrumented(PopulateVectors, 'PopulateVectors', log_file, run), [(GPKG, rastersDir, args.outdir, args.zonal, indexdir, args.fractional, args.append, args.cachemb, args.sketch) for GPKG in todoGPKGs])
+        for GPKG in todoGPKGs:
+            MergeOutput(GPKG)
+        if writer is not None:
+            writer.Close([TileFromName(GPKG) for GPKG in GPKGfiles])
+        farma_instrument.EndRun(log_file, run)
+        return
+
+    unitdir = os.path.join(args.outdir, 'units')
+    if not os.path.isdir(unitdir):
+        os.makedirs(unitdir)
+
+    # Grid of each raster for the cost estimates
+    grids = {}
+    for img in rasters:
+        imgDataset = gdal.Open(img, gdal.GA_ReadOnly)
+        grids[img] = (imgDataset.GetGeoTransform(), imgDataset.RasterXSize, imgDataset.RasterYSize)
+        imgDataset = None
+
+    # Split the work into (GPKG, raster) units, each GPKG's columns
+    # being merged into its output once all of its units are done
+    units = []
+    merges = {}
+    merge_funcs = {}
+    for GPKG in todoGPKGs:
+        todo, appending = RastersToPopulate(GPKG, rasters, args.outdir, args.append)
+        if len(todo) == 0:
+            continue
+        vecDataset = ogr.Open(GPKG)
+        veclyr = vecDataset.GetLayerByName(GPKG.split('/')[-1])
+        nfeatures = veclyr.GetFeatureCount()
+        extent = veclyr.GetExtent()
+        vecDataset = None
+        # Each task only carries the object count of its own GPKG
+        unit_func = farma_instrument.Instrumented(PopulateUnit, 'PopulateUnit', log_file, run, 2, {GPKG: nfeatures})
+        merge_funcs[GPKG] = farma_instrument.Instrumented(MergeUnits, 'MergeUnits', log_file, run, 1, {GPKG: nfeatures})
+        for img in todo:
+            # Units saved by an earlier run which did not get as far
+            # as the merge are not redone
+            if farma_manifest.IsDone(UnitFile(GPKG, img, unitdir), [GPKG, img], UnitParams(args.zonal, args.fractional, args.sketch)):
+                continue
+            window = farma_zonal.ExtentWindow(extent, *grids[img])
+            units.append((GPKG, UnitCost(nfeatures, window), (GPKG, img, unitdir, args.zonal, indexdir, args.fractional, args.cachemb, args.sketch), unit_func))
+        merges[GPKG] = (GPKG, todo, unitdir, args.outdir, appending, [GPKG] + rasters)
+    print("{} units over {} GPKGs".format(len(units), len(merges)))
+
+    failed = farma_pipeline.RunUnitsWithMerge(units, None, None, merges, ncores, on_done=MergeOutput, initializer=initializer, initargs=initargs, merge_funcs=merge_funcs)
+    farma_instrument.EndRun(log_file, run, len(failed))
+    if writer is not None:
+        # Outputs with nothing new to populate are merged as they are
+        for GPKG in todoGPKGs:
+            if GPKG not in merges:
+                MergeOutput(GPKG)
+        writer.Close([TileFromName(GPKG) for GPKG in GPKGfiles])
     
 
 if __name__ == "__main__":
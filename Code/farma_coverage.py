@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# A persistent object to pixel coverage index for 3_PopulatePolys.py.
+# The pixels covered by each object of a GPKG are found once per
+# raster grid and saved as a CSR style map (object -> pixel offsets
+# within the window of the raster covering the GPKG, with optional
+# fractional area weights). The index is memory mapped from disk and
+# keyed on the grid geotransform, size and CRS, so every date sharing
+# a grid is populated with a gather and reduce over the raster window.
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import farma_zonal
+
+
+def GridKey(GPKG, geotransform, wkt_str, xsize, ysize, fractional=False):
+    # Key of the index for a GPKG on a raster grid. The GPKG size and
+    # modification time (in ns, as farma_manifest.Fingerprint, so a
+    # GPKG rewritten within the same second is not missed) are
+    # included so the index is rebuilt if the objects change.
+    stat = os.stat(GPKG)
+    key = json.dumps([os.path.basename(GPKG), stat.st_size, stat.st_mtime_ns, [float(x) for x in geotransform], wkt_str, xsize, ysize, bool(fractional)])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def BuildCoverageIndex(veclyr, geotransform, wkt_str, xsize, ysize, fractional=False, supersample=4):
+    # Returns the index as a dict of arrays, or None if the layer does
+    # not overlap the grid
+    window = farma_zonal.LayerWindow(veclyr, geotransform, xsize, ysize)
+    if window is None:
+        return None
+    xoff, yoff, width, height = window
+    fids = farma_zonal.NumberZones(veclyr)
+    nzones = len(fids)
+
+    if fractional:
+        # Rasterize at a finer resolution and count the sub-pixels of
+        # each object in every pixel to get the fraction it covers
+        fine = (geotransform[0], geotransform[1] / supersample, 0, geotransform[3], 0, geotransform[5] / supersample)
+        zones = farma_zonal.RasterizeZones(veclyr, fine, wkt_str, (xoff * supersample, yoff * supersample, width * supersample, height * supersample))
+        rows, cols = np.nonzero(zones)
+        pixel = (rows // supersample).astype(np.int64) * width + (cols // supersample)
+        pairs, subcount = np.unique(zones[rows, cols].astype(np.int64) * (width * height) + pixel, return_counts=True)
+        zone = pairs // (width * height)
+        pixels = pairs % (width * height)
+        weights = (subcount / float(supersample * supersample)).astype(np.float32)
+    else:
+        zones = farma_zonal.RasterizeZones(veclyr, geotransform, wkt_str, window).ravel()
+        pixels = np.flatnonzero(zones)
+        zone = zones[pixels].astype(np.int64)
+        order = np.argsort(zone, kind='stable')
+        pixels = pixels[order]
+        zone = zone[order]
+        weights = None
+    farma_zonal.RemoveZones(veclyr)
+
+    indptr = np.zeros(nzones + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(zone, minlength=nzones + 1)[1:])
+    index = {'window': list(window), 'fids': np.array(fids, dtype=np.int64), 'indptr': indptr, 'pixels': pixels.astype(np.int64), 'weights': weights}
+    return index
+
+
+def SaveCoverageIndex(index, index_path):
+    # Write to a temporary directory and rename so an interrupted
+    # write is never picked up as a complete index
+    tmp_path = index_path + '.tmp{}'.format(os.getpid())
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name in ['fids', 'indptr', 'pixels', 'weights']:
+        if index[name] is not None:
+            np.save(os.path.join(tmp_path, name + '.npy'), index[name])
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'window': index['window']}, f)
+    try:
+        os.rename(tmp_path, index_path)
+    except OSError:
+        # Another worker finished the same index first
+        if not os.path.isdir(index_path):
+            raise
+        shutil.rmtree(tmp_path)
+
+
+def LoadCoverageIndex(index_path):
+    with open(os.path.join(index_path, 'meta.json')) as f:
+        meta = json.load(f)
+    index = {'window': meta['window']}
+    for name in ['fids', 'indptr', 'pixels', 'weights']:
+        npy = os.path.join(index_path, name + '.npy')
+        index[name] = np.load(npy, mmap_mode='r') if os.path.isfile(npy) else None
+    return index
+
+
+def GetCoverageIndex(veclyr, GPKG, grid, indexdir, fractional=False):
+    # Load the index of the GPKG for the raster grid (geotransform,
+    # wkt_str, xsize, ysize), building and saving it first if it does
+    # not exist
+    geotransform, wkt_str, xsize, ysize = grid[:4]
+    key = GridKey(GPKG, geotransform, wkt_str, xsize, ysize, fractional)
+    index_path = os.path.join(indexdir, '{}_{}'.format(os.path.basename(GPKG).replace('.gpkg', ''), key))
+    if os.path.isdir(index_path):
+        return LoadCoverageIndex(index_path)
+    index = BuildCoverageIndex(veclyr, geotransform, wkt_str, xsize, ysize, fractional)
+    if index is None:
+        return None
+    SaveCoverageIndex(index, index_path)
+    return LoadCoverageIndex(index_path)
+
+
+def CoverageStats(index, values, minthresh, maxthresh, no_data_val=None, out_no_data_val=0):
+    # Gather the pixels of every object from the raster window and
+    # reduce them to the zonal statistics
+    pixels = np.asarray(index['pixels'])
+    indptr = np.asarray(index['indptr'])
+    nzones = indptr.size - 1
+    vals = np.asarray(values).ravel()[pixels]
+    zone = np.repeat(np.arange(1, nzones + 1), np.diff(indptr))
+    zone = farma_zonal.ValidPixels(zone, vals, minthresh, maxthresh, no_data_val)
+    weights = None if index['weights'] is None else np.asarray(index['weights'])
+    return farma_zonal.ZonalStatsArrays(zone, vals, nzones, out_no_data_val, weights)
+
+
+def CoverageSketchStats(index, input_img, img_band, minthresh, maxthresh, no_data_val=None, out_no_data_val=0, bins=farma_zonal.SKETCH_BINS, reader=None):
+    # As CoverageStats with the median and mode sketched
+    # (farma_zonal.ZoneSketch), gathering the objects a chunk of about
+    # SKETCH_STRIP_PX pixels at a time from the rows of the window the
+    # chunk covers. Objects are numbered in layer order, which for the
+    # GPKGs of 2_BoundingBoxes_Docker.py is scan order, so a chunk
+    # covers a band of rows rather than the whole window.
+    pixels = index['pixels']
+    indptr = np.asarray(index['indptr'])
+    nzones = indptr.size - 1
+    xoff, yoff, width, height = index['window']
+    sketch = farma_zonal.ZoneSketch(nzones, bins, index['weights'] is not None)
+    start = 0
+    while start < nzones:
+        end = int(np.searchsorted(indptr, indptr[start] + farma_zonal.SKETCH_STRIP_PX, side='right')) - 1
+        end = min(max(end, start + 1), nzones)
+        px = np.asarray(pixels[indptr[start]:indptr[end]])
+        if px.size:
+            row0 = int(px.min()) // width
+            row1 = int(px.max()) // width + 1
+            band = farma_zonal.ReadWindow(input_img, img_band, (xoff, yoff + row0, width, row1 - row0), reader)
+            vals = band.ravel()[px - row0 * width]
+            zone = np.repeat(np.arange(start + 1, end + 1), np.diff(indptr[start:end + 1]))
+            zone = farma_zonal.ValidPixels(zone, vals, minthresh, maxthresh, no_data_val)
+            weights = None if index['weights'] is None else np.asarray(index['weights'][indptr[start]:indptr[end]])
+            sketch.Add(zone, vals, weights)
+        start = end
+    return sketch.Stats(out_no_data_val)
+
+
+def CalcZonalBandStatsIndexed(veclyr, GPKG, input_img, img_band, minthresh, maxthresh, indexdir, fractional=False, out_no_data_val=0, min_field=None, max_field=None, mean_field=None, stddev_field=None, sum_field=None, count_field=None, mode_field=None, median_field=None, reader=None, sketch_bins=None):
+    # As farma_zonal.CalcZonalBandStats but using (and if needed
+    # building) the coverage index of the GPKG for the image grid
+    grid = farma_zonal.RasterGrid(input_img, img_band, reader)
+    index = GetCoverageIndex(veclyr, GPKG, grid, indexdir, fractional)
+    fields = {'min': min_field, 'max': max_field, 'mean': mean_field, 'std': stddev_field, 'sum': sum_field, 'count': count_field, 'mode': mode_field, 'median': median_field}
+    if index is None:
+        # No overlap with the raster: every object gets no data
+        fids = [feat.GetFID() for feat in veclyr]
+        veclyr.ResetReading()
+        stats = farma_zonal.ZonalStatsArrays(np.zeros(1, dtype=np.int64), np.zeros(1), len(fids), out_no_data_val)
+    else:
+        if sketch_bins:
+            stats = CoverageSketchStats(index, input_img, img_band, minthresh, maxthresh, grid[4], out_no_data_val, sketch_bins, reader)
+        else:
+            values = farma_zonal.ReadWindow(input_img, img_band, index['window'], reader)
+            stats = CoverageStats(index, values, minthresh, maxthresh, grid[4], out_no_data_val)
+        fids = [int(x) for x in index['fids']]
+    farma_zonal.WriteZonalStats(veclyr, fids, stats, fields)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Change tracking per tile for the FARMA workflow. When part of the
+# segmentation is redone (e.g. one district re-segmented from new
+# imagery) the RAT, the clump ID to tile lookup and the mode image are
+# all rewritten, so whole-file fingerprints would redo every tile.
+# Instead each tile gets a content fingerprint: a hash of its window
+# and of its objects in the segmentation, labelled 1..n as in the tile
+# outputs (so renumbering the clumps elsewhere in the image does not
+# change it). The fingerprint file is only rewritten when the hash
+# changes and the tile outputs are made from it rather than from the
+# segmentation, so only the tiles whose objects changed are redone.
+# The outputs of the other tiles, and so their populated GPKGs in
+# 3_PopulatePolys.py, are left untouched.
+
+import hashlib
+import json
+import os
+import re
+import numpy as np
+import farma_extract
+import farma_manifest
+import farma_handles
+
+FINGERPRINT_DIR = '0_tile_fingerprints/'
+
+# Per tile files in the tile dirs of 2_BoundingBoxes_Docker.py, e.g.
+# tile_12.kea, tile_segs_mskd_12.kea, tile_segs_mskd_lbl_vec12.gpkg and
+# its marker once merged (farma_vector.MergedMarker)
+TILE_FILE = re.compile(r'^tile_[a-z_]*?(\d+)\.(kea|gpkg|sha1|merged)$')
+
+
+def FingerprintFile(fp_dir, tile):
+    return os.path.join(fp_dir, "tile_{0}.sha1".format(tile))
+
+
+def TileHash(segs, tile_lut, tile, window, geotransform, wkt_str):
+    # Hash of the window and the tile's objects within it
+    lbl, nobjs = farma_extract.MaskAndRelabel(segs, tile_lut, int(float(tile)))
+    digest = hashlib.sha1()
+    digest.update(json.dumps([list(window), list(geotransform), wkt_str]).encode())
+    digest.update(np.ascontiguousarray(lbl).tobytes())
+    return digest.hexdigest()
+
+
+def TileFingerprint(tile, bbox, segfile, lut_file, fp_dir):
+    # Write the fingerprint of a tile, leaving the file (and so the
+    # tile outputs made from it) untouched if the tile has not changed
+    fp_file = FingerprintFile(fp_dir, tile)
+    inputs = [segfile, lut_file]
+    params = {'bbox': [float(x) for x in bbox]}
+    if farma_manifest.IsDone(fp_file, inputs, params):
+        # Neither the segmentation nor the lookup have changed
+        return
+    tile_lut = farma_extract.LoadTileLUT(lut_file)
+    segDataset = farma_handles.OpenDataset(segfile)
+    geotransform = segDataset.GetGeoTransform()
+    window = farma_extract.BBoxToWindow(bbox, geotransform, segDataset.RasterXSize, segDataset.RasterYSize)
+    segs = segDataset.GetRasterBand(1).ReadAsArray(*window)
+    wkt_str = segDataset.GetProjection()
+    segDataset = None
+
+    tmp_file = farma_manifest.TmpPath(fp_file)
+    with open(tmp_file, 'w') as f:
+        f.write(TileHash(segs, tile_lut, tile, window, geotransform, wkt_str) + '\n')
+    if farma_manifest.ReplaceIfChanged(tmp_file, fp_file):
+        print("Tile {} has changed".format(tile))
+    farma_manifest.MarkDone(fp_file, inputs, params)
+
+
+def ChangedTiles(fp_dir, tiles, since):
+    # Tiles whose fingerprint was written at or after since (seconds)
+    changed = []
+    for tile in tiles:
+        fp = farma_manifest.Fingerprint(FingerprintFile(fp_dir, tile))
+        if fp is not None and fp[1] >= int(since * 1e9):
+            changed.append(tile)
+    return changed
+
+
+def RemoveStaleTiles(tiles, dirs):
+    # Remove the per tile files of tiles which no longer exist (e.g.
+    # when the re-segmented objects fall in fewer tiles) so they are
+    # not populated by 3_PopulatePolys.py
+    tiles = set(str(tile) for tile in tiles)
+    nremoved = 0
+    for tile_dir in dirs:
+        if not os.path.isdir(tile_dir):
+            continue
+        for name in os.listdir(tile_dir):
+            match = TILE_FILE.match(name)
+            if match and match.group(1) not in tiles:
+                farma_manifest.RemoveFile(os.path.join(tile_dir, name))
+                nremoved += 1
+    return nremoved
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# An in-memory alternative to steps 2-6 of 2_BoundingBoxes_Docker.py.
+# The segmentation is read once for the window of each tile, the
+# objects belonging to the tile are selected with a lookup array
+# indexed by clump ID, relabelled in numpy and polygonised straight
+# from an in-memory GDAL dataset, so no intermediate KEA files
+# (and no RAT stats or pyramids) are written.
+
+import os.path
+import numpy as np
+import osgeo.gdal as gdal
+import farma_manifest
+import farma_handles
+import farma_polygonise
+from osgeo import ogr
+from osgeo import osr
+
+
+# Lookup arrays are memory mapped once per worker process
+_tile_luts = {}
+
+
+def LoadTileLUT(lut_file):
+    if lut_file not in _tile_luts:
+        _tile_luts[lut_file] = np.load(lut_file, mmap_mode='r')
+    return _tile_luts[lut_file]
+
+
+def BBoxToWindow(bbox, geotransform, xsize, ysize):
+    # Convert a [minX, maxX, minY, maxY] bbox into a pixel window
+    # (xoff, yoff, width, height) padded by one pixel and clipped
+    # to the raster. The padding is harmless as pixels are selected
+    # by the tile lookup, not by the window.
+    minX, maxX, minY, maxY = bbox
+    xoff = int(np.floor((minX - geotransform[0]) / geotransform[1])) - 1
+    xend = int(np.ceil((maxX - geotransform[0]) / geotransform[1])) + 1
+    yoff = int(np.floor((maxY - geotransform[3]) / geotransform[5])) - 1
+    yend = int(np.ceil((minY - geotransform[3]) / geotransform[5])) + 1
+    xoff = max(xoff, 0)
+    yoff = max(yoff, 0)
+    xend = min(xend, xsize)
+    yend = min(yend, ysize)
+    return xoff, yoff, xend - xoff, yend - yoff
+
+
+def MaskAndRelabel(segs, tile_lut, tile):
+    # Keep only the objects assigned to this tile and relabel them
+    # 1..n in order of their original clump ID (as relabel_clumps)
+    keep = (segs != 0) & (tile_lut[segs] == tile)
+    lbl = np.zeros(segs.shape, dtype=np.uint32)
+    uniq, inv = np.unique(segs[keep], return_inverse=True)
+    lbl[keep] = inv.astype(np.uint32) + 1
+    return lbl, uniq.size
+
+
+def ExtractTileInMemory(tile, bbox, segfile, lut_file, tile_vec_segs_dir, fp_file=None, tolerance=None):
+    out_vec = os.path.join(tile_vec_segs_dir, "tile_segs_mskd_lbl_vec{0}.gpkg".format(tile))
+    # Skipped only if made from the current segmentation and lookup,
+    # or from the current tile fingerprint (farma_dirty.py) if given
+    inputs = [fp_file] if fp_file else [segfile, lut_file]
+    params = {'bbox': [float(x) for x in bbox]}
+    if tolerance is not None:
+        params['simplify'] = float(tolerance)
+    if farma_manifest.IsDone(out_vec, inputs, params):
+        print('out_vec exists')
+        return
+    print("Creating {}".format(out_vec))
+    tile_lut = LoadTileLUT(lut_file)
+
+    # Read the segmentation window for the tile once, through the
+    # worker's open handle of the segmentation
+    segDataset = farma_handles.OpenDataset(segfile)
+    geotransform = segDataset.GetGeoTransform()
+    xoff, yoff, width, height = BBoxToWindow(bbox, geotransform, segDataset.RasterXSize, segDataset.RasterYSize)
+    if tolerance is None:
+        segs = segDataset.GetRasterBand(1).ReadAsArray(xoff, yoff, width, height)
+    else:
+        # With a pixel of the neighbouring clumps around it to find
+        # the nodes of the shared boundaries (farma_polygonise.py)
+        ids = farma_polygonise.ReadPadded(segDataset, xoff, yoff, width, height)
+        segs = ids[1:-1, 1:-1]
+    wkt_str = segDataset.GetProjection()
+    segDataset = None
+
+    # Mask objects in the tile and relabel
+    lbl, nobjs = MaskAndRelabel(segs, tile_lut, int(float(tile)))
+
+    # Polygonise from an in-memory dataset (or with shared, simplified
+    # boundaries)
+    memDataset = None
+    if tolerance is None:
+        memDataset = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_UInt32)
+        memDataset.SetGeoTransform((geotransform[0] + xoff * geotransform[1], geotransform[1], 0, geotransform[3] + yoff * geotransform[5], 0, geotransform[5]))
+        memDataset.SetProjection(wkt_str)
+        memBand = memDataset.GetRasterBand(1)
+        memBand.WriteArray(lbl)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(wkt_str)
+    out_vec_segs_lyr = "tile_segs_mskd_lbl_vec{0}.gpkg".format(tile)
+    with farma_manifest.AtomicOutput(out_vec) as tmp_vec:
+        vecDataset = ogr.GetDriverByName('GPKG').CreateDataSource(tmp_vec)
+        veclyr = vecDataset.CreateLayer(out_vec_segs_lyr, srs, ogr.wkbPolygon)
+        veclyr.CreateField(ogr.FieldDefn('PXLVAL', ogr.OFTInteger))
+        if tolerance is None:
+            veclyr.StartTransaction()
+            gdal.Polygonize(memBand, memBand, veclyr, 0, [], callback=None)
+            veclyr.CommitTransaction()
+        else:
+            before, after = farma_polygonise.PolygoniseSimplified(lbl, ids, geotransform, (xoff, yoff), veclyr, tolerance)
+            print("{}: {} vertices simplified to {}".format(out_vec, before, after))
+        vecDataset = None
+    memDataset = None
+    farma_manifest.MarkDone(out_vec, inputs, params)
+    print("{}: {} objects".format(out_vec, nobjs))
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Shared read-only GDAL dataset handles for the FARMA workers. Opening
+# a KEA (HDF5) file parses its header each time and a closed dataset
+# loses its blocks from the GDAL cache, so each worker keeps its most
+# recently used datasets open in a bounded LRU and the tile and raster
+# reads go through them. InitWorker is the pool initializer which also
+# sizes the GDAL block cache and threads from a per-worker memory
+# budget. The number of datasets asked for and actually opened is
+# counted per thread, those of a background thread (a prefetch) being
+# charged to the thread it works for, and logged per unit by
+# farma_instrument.py.
+
+import collections
+import contextlib
+import os
+import threading
+import osgeo.gdal as gdal
+import farma_plan
+
+# Datasets kept open per worker thread
+MAX_HANDLES = 32
+# Fraction of the worker's memory given to the GDAL block cache
+CACHE_FRACTION = 0.5
+MIN_CACHE_MB = 64
+
+_max_handles = MAX_HANDLES
+# Handles must not be shared between threads, so each thread has its own
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def Handles():
+    if not hasattr(_local, 'handles'):
+        _local.handles = collections.OrderedDict()
+    return _local.handles
+
+
+def Account():
+    # The counts of this thread (and the threads charging it)
+    if getattr(_local, 'account', None) is None:
+        _local.account = {'requests': 0, 'opens': 0, 'evictions': 0}
+    return _local.account
+
+
+@contextlib.contextmanager
+def Charging(account):
+    # Count the datasets this thread asks for and opens to the account
+    # of another thread (e.g. the one a prefetch is for)
+    previous = getattr(_local, 'account', None)
+    _local.account = account
+    try:
+        yield
+    finally:
+        _local.account = previous
+
+
+def Count(name):
+    with _lock:
+        Account()[name] += 1
+
+
+def Stamp(path):
+    # Size and mtime, so a file replaced since it was opened is reopened
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+def OpenDataset(path):
+    # A read-only dataset of the file, opened once per worker thread.
+    # The caller must not close it (or set band/dataset options).
+    key = os.path.abspath(path)
+    handles = Handles()
+    stamp = Stamp(key)
+    Count('requests')
+    if key in handles and handles[key][0] == stamp:
+        handles.move_to_end(key)
+        return handles[key][1]
+    dataset = gdal.Open(path, gdal.GA_ReadOnly)
+    if dataset is None:
+        raise Exception("Could not open {}".format(path))
+    handles[key] = (stamp, dataset)
+    handles.move_to_end(key)
+    Count('opens')
+    # Close the least recently used datasets
+    while len(handles) > _max_handles:
+        handles.popitem(last=False)
+        Count('evictions')
+    return dataset
+
+
+def CloseAll():
+    Handles().clear()
+
+
+def Counts():
+    # Datasets asked for, opened and closed to make room so far by this
+    # thread (and on its behalf)
+    with _lock:
+        return dict(Account())
+
+
+def WorkerMemoryMB(nworkers, mem_bytes=None):
+    # Share of the available memory (default: all of it, within any
+    # cgroup limit) for each of nworkers workers
+    if mem_bytes is None:
+        mem_bytes = farma_plan.AvailableMemory()
+    return int(mem_bytes * farma_plan.MEM_FRACTION / max(nworkers, 1) / 2**20)
+
+
+def WorkerThreads(nworkers):
+    # GDAL threads per worker so the workers do not oversubscribe the CPUs
+    return max(1, farma_plan.AvailableCPUs() // max(nworkers, 1))
+
+
+def Configure(mem_mb, nthreads=1, max_handles=MAX_HANDLES):
+    # GDAL block cache, threads and dataset pool of this process
+    global _max_handles
+    _max_handles = max_handles
+    cache_mb = max(MIN_CACHE_MB, int(mem_mb * CACHE_FRACTION))
+    # Also applies to the datasets rsgislib opens in this process
+    gdal.SetCacheMax(cache_mb * 2**20)
+    gdal.SetConfigOption('GDAL_NUM_THREADS', str(nthreads))
+    return cache_mb
+
+
+def InitWorker(mem_mb, nthreads=1, max_handles=MAX_HANDLES):
+    # multiprocessing.Pool initializer (and farma_queue worker start)
+    Configure(mem_mb, nthreads, max_handles)
+    CloseAll()
+
+
+def WorkerInit(nworkers, mem_mb=None, max_handles=MAX_HANDLES):
+    # (initializer, initargs) for nworkers workers on this node, given
+    # the memory of each (default: a share of the available memory)
+    if mem_mb is None:
+        mem_mb = WorkerMemoryMB(nworkers)
+    nthreads = WorkerThreads(nworkers)
+    print("Workers: {} MB each ({} MB GDAL cache), {} GDAL threads, up to {} open datasets".format(mem_mb, max(MIN_CACHE_MB, int(mem_mb * CACHE_FRACTION)), nthreads, max_handles))
+    return InitWorker, (mem_mb, nthreads, max_handles)
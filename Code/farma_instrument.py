@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Instrumentation of the FARMA worker functions. Each (tile, stage)
+# or (GPKG, raster) unit run through Instrumented appends one JSON
+# line to a log with its wall and CPU time, bytes read and written,
+# peak RSS, object count, GDAL datasets asked for and opened (through
+# farma_handles.py) and whether it succeeded (with the error if not).
+# Run this file on a log for a summary of the slowest units, the time
+# spent in each stage and how busy the worker pool was:
+#     python farma_instrument.py -l farma_log.jsonl
+
+import argparse
+import json
+import os
+import time
+import traceback
+import farma_handles
+
+
+def ProcIO():
+    # (bytes read, bytes written) by this process so far
+    io = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                io[name] = int(value)
+    except (IOError, OSError):
+        pass
+    return io.get('rchar', 0), io.get('wchar', 0)
+
+
+def ResetPeakRSS():
+    # Reset the peak RSS of this process so each unit gets its own
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def PeakRSS():
+    # Peak RSS (MB) of this process since the last reset
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def WriteRecord(log_file, record):
+    # Append one JSON line. A single write to a file opened for
+    # appending so lines from different workers do not interleave.
+    line = (json.dumps(record) + '\n').encode()
+    fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def NewRun(log_file, script, cores):
+    # Record the start of a run of a script. Returns the run ID to
+    # pass to Instrumented and EndRun.
+    run = '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+    WriteRecord(log_file, {'type': 'run', 'run': run, 'script': script, 'cores': cores, 'start': time.time()})
+    return run
+
+
+def EndRun(log_file, run, failed=0):
+    WriteRecord(log_file, {'type': 'end', 'run': run, 'end': time.time(), 'failed': failed})
+
+
+class Instrumented(object):
+    # Wraps a worker function so each call is logged as a unit of the
+    # stage. The first nkey arguments identify the unit (e.g. the tile,
+    # or the GPKG and raster) and objects maps the first argument to
+    # its object count. Exceptions are logged then raised again.
+
+    def __init__(self, func, stage, log_file, run, nkey=1, objects=None):
+        self.func = func
+        self.stage = stage
+        self.log_file = log_file
+        self.run = run
+        self.nkey = nkey
+        self.objects = objects
+
+    def __call__(self, *args):
+        ResetPeakRSS()
+        read0, written0 = ProcIO()
+        start = time.time()
+        cpu0 = time.process_time()
+        counts0 = farma_handles.Counts()
+        record = {'type': 'unit', 'run': self.run, 'stage': self.stage,
+                  'unit': [str(a) for a in args[:self.nkey]], 'pid': os.getpid(), 'start': start}
+        if self.objects is not None:
+            record['objects'] = self.objects.get(args[0])
+        try:
+            result = self.func(*args)
+            record['ok'] = True
+            return result
+        except Exception as e:
+            record['ok'] = False
+            record['error'] = '{}: {}'.format(type(e).__name__, e)
+            record['traceback'] = traceback.format_exc()
+            raise
+        finally:
+            read1, written1 = ProcIO()
+            record['wall_s'] = time.time() - start
+            record['cpu_s'] = time.process_time() - cpu0
+            record['bytes_read'] = read1 - read0
+            record['bytes_written'] = written1 - written0
+            record['peak_rss_mb'] = PeakRSS()
+            counts1 = farma_handles.Counts()
+            record['gdal_requests'] = counts1['requests'] - counts0['requests']
+            record['gdal_opens'] = counts1['opens'] - counts0['opens']
+            WriteRecord(self.log_file, record)
+
+
+def ReadLog(log_file, run=None):
+    # The run records and unit records of a run (default: the latest)
+    records = []
+    with open(log_file) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    runs = [r for r in records if r['type'] == 'run']
+    if run is None and runs:
+        run = runs[-1]['run']
+    return ([r for r in records if r['type'] in ['run', 'end'] and r['run'] == run],
+            [r for r in records if r['type'] == 'unit' and r['run'] == run])
+
+
+def Summary(log_file, run=None, nslow=10):
+    runinfo, units = ReadLog(log_file, run)
+    if not units:
+        print("No units logged")
+        return
+    start = min(u['start'] for u in units)
+    end = max(u['start'] + u['wall_s'] for u in units)
+    cores = None
+    for r in runinfo:
+        if r['type'] == 'run':
+            print("Run {} of {} on {} cores".format(r['run'], r['script'], r['cores']))
+            cores = r['cores']
+            start = min(start, r['start'])
+        else:
+            end = max(end, r['end'])
+
+    # Time per stage
+    stages = {}
+    for u in units:
+        s = stages.setdefault(u['stage'], {'n': 0, 'failed': 0, 'wall': 0.0, 'cpu': 0.0, 'max': 0.0, 'read': 0, 'written': 0, 'rss': 0.0, 'objects': 0, 'requests': 0, 'opens': 0})
+        s['n'] += 1
+        s['failed'] += 0 if u['ok'] else 1
+        s['wall'] += u['wall_s']
+        s['cpu'] += u['cpu_s']
+        s['max'] = max(s['max'], u['wall_s'])
+        s['read'] += u['bytes_read']
+        s['written'] += u['bytes_written']
+        s['rss'] = max(s['rss'], u['peak_rss_mb'] or 0)
+        s['objects'] += u.get('objects') or 0
+        s['requests'] += u.get('gdal_requests', 0)
+        s['opens'] += u.get('gdal_opens', 0)
+    busy = sum(s['wall'] for s in stages.values())
+    print("{:<22} {:>6} {:>6} {:>10} {:>6} {:>9} {:>9} {:>10} {:>10} {:>8} {:>15}".format('stage', 'units', 'failed', 'wall_s', '%', 'max_s', 'cpu_s', 'read_MB', 'write_MB', 'rss_MB', 'opens/requests'))
+    for name, s in stages.items():
+        print("{:<22} {:>6} {:>6} {:>10.1f} {:>6.1f} {:>9.1f} {:>9.1f} {:>10.1f} {:>10.1f} {:>8.0f} {:>15}".format(name, s['n'], s['failed'], s['wall'], 100.0 * s['wall'] / busy if busy else 0, s['max'], s['cpu'], s['read'] / 2**20, s['written'] / 2**20, s['rss'], '{}/{}'.format(s['opens'], s['requests'])))
+    # Datasets opened against those asked for through farma_handles.py,
+    # each of which would have been an open without the shared handles
+    nrequests = sum(s['requests'] for s in stages.values())
+    nopens = sum(s['opens'] for s in stages.values())
+    if nrequests:
+        print("GDAL datasets: {} opened for {} requests ({:.1f}% reused)".format(nopens, nrequests, 100.0 * (nrequests - nopens) / nrequests))
+
+    # Slowest units
+    print("Slowest units:")
+    for u in sorted(units, key=lambda u: u['wall_s'], reverse=True)[:nslow]:
+        print("  {:<22} {:<40} {:>9.1f} s {:>8} objects {}".format(u['stage'], ' '.join(os.path.basename(x) for x in u['unit']), u['wall_s'], str(u.get('objects')), '' if u['ok'] else 'FAILED'))
+
+    # Pool utilisation: the time the workers were busy out of the
+    # time available to them over the run
+    workers = cores if cores else len(set(u['pid'] for u in units))
+    span = end - start
+    if span > 0:
+        print("Pool utilisation: {:.1f}% ({:.0f} busy worker seconds of {} workers x {:.0f} s)".format(100.0 * busy / (workers * span), busy, workers, span))
+
+    failed = [u for u in units if not u['ok']]
+    if failed:
+        print("Failures:")
+        for u in failed:
+            print("  {:<22} {:<40} {}".format(u['stage'], ' '.join(os.path.basename(x) for x in u['unit']), u['error']))
+
+
+def main():
+    print("Use 'python farma_instrument.py -h' for help")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l", "--log", type=str, help="Specify the JSON-lines log written by scripts 2 or 3")
+    parser.add_argument("-r", "--run", type=str, help="Specify the run to summarise (default: the latest)")
+    parser.add_argument("-n", "--slowest", type=int, default=10, help="Specify the number of slowest units to list")
+    args = parser.parse_args()
+
+    if args.log == None:
+        print("SPECIFY THE LOG FILE")
+        os._exit(1)
+
+    Summary(args.log, args.run, args.slowest)
+
+
+if __name__ == "__main__":
+    main()
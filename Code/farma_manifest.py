@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Crash safe outputs for the FARMA workflow. Outputs are written to a
+# temporary name in the same directory and renamed into place once
+# complete, so a killed worker never leaves a partial file under the
+# final name. Each output directory keeps a manifest (JSON lines) of
+# the completed outputs with fingerprints (size and modification
+# time) of the output and of the inputs it was made from. An output
+# is only skipped on a rerun if it and all of its inputs still match
+# the manifest, so exactly the missing or stale work is redone.
+# The temporary files of killed workers are removed by SweepTmp when
+# the next run starts.
+
+import contextlib
+import filecmp
+import json
+import os
+import re
+import socket
+
+MANIFEST = '.farma_manifest.jsonl'
+
+# Manifests are read once per process: PID -> manifest file -> records
+# (a forked worker does not use the copy of its parent)
+_manifests = {}
+
+# Node name in the temporary names, as directories may be shared
+# between nodes whose PIDs mean nothing here
+HOST = socket.gethostname().split('.')[0]
+TMP_PATTERN = re.compile(r'^\.tmp(\d+)(?:_([^.]*))?\.')
+
+
+def Fingerprint(path):
+    # [size, mtime (ns)] of a file, or None if it does not exist
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def ManifestFile(output):
+    return os.path.join(os.path.dirname(os.path.abspath(output)), MANIFEST)
+
+
+def TmpPath(output):
+    # Temporary name in the same directory (so the rename is atomic),
+    # keeping the extension for the drivers which look at it
+    return os.path.join(os.path.dirname(output), '.tmp{}_{}.{}'.format(os.getpid(), HOST, os.path.basename(output)))
+
+
+def PidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def SweepTmp(dirs):
+    # Remove the temporary outputs (TmpPath) left in dirs by processes
+    # of this node which are no longer running (e.g. killed workers),
+    # so they are not counted against a disk budget. Returns the
+    # number of files removed.
+    nremoved = 0
+    for path in dirs:
+        try:
+            names = os.listdir(path)
+        except OSError:
+            continue
+        for name in names:
+            match = TMP_PATTERN.match(name)
+            if match is None or match.group(2) not in (None, HOST):
+                continue
+            pid = int(match.group(1))
+            if pid == os.getpid() or PidAlive(pid):
+                continue
+            try:
+                os.remove(os.path.join(path, name))
+                nremoved += 1
+            except OSError:
+                # Removed by another process meanwhile
+                pass
+    return nremoved
+
+
+def RemoveFile(path):
+    for name in [path, path + '-wal', path + '-shm', path + '.aux.xml']:
+        if os.path.exists(name):
+            os.remove(name)
+
+
+@contextlib.contextmanager
+def AtomicOutput(output):
+    # with AtomicOutput(out) as tmp: write tmp, which is renamed to
+    # out when the block finishes or removed if it raises
+    tmp = TmpPath(output)
+    RemoveFile(tmp)
+    try:
+        yield tmp
+        os.replace(tmp, output)
+    except BaseException:
+        RemoveFile(tmp)
+        raise
+
+
+def LoadManifest(manifest_file, reload=False):
+    # Latest record of each output in the manifest
+    manifests = _manifests.setdefault(os.getpid(), {})
+    if reload or manifest_file not in manifests:
+        records = {}
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+                    records[record['output']] = record
+        manifests[manifest_file] = records
+    return manifests[manifest_file]
+
+
+def Record(output, reload=False):
+    # The manifest record of an output, if it is complete and has not
+    # changed since it was recorded
+    record = LoadManifest(ManifestFile(output), reload).get(os.path.basename(output))
+    if record is None or record['fingerprint'] != Fingerprint(output):
+        return None
+    return record
+
+
+def Params(params):
+    # Parameters as they are stored in the manifest (JSON)
+    return json.loads(json.dumps(params))
+
+
+def IsDone(output, inputs=(), params=None, reload=False):
+    # True if the output is complete and was made from the inputs as
+    # they are now with the same parameters
+    record = Record(output, reload)
+    if record is None or record['params'] != Params(params):
+        return False
+    if sorted(record['inputs']) != sorted(os.path.abspath(i) for i in inputs):
+        return False
+    return all(Fingerprint(i) == record['inputs'][i] for i in record['inputs'])
+
+
+def MarkDone(output, inputs=(), params=None):
+    # Record a completed output in its directory's manifest. A single
+    # write to the file opened for appending so records from different
+    # workers do not interleave.
+    record = {'output': os.path.basename(output), 'fingerprint': Fingerprint(output),
+              'inputs': {os.path.abspath(i): Fingerprint(i) for i in inputs}, 'params': Params(params)}
+    line = (json.dumps(record) + '\n').encode()
+    fd = os.open(ManifestFile(output), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+    manifest = _manifests.get(os.getpid(), {}).get(ManifestFile(output))
+    if manifest is not None:
+        manifest[record['output']] = record
+
+
+def ReplaceIfChanged(new_file, old_file):
+    # Move new_file to old_file unless their contents are the same,
+    # in which case the old file (and its fingerprint) is kept
+    if os.path.isfile(old_file) and filecmp.cmp(new_file, old_file, shallow=False):
+        os.remove(new_file)
+        return False
+    os.replace(new_file, old_file)
+    return True
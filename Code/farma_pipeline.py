@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# A per-tile task scheduler for the FARMA workflow.
+# Each tile moves through the processing stages as soon as its
+# own previous stage has finished, rather than every stage
+# waiting for the slowest tile of the stage before it.
+
+import heapq
+import multiprocessing
+import queue
+import time
+
+# Returned by a stage to finish its tile early (e.g. the tile output
+# is already complete), skipping the tile's remaining stages
+TILE_DONE = 'TILE_DONE'
+
+
+def RunTilePipeline(tiles, stages, ncores, report_interval=30, on_done=None, initializer=None, initargs=(), can_start=None):
+    # tiles: list of tile IDs, in the order they should be started
+    # (e.g. largest first so stragglers begin early)
+    # stages: list of (name, func, args) where args(tile) returns the
+    # argument tuple of func for that tile, or a function of the tile
+    # returning such a list if tiles go through different stages
+    # Ready tasks are held in a priority queue favouring the latest
+    # stage, and a task is only handed to the pool when a worker is
+    # free, so idle workers always pick up the next ready task and a
+    # tile that has started is finished before new tiles are begun.
+    # on_done(tile) is called (in this process) when a tile has
+    # finished its last stage. initializer(*initargs) is run in each
+    # worker when it starts (e.g. farma_handles.InitWorker).
+    # can_start() is asked before a new tile is begun, which waits
+    # while it returns False and other tasks are running (e.g. while
+    # the disk budget is used up).
+    # Returns a list of (tile, stage name, error) for failed tasks.
+    if callable(stages):
+        tile_stages = {tile: stages(tile) for tile in tiles}
+    else:
+        tile_stages = {tile: stages for tile in tiles}
+    stage_names = []
+    for tile in tiles:
+        for name, func, args in tile_stages[tile]:
+            if name not in stage_names:
+                stage_names.append(name)
+
+    ready = []
+    queued = {name: 0 for name in stage_names}
+    running = {name: 0 for name in stage_names}
+    for order, tile in enumerate(tiles):
+        heapq.heappush(ready, (0, order, tile))
+        queued[tile_stages[tile][0][0]] += 1
+    max_queued = dict(queued)
+
+    done_q = queue.Queue()
+    failed = []
+    remaining = len(tiles)
+    inflight = 0
+    last_report = time.time()
+
+    with multiprocessing.Pool(processes=ncores, initializer=initializer, initargs=initargs) as pool:
+        while remaining > 0:
+            # Hand ready tasks to any free workers
+            while ready and inflight < ncores:
+                if (ready[0][0] == 0) and (can_start is not None) and (not can_start()):
+                    if inflight > 0:
+                        # Wait for a running task to free space
+                        break
+                    # Nothing running would free it, so carry on
+                    print("Starting tile {} over the limit as no other tiles are running".format(ready[0][2]))
+                neg_stage, order, tile = heapq.heappop(ready)
+                idx = -neg_stage
+                name, func, args = tile_stages[tile][idx]
+                queued[name] -= 1
+                running[name] += 1
+                inflight += 1
+                pool.apply_async(func, args(tile),
+                                 callback=lambda result, tile=tile, idx=idx, order=order: done_q.put((tile, idx, order, None, result)),
+                                 error_callback=lambda e, tile=tile, idx=idx, order=order: done_q.put((tile, idx, order, e, None)))
+
+            # Wait for a task to finish and queue the tile's next stage
+            tile, idx, order, err, result = done_q.get()
+            name = tile_stages[tile][idx][0]
+            running[name] -= 1
+            inflight -= 1
+            if err is not None:
+                print("Tile {} failed at {}: {}".format(tile, name, err))
+                failed.append((tile, name, err))
+                remaining -= 1
+            elif (idx + 1 < len(tile_stages[tile])) and (result != TILE_DONE):
+                next_name = tile_stages[tile][idx + 1][0]
+                queued[next_name] += 1
+                max_queued[next_name] = max(max_queued[next_name], queued[next_name])
+                heapq.heappush(ready, (-(idx + 1), order, tile))
+            else:
+                remaining -= 1
+                if on_done is not None:
+                    on_done(tile)
+
+            if (time.time() - last_report) > report_interval:
+                PrintQueueDepth(stage_names, queued, running, remaining)
+                last_report = time.time()
+
+    PrintQueueDepth(stage_names, queued, running, remaining)
+    print("Max queue depth per stage: " + ", ".join("{}={}".format(name, max_queued[name]) for name in stage_names))
+    return failed
+
+
+def PrintQueueDepth(stage_names, queued, running, remaining):
+    # Print the number of tiles waiting for and running each stage
+    print("Tiles remaining: {} | ".format(remaining) + ", ".join("{}: {} queued/{} running".format(name, queued[name], running[name]) for name in stage_names))
+
+
+def RunUnitsWithMerge(units, unit_func, merge_func, merge_args, ncores, report_interval=30, on_done=None, initializer=None, initargs=(), merge_funcs=None):
+    # units: list of (group, cost, args) where unit_func(*args) does
+    # one independent piece of work for the group (e.g. one raster
+    # for one GPKG), or (group, cost, args, func) to run func instead
+    # merge_args: dict of group -> argument tuple of merge_func, which
+    # is run as soon as every unit of its group has finished, or the
+    # function of the group in merge_funcs if given
+    # Units are started longest (highest cost) first so the largest
+    # pieces of work do not finish last, and merges are started ahead
+    # of any remaining units so outputs appear as early as possible.
+    # on_done(group) is called (in this process) when a merge finishes.
+    # initializer(*initargs) is run in each worker when it starts.
+    # Returns a list of (group, unit args or 'merge', error) for failures.
+    ready = []
+    pending = {}
+    unit_funcs = {}
+    for seq, unit in enumerate(units):
+        group, cost, args = unit[:3]
+        if len(unit) > 3:
+            unit_funcs[seq] = unit[3]
+        heapq.heappush(ready, (1, -cost, seq, group, args))
+        pending[group] = pending.get(group, 0) + 1
+    # Groups with no units to run only need merging
+    for seq, group in enumerate(merge_args):
+        if group not in pending:
+            heapq.heappush(ready, (0, 0, seq, group, None))
+
+    done_q = queue.Queue()
+    failed = []
+    failed_groups = set()
+    inflight = 0
+    nunits = len(units)
+    remaining = len(ready) + len([group for group in pending if group in merge_args])
+    last_report = time.time()
+
+    with multiprocessing.Pool(processes=ncores, initializer=initializer, initargs=initargs) as pool:
+        while remaining > 0:
+            while ready and inflight < ncores:
+                priority, negcost, seq, group, args = heapq.heappop(ready)
+                if priority == 0:
+                    func, args = (merge_funcs or {}).get(group, merge_func), merge_args[group]
+                else:
+                    func = unit_funcs.get(seq, unit_func)
+                inflight += 1
+                pool.apply_async(func, args,
+                                 callback=lambda result, group=group, priority=priority, args=args: done_q.put((group, priority, args, None)),
+                                 error_callback=lambda e, group=group, priority=priority, args=args: done_q.put((group, priority, args, e)))
+
+            group, priority, args, err = done_q.get()
+            inflight -= 1
+            remaining -= 1
+            if err is not None:
+                print("{} failed ({}): {}".format(group, 'merge' if priority == 0 else args, err))
+                failed.append((group, 'merge' if priority == 0 else args, err))
+                if priority == 1:
+                    failed_groups.add(group)
+            elif (priority == 0) and (on_done is not None):
+                on_done(group)
+            if priority == 1:
+                nunits -= 1
+                pending[group] -= 1
+                if pending[group] == 0 and group in merge_args:
+                    if group in failed_groups:
+                        # Do not merge a group with missing units
+                        remaining -= 1
+                    else:
+                        heapq.heappush(ready, (0, 0, 0, group, None))
+
+            if (time.time() - last_report) > report_interval:
+                print("Units remaining: {} | merges queued: {} | running: {}".format(nunits, len([x for x in ready if x[0] == 0]), inflight))
+                last_report = time.time()
+
+    return failed
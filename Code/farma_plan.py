@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# A simple planner for clumping a segmentation in 0_ClumpSegmentation.py.
+# The peak memory and runtime of each clumping method are estimated
+# from the raster dimensions, data type and block size and the RAM and
+# CPUs available, and the fastest plan that fits in memory is picked.
+# Each run is logged with the estimate next to the measured figures,
+# and the logged runs are used to scale later estimates.
+
+import json
+import os
+import resource
+import numpy as np
+import osgeo.gdal as gdal
+
+METHODS = ['CLUMP_RAM', 'CLUMP_DISK', 'TILED_SINGLE', 'TILED_MULTI']
+
+# Cost model. Seconds per megapixel clumped, memory (bytes) per pixel
+# held and the extra cost of stitching tiles back together. These are
+# starting points which the logged runs calibrate.
+COSTS = {'CLUMP_RAM': {'s_per_mp': 0.05, 'bytes_per_pxl': 12},
+         'CLUMP_DISK': {'s_per_mp': 0.5},
+         'TILED_SINGLE': {'s_per_mp': 0.06, 'bytes_per_pxl': 12},
+         'TILED_MULTI': {'s_per_mp': 0.06, 'bytes_per_pxl': 12}}
+# Stitching the tiles (serial, per megapixel of the whole image)
+STITCH_S_PER_MP = 0.02
+# Writing, reading and labelling each tile
+TILE_OVERHEAD_S = 2.0
+# Fixed memory of the process (Python, GDAL cache etc.)
+BASE_BYTES = 512 * 1024 * 1024
+# Fraction of the available memory a plan may use
+MEM_FRACTION = 0.8
+# Smallest tile worth using
+MIN_TILE = 1000
+
+
+def RasterInfo(img):
+    # (xsize, ysize, bytes per pixel, (block width, block height))
+    imgDataset = gdal.Open(img, gdal.GA_ReadOnly)
+    imgBand = imgDataset.GetRasterBand(1)
+    info = (imgDataset.RasterXSize, imgDataset.RasterYSize, gdal.GetDataTypeSize(imgBand.DataType) // 8, tuple(imgBand.GetBlockSize()))
+    imgDataset = None
+    return info
+
+
+def AvailableMemory():
+    # Available memory (bytes), within any cgroup limit
+    avail = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    for limit_file in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+        except (IOError, OSError):
+            continue
+        if limit.isdigit():
+            avail = min(avail, int(limit))
+    return avail
+
+
+def AvailableCPUs():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def ReadRuns(log_file):
+    runs = []
+    if log_file and os.path.isfile(log_file):
+        with open(log_file) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    runs.append(json.loads(line))
+    return runs
+
+
+def Calibration(runs):
+    # Per method (runtime, memory) scale factors: the median ratio of
+    # the measured to the raw (uncalibrated) estimated figures of the
+    # logged runs. The calibrated estimates are not used, as they were
+    # already scaled by the runs before them. Runs logged without the
+    # raw figures are left out.
+    scales = {}
+    for method in METHODS:
+        done = [r for r in runs if r['method'] == method and r.get('measured_s') and r.get('raw_estimated_s')]
+        if done:
+            scales[method] = (float(np.median([r['measured_s'] / r['raw_estimated_s'] for r in done])),
+                              float(np.median([r['measured_mb'] / r['raw_estimated_mb'] for r in done])))
+    return scales
+
+
+def TileSize(budget, bytes_per_pxl, block, xsize, ysize):
+    # Largest square tile (whole blocks) which fits in the budget
+    side = int(np.sqrt(max(budget, 0) / float(bytes_per_pxl)))
+    side = min(side, max(xsize, ysize))
+    side = (side // block[0]) * block[0] if side >= block[0] else side
+    return side
+
+
+def NumTiles(tile, xsize, ysize):
+    tile = float(max(tile, 1))
+    return int(np.ceil(xsize / tile)) * int(np.ceil(ysize / tile))
+
+
+def EstimatePlans(xsize, ysize, pxl_bytes, block, mem_bytes, ncpus, scales=None):
+    # Estimated (peak memory, runtime) of each method, as a list of
+    # plan dicts. The tiled methods use the largest tiles that fit.
+    npxl = float(xsize) * ysize
+    mp = npxl / 1e6
+    budget = mem_bytes * MEM_FRACTION - BASE_BYTES
+    plans = []
+
+    # Whole image (input and 32 bit output) held in memory
+    cost = COSTS['CLUMP_RAM']
+    plans.append({'method': 'CLUMP_RAM', 'tilesize': None, 'cores': 1,
+                  'estimated_mb': (BASE_BYTES + npxl * (cost['bytes_per_pxl'] + pxl_bytes)) / 2**20,
+                  'estimated_s': mp * cost['s_per_mp']})
+
+    # A few rows of blocks held at a time
+    plans.append({'method': 'CLUMP_DISK', 'tilesize': None, 'cores': 1,
+                  'estimated_mb': (BASE_BYTES + 4.0 * xsize * block[1] * (4 + pxl_bytes)) / 2**20,
+                  'estimated_s': mp * COSTS['CLUMP_DISK']['s_per_mp']})
+
+    # One tile at a time, then the tiles are stitched
+    cost = COSTS['TILED_SINGLE']
+    tile = TileSize(budget, cost['bytes_per_pxl'] + pxl_bytes, block, xsize, ysize)
+    plans.append({'method': 'TILED_SINGLE', 'tilesize': tile, 'cores': 1,
+                  'estimated_mb': (BASE_BYTES + float(tile) ** 2 * (cost['bytes_per_pxl'] + pxl_bytes)) / 2**20,
+                  'estimated_s': mp * (cost['s_per_mp'] + STITCH_S_PER_MP) + NumTiles(tile, xsize, ysize) * TILE_OVERHEAD_S})
+
+    # One tile per core (each in its own process)
+    cost = COSTS['TILED_MULTI']
+    for cores in range(ncpus, 1, -1):
+        tile = TileSize((budget - (cores - 1) * BASE_BYTES) / cores, cost['bytes_per_pxl'] + pxl_bytes, block, xsize, ysize)
+        ntiles = NumTiles(tile, xsize, ysize)
+        if tile >= MIN_TILE:
+            # No more cores than tiles
+            cores = min(cores, ntiles)
+            plans.append({'method': 'TILED_MULTI', 'tilesize': tile, 'cores': cores,
+                          'estimated_mb': (cores * BASE_BYTES + cores * float(tile) ** 2 * (cost['bytes_per_pxl'] + pxl_bytes)) / 2**20,
+                          'estimated_s': mp * (cost['s_per_mp'] / cores + STITCH_S_PER_MP) + np.ceil(ntiles / float(cores)) * TILE_OVERHEAD_S})
+            break
+
+    for plan in plans:
+        # The model's figures are kept for calibrating later runs
+        plan['raw_estimated_s'] = plan['estimated_s']
+        plan['raw_estimated_mb'] = plan['estimated_mb']
+        time_scale, mem_scale = (scales or {}).get(plan['method'], (1.0, 1.0))
+        plan['estimated_s'] *= time_scale
+        plan['estimated_mb'] *= mem_scale
+        plan['fits'] = (plan['estimated_mb'] <= mem_bytes * MEM_FRACTION / 2**20)
+        if plan['tilesize'] is not None and plan['tilesize'] < MIN_TILE and plan['tilesize'] < max(xsize, ysize):
+            plan['fits'] = False
+    return plans
+
+
+def ChoosePlan(plans):
+    # Fastest plan that fits, otherwise the one needing least memory
+    fits = [p for p in plans if p['fits']]
+    if fits:
+        return min(fits, key=lambda p: p['estimated_s'])
+    return min(plans, key=lambda p: p['estimated_mb'])
+
+
+def PlanClumping(img, log_file=None, mem_bytes=None, ncpus=None):
+    # Plan the clumping of img, printing the estimate of every method
+    xsize, ysize, pxl_bytes, block = RasterInfo(img)
+    if mem_bytes is None:
+        mem_bytes = AvailableMemory()
+    if ncpus is None:
+        ncpus = AvailableCPUs()
+    plans = EstimatePlans(xsize, ysize, pxl_bytes, block, mem_bytes, ncpus, Calibration(ReadRuns(log_file)))
+    print("{} x {} pixels ({} bytes, {} x {} blocks), {:.0f} MB RAM and {} CPUs available".format(xsize, ysize, pxl_bytes, block[0], block[1], mem_bytes / 2**20, ncpus))
+    for plan in plans:
+        print("  {:<13} tile {:<6} cores {:<3} ~{:>9.0f} MB ~{:>8.0f} s {}".format(plan['method'], str(plan['tilesize']), plan['cores'], plan['estimated_mb'], plan['estimated_s'], '' if plan['fits'] else '(does not fit)'))
+    plan = ChoosePlan(plans)
+    plan.update({'xsize': xsize, 'ysize': ysize, 'pxl_bytes': pxl_bytes, 'mem_mb': mem_bytes / 2**20, 'cpus': ncpus})
+    print("Chose {}".format(plan['method']))
+    return plan
+
+
+def PeakMemoryMB(cores=1):
+    # Peak RSS (MB) of this process plus, for worker processes, cores
+    # times the largest child (only the largest child is reported)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak += cores * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak / 1024.0
+
+
+def LogRun(log_file, plan, measured_s, measured_mb):
+    # Append the plan with its measured figures to the run log
+    run = dict(plan)
+    run['measured_s'] = measured_s
+    run['measured_mb'] = measured_mb
+    print("{}: estimated {:.0f} s, {:.0f} MB; measured {:.0f} s, {:.0f} MB".format(plan['method'], plan['estimated_s'], plan['estimated_mb'], measured_s, measured_mb))
+    if log_file:
+        with open(log_file, 'a') as f:
+            f.write(json.dumps(run) + '\n')
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Vertex reduced polygonisation of the tile labels for
+# 2_BoundingBoxes_Docker.py. The labels are polygonised exactly with
+# GDAL in pixel coordinates, then every ring is cut into arcs at the
+# nodes of the segmentation: the pixel corners where three or more
+# clumps meet (or two meet diagonally). Each arc is the boundary
+# between the same two clumps in every tile, so it is simplified once
+# (collinear pixel edges merged, then Douglas-Peucker with a tolerance
+# in pixels) and used by both of its polygons, so neighbouring fields
+# share exactly the same boundary. The nodes are found from the clump
+# IDs of the segmentation, not the tile labels, so the arcs are cut
+# at the same places whichever tile they are seen from.
+# Arcs simplified separately can still cross each other, so an arc
+# which crosses or overlaps another arc of the tile, or leaves one of
+# its polygons invalid, falls back to the exact (collinear merged)
+# arc in all of its polygons. The polygons of a tile are then free of
+# gaps and overlaps. Whether an arc falls back depends on the arcs of
+# the tile, so an arc shared with a clump of another tile is never
+# simplified: it is exact in both tiles, which therefore always
+# share it.
+
+import struct
+import numpy as np
+import osgeo.gdal as gdal
+from osgeo import ogr
+
+# Clump ID given to pixels outside of the raster
+OUTSIDE = -1
+
+
+def ReadPadded(dataset, xoff, yoff, width, height, band=1):
+    # Read a window with one extra pixel on every side, pixels off the
+    # raster being OUTSIDE
+    out = np.full((height + 2, width + 2), OUTSIDE, dtype=np.int64)
+    x0 = max(xoff - 1, 0)
+    y0 = max(yoff - 1, 0)
+    x1 = min(xoff + width + 1, dataset.RasterXSize)
+    y1 = min(yoff + height + 1, dataset.RasterYSize)
+    if (x1 > x0) and (y1 > y0):
+        out[y0 - yoff + 1:y1 - yoff + 1, x0 - xoff + 1:x1 - xoff + 1] = dataset.GetRasterBand(band).ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+    return out
+
+
+def NodeGrid(ids):
+    # ids: clump IDs of a window padded by one pixel (height + 2,
+    # width + 2). Returns a boolean array (height + 1, width + 1) of
+    # the pixel corners of the window which are nodes.
+    a = ids[:-1, :-1]
+    b = ids[:-1, 1:]
+    c = ids[1:, :-1]
+    d = ids[1:, 1:]
+    ndistinct = 1 + (b != a) + ((c != a) & (c != b)) + ((d != a) & (d != b) & (d != c))
+    return (ndistinct >= 3) | ((a == d) & (b == c) & (a != b))
+
+
+def Densify(ring):
+    # Every pixel corner along a closed ring of axis aligned edges
+    steps = np.diff(ring, axis=0)
+    lengths = np.abs(steps).sum(axis=1)
+    unit = np.repeat(np.sign(steps), lengths, axis=0)
+    return np.concatenate((ring[:1], ring[0] + np.cumsum(unit, axis=0)))
+
+
+def Corners(arc):
+    # Drop the points where the direction does not change (merging
+    # collinear pixel edges), keeping the end points
+    if len(arc) < 3:
+        return arc
+    steps = np.diff(arc, axis=0)
+    turn = np.any(steps[1:] != steps[:-1], axis=1)
+    return arc[np.concatenate(([True], turn, [True]))]
+
+
+def DouglasPeucker(arc, tolerance):
+    # Simplify an open arc keeping its end points. Points further than
+    # tolerance from the line through the kept points either side of
+    # them are kept, so the arc moves at most tolerance.
+    n = len(arc)
+    if n < 3:
+        return arc
+    pts = arc.astype(np.float64)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        s, e = stack.pop()
+        if e <= s + 1:
+            continue
+        seg = pts[s + 1:e] - pts[s]
+        line = pts[e] - pts[s]
+        norm = np.hypot(line[0], line[1])
+        if norm == 0:
+            # A loop: distance from the point it starts and ends at
+            dist = np.hypot(seg[:, 0], seg[:, 1])
+        else:
+            dist = np.abs(seg[:, 0] * line[1] - seg[:, 1] * line[0]) / norm
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            keep[s + 1 + i] = True
+            stack.append((s, s + 1 + i))
+            stack.append((s + 1 + i, e))
+    return arc[keep]
+
+
+class ArcCache(object):
+    # The exact and simplified version of each arc, keyed by its first
+    # edge in a canonical direction so both polygons of an arc (and
+    # every tile) simplify it the same way. Coordinates are pixel
+    # corners of the whole segmentation.
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.arcs = {}
+        self.exact = set()
+
+    def Add(self, arc, closed=False):
+        # Returns (key, forward) of the arc
+        first = (tuple(arc[0]), tuple(arc[1]))
+        last = (tuple(arc[-1]), tuple(arc[-2]))
+        forward = first <= last
+        key = first if forward else last
+        if key not in self.arcs:
+            canon = arc if forward else arc[::-1]
+            exact = Corners(canon)
+            if closed:
+                # Split a ring with no nodes at its furthest point
+                far = int(np.argmax(np.abs(exact - exact[0]).sum(axis=1)))
+                simple = np.concatenate((DouglasPeucker(exact[:far + 1], self.tolerance), DouglasPeucker(exact[far:], self.tolerance)[1:]))
+                if len(simple) < 4:
+                    simple = exact
+            else:
+                simple = DouglasPeucker(exact, self.tolerance)
+            self.arcs[key] = (exact, simple)
+        return key, forward
+
+    def Get(self, key, forward):
+        exact, simple = self.arcs[key]
+        arc = exact if key in self.exact else simple
+        return arc if forward else arc[::-1]
+
+
+def ForeignPixels(lbl, ids):
+    # Pixels of clumps of other tiles (not labelled in lbl, but neither
+    # background nor off the raster), padded by one pixel as ids
+    labelled = np.zeros(ids.shape, dtype=bool)
+    labelled[1:-1, 1:-1] = lbl != 0
+    return (~labelled) & (ids != 0) & (ids != OUTSIDE)
+
+
+def BordersForeign(arc, foreign):
+    # True if the arc (pixel corners of the window) is the boundary
+    # with a foreign clump. Both sides of an arc are the same two
+    # clumps all along it, so only its first edge is looked at.
+    (x0, y0), (x1, y1) = arc[0], arc[1]
+    if y0 == y1:
+        # Pixels above and below the edge (indexes padded by one)
+        col = min(x0, x1) + 1
+        return bool(foreign[y0, col] or foreign[y0 + 1, col])
+    row = min(y0, y1) + 1
+    return bool(foreign[row, x0] or foreign[row, x0 + 1])
+
+
+def SplitRing(ring, nodes, offset, cache, foreign=None):
+    # Cut a closed ring (pixel corners of the window) at the nodes and
+    # add its arcs to the cache, keeping the arcs bordering a foreign
+    # pixel (if given) exact. Returns the (key, forward) of each arc in
+    # order around the ring.
+    dense = Densify(ring)
+    is_node = nodes[dense[:-1, 1], dense[:-1, 0]]
+    idx = np.flatnonzero(is_node)
+    if idx.size == 0:
+        # No nodes: start at the smallest corner (always a corner) in
+        # a canonical direction
+        pts = dense[:-1]
+        start = int(np.lexsort((pts[:, 0], pts[:, 1]))[0])
+        loops = [np.concatenate((pts[start:], pts[:start], pts[start:start + 1]))]
+    else:
+        # Start at the first node so arcs do not wrap around the ring end
+        pts = dense[:-1]
+        loop = np.concatenate((pts[idx[0]:], pts[:idx[0]], pts[idx[0]:idx[0] + 1]))
+        cuts = np.append(idx - idx[0], len(pts))
+        loops = [loop[cuts[k]:cuts[k + 1] + 1] for k in range(len(cuts) - 1)]
+    refs = []
+    for arc in loops:
+        key, forward = cache.Add(arc + offset, closed=(idx.size == 0))
+        if (foreign is not None) and BordersForeign(arc, foreign):
+            cache.exact.add(key)
+        refs.append((key, forward))
+    return refs
+
+
+def JoinRing(refs, cache):
+    # The ring made from its arcs, closed
+    parts = [cache.Get(key, forward) for key, forward in refs]
+    return np.concatenate([parts[0]] + [part[1:] for part in parts[1:]])
+
+
+def PolygonWKB(rings, geotransform):
+    # WKB polygon of rings of pixel corners of the segmentation
+    wkb = [struct.pack('<BII', 1, 3, len(rings))]
+    for ring in rings:
+        xy = np.empty((len(ring), 2), dtype='<f8')
+        xy[:, 0] = geotransform[0] + ring[:, 0] * geotransform[1]
+        xy[:, 1] = geotransform[3] + ring[:, 1] * geotransform[5]
+        wkb.append(struct.pack('<I', len(ring)))
+        wkb.append(xy.tobytes())
+    return b''.join(wkb)
+
+
+def PixelPolygons(lbl):
+    # Exact polygons of the labels (not 0) in pixel corner coordinates:
+    # a list of (label, [rings as integer (x, y) arrays])
+    height, width = lbl.shape
+    memDataset = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_UInt32)
+    memDataset.SetGeoTransform((0, 1, 0, 0, 0, 1))
+    memBand = memDataset.GetRasterBand(1)
+    memBand.WriteArray(lbl)
+    vecDataset = ogr.GetDriverByName('Memory').CreateDataSource('')
+    veclyr = vecDataset.CreateLayer('lbl', None, ogr.wkbPolygon)
+    veclyr.CreateField(ogr.FieldDefn('PXLVAL', ogr.OFTInteger))
+    gdal.Polygonize(memBand, memBand, veclyr, 0, [], callback=None)
+    polygons = []
+    for feat in veclyr:
+        geom = feat.GetGeometryRef()
+        rings = [np.rint(np.array(geom.GetGeometryRef(i).GetPoints())[:, :2]).astype(np.int64) for i in range(geom.GetGeometryCount())]
+        polygons.append((feat.GetField('PXLVAL'), rings))
+    vecDataset = None
+    memDataset = None
+    return polygons
+
+
+def IsValid(rings):
+    return ogr.CreateGeometryFromWkb(PolygonWKB(rings, (0, 1, 0, 0, 0, 1))).IsValid()
+
+
+def Orient(a, b, c):
+    # Sign of the turn a -> b -> c (integer pixel corners, so exact)
+    return np.sign((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0]))
+
+
+def OnSegment(p, a, b):
+    # p (collinear with a, b) lies within the segment a-b
+    return (np.minimum(a[:, 0], b[:, 0]) <= p[:, 0]) & (p[:, 0] <= np.maximum(a[:, 0], b[:, 0])) & \
+           (np.minimum(a[:, 1], b[:, 1]) <= p[:, 1]) & (p[:, 1] <= np.maximum(a[:, 1], b[:, 1]))
+
+
+def CrossingArcs(arcs, cell=16):
+    # Indexes of the arcs (list of (n, 2) integer arrays) which cross
+    # or overlap another arc or themselves, touching only at shared
+    # end points being allowed. Segments are only tested against those
+    # in the same grid cells of cell pixels.
+    if not arcs:
+        return set()
+    lengths = np.array([len(arc) - 1 for arc in arcs])
+    pts = np.concatenate(arcs)
+    ends = np.cumsum(lengths + 1)
+    seg_start = np.concatenate([np.arange(e - n - 1, e - 1) for e, n in zip(ends, lengths)])
+    a = pts[seg_start]
+    b = pts[seg_start + 1]
+    arc_id = np.repeat(np.arange(len(arcs)), lengths)
+    seg_id = seg_start - np.repeat(ends - lengths - 1, lengths)
+    closed = np.array([np.array_equal(arc[0], arc[-1]) for arc in arcs])
+
+    # Every grid cell touched by the bbox of each segment
+    c0 = np.minimum(a, b) // cell
+    c1 = np.maximum(a, b) // cell
+    ncx = c1[:, 0] - c0[:, 0] + 1
+    ncells = ncx * (c1[:, 1] - c0[:, 1] + 1)
+    seg = np.repeat(np.arange(len(a)), ncells)
+    k = np.arange(seg.size) - np.repeat(np.cumsum(ncells) - ncells, ncells)
+    cx = c0[seg, 0] + k % ncx[seg]
+    cy = c0[seg, 1] + k // ncx[seg]
+    cell_id = (cx - cx.min()) * (cy.max() - cy.min() + 1) + (cy - cy.min())
+    order = np.lexsort((seg, cell_id))
+    seg = seg[order]
+    cell_id = cell_id[order]
+    # Pairs of segments in the same cell
+    first = []
+    second = []
+    d = 1
+    while d < seg.size:
+        same = cell_id[d:] == cell_id[:-d]
+        if not same.any():
+            break
+        first.append(seg[:-d][same])
+        second.append(seg[d:][same])
+        d += 1
+    if not first:
+        return set()
+    i = np.concatenate(first)
+    j = np.concatenate(second)
+    pair = np.unique(i * len(a) + j)
+    i = pair // len(a)
+    j = pair % len(a)
+    # Neighbouring segments of an arc always share an end point
+    same_arc = arc_id[i] == arc_id[j]
+    gap = np.abs(seg_id[i] - seg_id[j])
+    adjacent = same_arc & ((gap == 1) | (closed[arc_id[i]] & (gap == lengths[arc_id[i]] - 1)))
+    i = i[~adjacent]
+    j = j[~adjacent]
+    if i.size == 0:
+        return set()
+
+    p1, p2, q1, q2 = a[i], b[i], a[j], b[j]
+    d1 = Orient(q1, q2, p1)
+    d2 = Orient(q1, q2, p2)
+    d3 = Orient(p1, p2, q1)
+    d4 = Orient(p1, p2, q2)
+    proper = (d1 * d2 < 0) & (d3 * d4 < 0)
+
+    def IsEnd(p, s, t):
+        return np.all(p == s, axis=1) | np.all(p == t, axis=1)
+
+    # An end point on the other segment is only allowed where it is
+    # also an end point of the other segment (a shared node or vertex)
+    touch = ((d1 == 0) & OnSegment(p1, q1, q2) & ~IsEnd(p1, q1, q2)) | \
+            ((d2 == 0) & OnSegment(p2, q1, q2) & ~IsEnd(p2, q1, q2)) | \
+            ((d3 == 0) & OnSegment(q1, p1, p2) & ~IsEnd(q1, p1, p2)) | \
+            ((d4 == 0) & OnSegment(q2, p1, p2) & ~IsEnd(q2, p1, p2))
+    # Collinear segments sharing more than a point (e.g. the same two
+    # end points)
+    collinear = (d1 == 0) & (d2 == 0)
+    axis = (np.abs(p2 - p1)[:, 0] < np.abs(p2 - p1)[:, 1]).astype(np.int64)
+    rows = np.arange(i.size)
+    lo = np.maximum(np.minimum(p1[rows, axis], p2[rows, axis]), np.minimum(q1[rows, axis], q2[rows, axis]))
+    hi = np.minimum(np.maximum(p1[rows, axis], p2[rows, axis]), np.maximum(q1[rows, axis], q2[rows, axis]))
+    overlap = collinear & (hi > lo)
+    bad = proper | touch | overlap
+    return set(arc_id[i[bad]].tolist()) | set(arc_id[j[bad]].tolist())
+
+
+def SimplifyPolygons(polygons, nodes, offset, tolerance, is_valid=IsValid, foreign=None):
+    # Simplify the (label, rings) polygons with shared arcs. offset is
+    # (x, y) of the window in the segmentation. Returns the rings of
+    # each polygon (in the segmentation's pixel corners).
+    # Arcs bordering the foreign pixels (ForeignPixels) are kept exact.
+    # Arcs are reverted to exact until every polygon is valid and no
+    # two arcs of the window cross or overlap, so the polygons of the
+    # window tile it without gaps or overlaps.
+    cache = ArcCache(tolerance)
+    offset = np.asarray(offset, dtype=np.int64)
+    refs = [[SplitRing(ring, nodes, offset, cache, foreign) for ring in rings] for label, rings in polygons]
+    users = {}
+    for i, poly in enumerate(refs):
+        for ring in poly:
+            for key, forward in ring:
+                users.setdefault(key, set()).add(i)
+
+    out = [None] * len(refs)
+    check = range(len(refs))
+    while True:
+        reverted = set()
+        for i in check:
+            out[i] = [JoinRing(ring, cache) for ring in refs[i]]
+            keys = set(key for ring in refs[i] for key, forward in ring)
+            if (not keys <= cache.exact) and ((min(len(r) for r in out[i]) < 4) or (not is_valid(out[i]))):
+                reverted |= keys - cache.exact
+        if not reverted:
+            # Simplified arcs crossing their neighbours (or themselves)
+            # or the exact arcs
+            keys = list(users)
+            crossing = CrossingArcs([cache.Get(key, True) for key in keys])
+            reverted = set(keys[k] for k in crossing) - cache.exact
+        if not reverted:
+            return out
+        # Use the exact arcs of the invalid polygons in all their users
+        cache.exact |= reverted
+        check = sorted(set(i for key in reverted for i in users[key]))
+
+
+def PolygoniseSimplified(lbl, ids, geotransform, offset, veclyr, tolerance):
+    # Write the polygons of the labels lbl (0 = none) into veclyr
+    # (with a PXLVAL field). ids: the clump IDs around lbl, padded by
+    # one pixel (ReadPadded). geotransform: of the segmentation, whose
+    # pixel (x, y) offset is lbl[0, 0]. Returns the number of vertices
+    # before and after.
+    polygons = PixelPolygons(lbl)
+    nodes = NodeGrid(ids)
+    rings = SimplifyPolygons(polygons, nodes, offset, tolerance, foreign=ForeignPixels(lbl, ids))
+    before = sum(len(r) for label, poly in polygons for r in poly)
+    after = sum(len(r) for poly in rings for r in poly)
+    lyrDefn = veclyr.GetLayerDefn()
+    veclyr.StartTransaction()
+    for (label, poly), simple in zip(polygons, rings):
+        feat = ogr.Feature(lyrDefn)
+        feat.SetGeometryDirectly(ogr.CreateGeometryFromWkb(PolygonWKB(simple, geotransform)))
+        feat.SetField('PXLVAL', int(label))
+        veclyr.CreateFeature(feat)
+    veclyr.CommitTransaction()
+    return before, after
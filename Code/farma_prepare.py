@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# A single block-wise pass over a KEA segmentation which gathers
+# everything 1_CreateRegGrid.py needs for the FARMA workflow: the
+# pixel count, the spatial extent and the mode regular grid cell
+# (tile) of every clump. The grid cell of each pixel is computed from
+# its row/column so no regular grid image is written or read, and the
+# RAT columns are all written once at the end.
+
+import numpy as np
+import osgeo.gdal as gdal
+from rios import rat
+
+# Target number of pixels read per strip of rows
+STRIP_PIXELS = 16 * 1024 * 1024
+# Number of (clump, cell) pairs held before they are consolidated
+MAX_PAIRS = 8 * 1024 * 1024
+
+
+def GridCells(rows, cols, tilesize, ncellx):
+    # Regular grid cell IDs (from 1, row by row) of the given pixels,
+    # matching rsgislib.segmentation.generate_regular_grid
+    return (rows // tilesize) * ncellx + (cols // tilesize) + 1
+
+
+def StripRows(band, xsize):
+    # Rows read at a time: whole blocks, roughly STRIP_PIXELS pixels
+    bh = band.GetBlockSize()[1]
+    return max(1, STRIP_PIXELS // (xsize * bh)) * bh
+
+
+def Grow(arrays, size):
+    # Grow the per clump arrays (by at least double) to hold size rows
+    if size <= arrays['count'].size:
+        return arrays
+    newsize = max(size, 2 * arrays['count'].size)
+    grown = {}
+    for name, arr in arrays.items():
+        fill = np.iinfo(arr.dtype).max if name.startswith('min') else 0
+        if name.startswith('max'):
+            fill = -1
+        grown[name] = np.full(newsize, fill, dtype=arr.dtype)
+        grown[name][:arr.size] = arr
+    return grown
+
+
+def ConsolidatePairs(pair_keys, pair_counts):
+    # Sum the pixel counts of repeated (clump, cell) pair keys
+    keys = np.concatenate(pair_keys)
+    counts = np.concatenate(pair_counts)
+    keys, inv = np.unique(keys, return_inverse=True)
+    return [keys], [np.bincount(inv, weights=counts).astype(np.int64)]
+
+
+def ScanClumps(segs, tilesize=None):
+    # Read the segmentation once, strip by strip, and gather per clump
+    # (ID > 0) pixel counts, extents (in pixels) and, if a tilesize is
+    # given, the histogram of regular grid cells each clump falls in.
+    # Returns a dict of per clump arrays indexed by clump ID (and the
+    # geotransform).
+    segDataset = gdal.Open(segs, gdal.GA_ReadOnly)
+    segBand = segDataset.GetRasterBand(1)
+    xsize, ysize = segDataset.RasterXSize, segDataset.RasterYSize
+    nrows = StripRows(segBand, xsize)
+    if tilesize:
+        ncellx = int(np.ceil(xsize / float(tilesize)))
+        ncells = ncellx * int(np.ceil(ysize / float(tilesize)))
+
+    # Extents are kept as combined keys so the min/max column also
+    # records the position of that pixel along the other axis, as
+    # rsgislib.rastergis.clumps_spatial_extent does (ties go to the
+    # first pixel in row order)
+    arrays = {'count': np.zeros(0, dtype=np.int64),
+              'mincol': np.zeros(0, dtype=np.int64),
+              'maxcol': np.zeros(0, dtype=np.int64),
+              'minrow': np.zeros(0, dtype=np.int64),
+              'maxrow': np.zeros(0, dtype=np.int64)}
+    pair_keys = []
+    pair_counts = []
+    npairs = 0
+
+    cols_all = np.arange(xsize, dtype=np.int64)
+    for yoff in range(0, ysize, nrows):
+        h = min(nrows, ysize - yoff)
+        clumps = segBand.ReadAsArray(0, yoff, xsize, h).ravel()
+        pxl = np.flatnonzero(clumps)
+        if pxl.size == 0:
+            continue
+        clumps = clumps[pxl].astype(np.int64)
+        rows = pxl // xsize + yoff
+        cols = cols_all[pxl % xsize]
+        order = np.argsort(clumps, kind='stable')
+        clumps = clumps[order]
+        rows = rows[order]
+        cols = cols[order]
+        starts = np.flatnonzero(np.diff(clumps)) + 1
+        starts = np.concatenate(([0], starts))
+        ids = clumps[starts]
+        arrays = Grow(arrays, int(ids[-1]) + 1)
+
+        arrays['count'][ids] += np.diff(np.append(starts, clumps.size))
+        # First column, then first (top) row
+        key = np.minimum.reduceat(cols * ysize + rows, starts)
+        arrays['mincol'][ids] = np.minimum(arrays['mincol'][ids], key)
+        # Last column, then first row
+        key = np.maximum.reduceat(cols * ysize + (ysize - 1 - rows), starts)
+        arrays['maxcol'][ids] = np.maximum(arrays['maxcol'][ids], key)
+        # First row, then first (left) column
+        key = np.minimum.reduceat(rows * xsize + cols, starts)
+        arrays['minrow'][ids] = np.minimum(arrays['minrow'][ids], key)
+        # Last row, then first column
+        key = np.maximum.reduceat(rows * xsize + (xsize - 1 - cols), starts)
+        arrays['maxrow'][ids] = np.maximum(arrays['maxrow'][ids], key)
+
+        if tilesize:
+            keys, counts = np.unique(clumps * ncells + GridCells(rows, cols, tilesize, ncellx) - 1, return_counts=True)
+            pair_keys.append(keys)
+            pair_counts.append(counts.astype(np.int64))
+            npairs += keys.size
+            if npairs > MAX_PAIRS:
+                pair_keys, pair_counts = ConsolidatePairs(pair_keys, pair_counts)
+                npairs = pair_keys[0].size
+    gt = segDataset.GetGeoTransform()
+    segDataset = None
+
+    nclumps = arrays['count'].size
+    found = arrays['count'] > 0
+    # Each extent as the (column, row) of the pixel
+    result = {'gt': gt, 'count': arrays['count']}
+    result['mincol'] = (np.where(found, arrays['mincol'] // ysize, 0), np.where(found, arrays['mincol'] % ysize, 0))
+    result['maxcol'] = (np.where(found, arrays['maxcol'] // ysize, 0), np.where(found, ysize - 1 - arrays['maxcol'] % ysize, 0))
+    result['minrow'] = (np.where(found, arrays['minrow'] % xsize, 0), np.where(found, arrays['minrow'] // xsize, 0))
+    result['maxrow'] = (np.where(found, xsize - 1 - arrays['maxrow'] % xsize, 0), np.where(found, arrays['maxrow'] // xsize, 0))
+
+    if tilesize:
+        result['tiles'] = np.zeros(nclumps, dtype=np.uint32)
+        if pair_keys:
+            keys, counts = ConsolidatePairs(pair_keys, pair_counts)
+            keys, counts = keys[0], counts[0]
+            # Mode cell per clump: most pixels, then smallest cell ID
+            pclump = keys // ncells
+            order = np.lexsort((keys % ncells, -counts, pclump))
+            first = np.concatenate(([True], np.diff(pclump[order]) != 0))
+            best = order[first]
+            result['tiles'][pclump[best]] = (keys[best] % ncells + 1).astype(np.uint32)
+    return result
+
+
+def ExtentColumns(scan):
+    # The clumps_spatial_extent RAT columns (MinXX, MinXY, ... MaxYY)
+    # from the scanned extents, as pixel centre coordinates
+    gt = scan['gt']
+    def Coords(colrow):
+        col, row = colrow
+        return gt[0] + (col + 0.5) * gt[1], gt[3] + (row + 0.5) * gt[5]
+    found = scan['count'] > 0
+    columns = {}
+    columns['MinXX'], columns['MinXY'] = Coords(scan['mincol'] if gt[1] > 0 else scan['maxcol'])
+    columns['MaxXX'], columns['MaxXY'] = Coords(scan['maxcol'] if gt[1] > 0 else scan['mincol'])
+    # North up images have the minimum Y on the last row
+    columns['MinYX'], columns['MinYY'] = Coords(scan['maxrow'] if gt[5] < 0 else scan['minrow'])
+    columns['MaxYX'], columns['MaxYY'] = Coords(scan['minrow'] if gt[5] < 0 else scan['maxrow'])
+    for name in columns:
+        columns[name] = np.where(found, columns[name], 0)
+    return columns
+
+
+def WriteClumpColumns(segs, scan, tiles=None):
+    # Write the Histogram, extent and (if given) tiles RAT columns
+    # in one go at the end of the scan
+    segDataset = gdal.Open(segs, gdal.GA_Update)
+    # Clump 0 is the background and is not counted (ignore_zero)
+    histogram = scan['count'].astype(np.float64)
+    if histogram.size:
+        histogram[0] = 0
+    rat.writeColumn(segDataset, "Histogram", histogram)
+    for name, values in ExtentColumns(scan).items():
+        rat.writeColumn(segDataset, name, values)
+    if tiles is not None:
+        rat.writeColumn(segDataset, "tiles", tiles)
+    segDataset = None
+
+
+def WriteModeImage(segs, tiles, out_img):
+    # Write the tile of each pixel's clump (tiles[clump]) as a 16 bit
+    # KEA image (32 bit if there are more tiles than 16 bits hold) with
+    # the geometry of the segmentation, strip by strip
+    tiles = np.asarray(tiles)
+    if tiles.size and tiles.max() > np.iinfo(np.uint16).max:
+        dtype, gdal_type = np.uint32, gdal.GDT_UInt32
+    else:
+        dtype, gdal_type = np.uint16, gdal.GDT_UInt16
+    tiles = tiles.astype(dtype)
+    segDataset = gdal.Open(segs, gdal.GA_ReadOnly)
+    segBand = segDataset.GetRasterBand(1)
+    xsize, ysize = segDataset.RasterXSize, segDataset.RasterYSize
+    driver = gdal.GetDriverByName('KEA')
+    outDataset = driver.Create(out_img, xsize, ysize, 1, gdal_type)
+    outDataset.SetGeoTransform(segDataset.GetGeoTransform())
+    outDataset.SetProjection(segDataset.GetProjection())
+    outBand = outDataset.GetRasterBand(1)
+    outBand.SetNoDataValue(0)
+    nrows = StripRows(segBand, xsize)
+    for yoff in range(0, ysize, nrows):
+        h = min(nrows, ysize - yoff)
+        clumps = segBand.ReadAsArray(0, yoff, xsize, h)
+        # Clumps past the end of the RAT have no tile
+        mode = np.zeros(clumps.shape, dtype=dtype)
+        inlut = clumps < tiles.size
+        mode[inlut] = tiles[clumps[inlut]]
+        outBand.WriteArray(mode, 0, yoff)
+    outDataset = None
+    segDataset = None
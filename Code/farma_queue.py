@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# A work queue on a shared filesystem so the tiles (script 2) or
+# GPKGs (script 3) can be processed by any number of worker processes
+# on any number of nodes. Only plain files are used (no database,
+# which is unreliable over NFS):
+#     tasks/<id>.json   the function name and arguments of each task
+#     leases/<id>       held by the worker running the task
+#     beats/<id>.<token> heartbeat of the lease with that token
+#     attempts/<id>/<version>.<n> taken by the n'th lease of a version
+#     done/<id>         the task finished
+#     failed/<id>       the task raised an error (or kept losing workers)
+# Task IDs are the keys of the units (tile, GPKG name). Submitting a
+# task again after a resume is a no-op unless its arguments changed
+# or it failed, when it is replaced with a new version and its result
+# cleared so it runs again (a worker still running the old version
+# does not record its result). A lease is written in full and
+# then linked into place, so only one worker can hold it and it is
+# never read half written. While the task runs its worker touches the
+# heartbeat file of its own lease token only, so a worker which has
+# lost its lease can never keep the next holder's lease alive. The
+# lease of a dead worker expires and the task is claimed again (the
+# node clocks are assumed to be in sync). Each holder of a lease then
+# takes the next attempt number with O_EXCL, so a task which keeps
+# killing its worker is failed even if workers race to claim it.
+# Completion is recorded with O_EXCL so each task is completed exactly
+# once; if a worker stalls past its lease the task may run twice,
+# which is safe as every output is written atomically (see
+# farma_manifest).
+
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+LEASE_SECONDS = 300
+# Times a task may lose its worker before it is failed
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 5
+
+
+def WriteNew(path, data):
+    # Create path with data, failing if it exists. Returns True if created.
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        return False
+    try:
+        os.write(fd, json.dumps(data).encode())
+    finally:
+        os.close(fd)
+    return True
+
+
+def LinkNew(path, data):
+    # Create path with data written in full first (link fails if path
+    # exists). Returns True if created.
+    tmp = os.path.join(os.path.dirname(path), '.{}.{}.{}'.format(os.path.basename(path), os.getpid(), uuid.uuid4().hex))
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    try:
+        os.link(tmp, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp)
+
+
+def ReadJSON(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class WorkQueue(object):
+
+    def __init__(self, queue_dir, lease_seconds=LEASE_SECONDS):
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        # Claim order of each task (read once from its task file)
+        self.orders = {}
+        for sub in ['tasks', 'leases', 'beats', 'attempts', 'done', 'failed']:
+            if not os.path.isdir(os.path.join(queue_dir, sub)):
+                os.makedirs(os.path.join(queue_dir, sub), exist_ok=True)
+
+    def Path(self, sub, task_id):
+        return os.path.join(self.queue_dir, sub, task_id)
+
+    def Submit(self, task_id, func, args, order=0):
+        # Add a task. task_id is the key of the unit of work. Tasks are
+        # claimed in order, then task ID order. Submitting the same
+        # task again is a no-op unless it failed (it is retried) or
+        # its function or arguments differ (it is replaced). Returns
+        # True if the task will be run.
+        task_file = self.Path('tasks', task_id + '.json')
+        task = ReadJSON(task_file)
+        if (task is not None) and (task['func'] == func) and (task['args'] == json.loads(json.dumps(args))) and not os.path.exists(self.Path('failed', task_id)):
+            return False
+        tmp = self.Path('tasks', '.{}.{}'.format(os.getpid(), task_id))
+        with open(tmp, 'w') as f:
+            json.dump({'id': task_id, 'func': func, 'args': args, 'order': order, 'version': uuid.uuid4().hex}, f)
+        os.replace(tmp, task_file)
+        self.orders.pop(task_id, None)
+        if task is not None:
+            RemoveQuietly(self.Path('done', task_id))
+            RemoveQuietly(self.Path('failed', task_id))
+            shutil.rmtree(self.Path('attempts', task_id), ignore_errors=True)
+        return True
+
+    def Version(self, task_id):
+        task = ReadJSON(self.Path('tasks', task_id + '.json'))
+        return task.get('version') if task else None
+
+    def Order(self, task_id):
+        if task_id not in self.orders:
+            task = ReadJSON(self.Path('tasks', task_id + '.json'))
+            self.orders[task_id] = task.get('order', 0) if task else 0
+        return self.orders[task_id]
+
+    def TaskIDs(self):
+        names = [name[:-len('.json')] for name in os.listdir(os.path.join(self.queue_dir, 'tasks')) if name.endswith('.json') and not name.startswith('.')]
+        return sorted(names, key=lambda task_id: (self.Order(task_id), task_id))
+
+    def Finished(self, task_id):
+        return os.path.exists(self.Path('done', task_id)) or os.path.exists(self.Path('failed', task_id))
+
+    def Claim(self, worker):
+        # Lease the first task which is not finished or leased (or
+        # whose lease has expired). Returns (task, token) or None.
+        for task_id in self.TaskIDs():
+            if self.Finished(task_id):
+                continue
+            lease_file = self.Path('leases', task_id)
+            if os.path.exists(lease_file):
+                if self.Age(task_id) < self.lease_seconds:
+                    continue
+                # Take the expired lease out of the way; only one
+                # worker's rename succeeds
+                stale = self.Path('leases', '.{}.expired.{}'.format(task_id, uuid.uuid4().hex))
+                try:
+                    os.rename(lease_file, stale)
+                except OSError:
+                    continue
+                # Read the lease actually taken (not one read before
+                # the rename, which another worker may have replaced)
+                lease = ReadJSON(stale)
+                beat = self.Path('beats', '{}.{}'.format(task_id, lease['token'])) if lease else None
+                if (lease is not None) and (time.time() - Mtime(beat, 0) < self.lease_seconds):
+                    # Renewed since it was looked at, so put it back
+                    try:
+                        os.link(stale, lease_file)
+                    except OSError:
+                        pass
+                    os.remove(stale)
+                    continue
+                os.remove(stale)
+                if beat is not None:
+                    RemoveQuietly(beat)
+                print("Lease of {} held by {} expired".format(task_id, lease['worker'] if lease else 'unknown'))
+            token = uuid.uuid4().hex
+            beat = self.Path('beats', '{}.{}'.format(task_id, token))
+            WriteNew(beat, {})
+            if not LinkNew(lease_file, {'worker': worker, 'token': token, 'start': time.time()}):
+                RemoveQuietly(beat)
+                continue
+            # The task may have finished while this worker was looking
+            if self.Finished(task_id):
+                self.Release(task_id, token)
+                continue
+            # Every earlier attempt of this version lost its worker
+            if self.Attempt(task_id) > MAX_ATTEMPTS:
+                WriteNew(self.Path('failed', task_id), {'worker': worker, 'error': 'Lost its worker {} times'.format(MAX_ATTEMPTS)})
+                self.Release(task_id, token)
+                continue
+            task = ReadJSON(self.Path('tasks', task_id + '.json'))
+            return task, token
+        return None
+
+    def Attempt(self, task_id):
+        # Take the next attempt number of the current version of a task
+        attempts_dir = self.Path('attempts', task_id)
+        os.makedirs(attempts_dir, exist_ok=True)
+        version = self.Version(task_id)
+        n = 1
+        while not WriteNew(os.path.join(attempts_dir, '{}.{}'.format(version, n)), {}):
+            n += 1
+        return n
+
+    def Age(self, task_id):
+        # Seconds since the lease of a task was last renewed (its
+        # heartbeat, or the lease itself if that has gone)
+        lease_file = self.Path('leases', task_id)
+        lease = ReadJSON(lease_file)
+        mtime = Mtime(lease_file, time.time())
+        if lease is not None:
+            mtime = Mtime(self.Path('beats', '{}.{}'.format(task_id, lease['token'])), mtime)
+        return time.time() - mtime
+
+    def Holds(self, task_id, token):
+        lease = ReadJSON(self.Path('leases', task_id))
+        return (lease is not None) and (lease['token'] == token)
+
+    def Renew(self, task_id, token):
+        # Heartbeat: returns False if the lease has been lost. Only the
+        # heartbeat of this token is touched, which whoever takes the
+        # lease removes, so a lost lease is never renewed.
+        try:
+            os.utime(self.Path('beats', '{}.{}'.format(task_id, token)))
+        except OSError:
+            return False
+        return self.Holds(task_id, token)
+
+    def Release(self, task_id, token):
+        # Move the lease aside first so a lease taken by another
+        # worker meanwhile is put back rather than removed
+        lease_file = self.Path('leases', task_id)
+        mine = self.Path('leases', '.{}.released.{}'.format(task_id, token))
+        try:
+            os.rename(lease_file, mine)
+        except OSError:
+            mine = None
+        if mine is not None:
+            lease = ReadJSON(mine)
+            if (lease is not None) and (lease['token'] != token):
+                try:
+                    os.link(mine, lease_file)
+                except OSError:
+                    pass
+            os.remove(mine)
+        RemoveQuietly(self.Path('beats', '{}.{}'.format(task_id, token)))
+
+    def Complete(self, task_id, token, worker, error=None, version=None):
+        # Record the result once (the first worker to finish wins),
+        # unless the task was replaced while it ran
+        record = {'worker': worker, 'end': time.time()}
+        if version != self.Version(task_id):
+            print("Task {} was replaced while it ran".format(task_id))
+            done = False
+        elif error is None:
+            done = WriteNew(self.Path('done', task_id), record)
+        else:
+            record['error'] = error
+            done = WriteNew(self.Path('failed', task_id), record)
+        self.Release(task_id, token)
+        return done
+
+    def Status(self):
+        # Numbers of (tasks, done, failed, leased)
+        count = lambda sub: len([name for name in os.listdir(os.path.join(self.queue_dir, sub)) if not name.startswith('.')])
+        return len(self.TaskIDs()), count('done'), count('failed'), count('leases')
+
+    def Drained(self):
+        ntasks, ndone, nfailed, nleased = self.Status()
+        return ndone + nfailed >= ntasks
+
+    def Failures(self):
+        return {name: ReadJSON(self.Path('failed', name)) for name in os.listdir(os.path.join(self.queue_dir, 'failed')) if not name.startswith('.')}
+
+
+def Mtime(path, default):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return default
+
+
+def RemoveQuietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def Heartbeat(wq, task_id, token, stop):
+    while not stop.wait(wq.lease_seconds / 3.0):
+        if not wq.Renew(task_id, token):
+            print("Lost the lease of {}".format(task_id))
+            return
+
+
+def WorkerLoop(queue_dir, funcs, lease_seconds=LEASE_SECONDS, poll=POLL_SECONDS, initializer=None, initargs=()):
+    # Claim and run tasks until every task is finished. funcs maps the
+    # function names of the tasks to the functions. initializer(*initargs)
+    # is run first, as for a multiprocessing.Pool worker.
+    if initializer is not None:
+        initializer(*initargs)
+    wq = WorkQueue(queue_dir, lease_seconds)
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    while True:
+        claimed = wq.Claim(worker)
+        if claimed is None:
+            if wq.Drained():
+                return
+            # Other workers hold the rest, which may yet expire
+            time.sleep(poll)
+            continue
+        task, token = claimed
+        stop = threading.Event()
+        beat = threading.Thread(target=Heartbeat, args=(wq, task['id'], token, stop))
+        beat.daemon = True
+        beat.start()
+        error = None
+        try:
+            funcs[task['func']](*task['args'])
+        except Exception as e:
+            error = '{}: {}\n{}'.format(type(e).__name__, e, traceback.format_exc())
+            print("Task {} failed: {}: {}".format(task['id'], type(e).__name__, e))
+        finally:
+            stop.set()
+            beat.join()
+        wq.Complete(task['id'], token, worker, error, task.get('version'))
+
+
+def RunWorkers(queue_dir, funcs, nworkers, lease_seconds=LEASE_SECONDS, poll=POLL_SECONDS, initializer=None, initargs=()):
+    # Run nworkers worker processes on this node until the queue is drained
+    procs = [multiprocessing.Process(target=WorkerLoop, args=(queue_dir, funcs, lease_seconds, poll, initializer, initargs)) for i in range(nworkers)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+
+def WaitDrained(queue_dir, poll=POLL_SECONDS, report_interval=30):
+    # Wait for workers (on any node) to finish every task. Returns the failures.
+    wq = WorkQueue(queue_dir)
+    last_report = 0
+    while not wq.Drained():
+        if (time.time() - last_report) > report_interval:
+            ntasks, ndone, nfailed, nleased = wq.Status()
+            print("Tasks: {} done, {} failed, {} running of {}".format(ndone, nfailed, nleased, ntasks))
+            last_report = time.time()
+        time.sleep(poll)
+    return wq.Failures()
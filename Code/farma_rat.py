@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Helper functions for working with the segmentation
+# raster attribute table (RAT) in the FARMA workflow.
+# Per-tile aggregates are computed with grouped
+# reductions so the RAT is only scanned once, and the
+# RAT can be streamed in row chunks so memory use does
+# not grow with the number of clumps.
+
+import numpy as np
+import osgeo.gdal as gdal
+
+# Number of RAT rows read at a time
+CHUNK_ROWS = 1000000
+
+
+def TileExtents(TileID, MinXX, MinYY, MaxXX, MaxYY):
+    # Compute the bbox and object count of every tile in one pass.
+    # Objects are sorted by tile ID once and each contiguous run of
+    # the same tile is reduced with ufunc.reduceat, rather than
+    # building a boolean mask over the whole RAT for every tile.
+    # Returns (tiles, counts, minX, maxX, minY, maxY) as arrays
+    # ordered by tile ID (the same order as np.unique(TileID)).
+    TileID = np.asarray(TileID)
+    if TileID.size == 0:
+        empty = np.array([], dtype=np.float64)
+        return TileID.copy(), np.array([], dtype=np.int64), empty, empty.copy(), empty.copy(), empty.copy()
+
+    # Tile IDs are small integers, so sort them as 16 bit where
+    # possible which lets numpy use a linear time radix sort
+    if np.issubdtype(TileID.dtype, np.integer) and TileID.min() >= 0 and TileID.max() < 65536:
+        order = np.argsort(TileID.astype(np.uint16), kind='stable')
+    else:
+        order = np.argsort(TileID)
+    sorted_ids = TileID[order]
+    # Index of the first object of each tile in the sorted order
+    starts = np.flatnonzero(np.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1])))
+    tiles = sorted_ids[starts]
+    counts = np.diff(np.append(starts, sorted_ids.size))
+
+    minX = np.minimum.reduceat(np.asarray(MinXX)[order], starts)
+    minY = np.minimum.reduceat(np.asarray(MinYY)[order], starts)
+    maxX = np.maximum.reduceat(np.asarray(MaxXX)[order], starts)
+    maxY = np.maximum.reduceat(np.asarray(MaxYY)[order], starts)
+
+    return tiles, counts, minX, maxX, minY, maxY
+
+
+def AdaptiveTiles(cx, cy, max_objects=None, pixels=None, max_pixels=None):
+    # Assign objects to tiles with a k-d split of their centroids
+    # (cx, cy) so no tile has more than max_objects objects and/or
+    # more than max_pixels pixels (pixels: the pixel count of each
+    # object). Each tile is split in two across its longer side at
+    # the (pixel weighted) median centroid until it is within budget.
+    # Returns an array of tile IDs (1..ntiles) for every object.
+    cx = np.asarray(cx, dtype=np.float64)
+    cy = np.asarray(cy, dtype=np.float64)
+    if (max_objects is None) and (max_pixels is None):
+        raise Exception("A maximum number of objects or pixels per tile must be given")
+    if pixels is None:
+        pixels = np.ones(cx.size)
+    pixels = np.asarray(pixels, dtype=np.float64)
+
+    TileID = np.zeros(cx.size, dtype=np.uint32)
+    todo = [np.arange(cx.size)]
+    ntiles = 0
+    while todo:
+        idx = todo.pop()
+        npix = pixels[idx].sum()
+        over_objects = (max_objects is not None) and (idx.size > max_objects)
+        over_pixels = (max_pixels is not None) and (npix > max_pixels)
+        if (idx.size <= 1) or not (over_objects or over_pixels):
+            ntiles += 1
+            TileID[idx] = ntiles
+            continue
+        x = cx[idx]
+        y = cy[idx]
+        coord = x if (x.max() - x.min()) >= (y.max() - y.min()) else y
+        order = np.argsort(coord, kind='stable')
+        # Split where half of the budget being exceeded is on each side
+        if over_objects:
+            split = idx.size // 2
+        else:
+            split = int(np.searchsorted(np.cumsum(pixels[idx][order]), npix / 2.0))
+            split = min(max(split, 1), idx.size - 1)
+        todo.append(idx[order[split:]])
+        todo.append(idx[order[:split]])
+    return TileID
+
+
+def SplitTile(MinXX, MinYY, MaxXX, MaxYY, max_size=None, max_objects=None, max_pixels=None, resolution=1.0):
+    # Split the objects of an oversized tile into sub-tiles whose bbox
+    # (the union of the object extents) is under max_size map units in
+    # X and Y, with at most max_objects objects and at most max_pixels
+    # pixels (of the given resolution) in the window of the bbox, as
+    # it is read to extract the sub-tile. Sub-tiles are split in two
+    # across their longer side at the median object centre. Objects
+    # are never cut, so each object is in exactly one sub-tile and a
+    # single object over the bounds is left as a sub-tile on its own.
+    # Returns an array of sub-tile labels (0..n-1) for every object.
+    MinXX = np.asarray(MinXX, dtype=np.float64)
+    MinYY = np.asarray(MinYY, dtype=np.float64)
+    MaxXX = np.asarray(MaxXX, dtype=np.float64)
+    MaxYY = np.asarray(MaxYY, dtype=np.float64)
+    cx = (MinXX + MaxXX) / 2.0
+    cy = (MinYY + MaxYY) / 2.0
+
+    labels = np.zeros(MinXX.size, dtype=np.int64)
+    todo = [np.arange(MinXX.size)]
+    nsub = 0
+    while todo:
+        idx = todo.pop()
+        width = MaxXX[idx].max() - MinXX[idx].min()
+        height = MaxYY[idx].max() - MinYY[idx].min()
+        if (idx.size <= 1) or not TileOverBounds(idx.size, width, height, max_size, max_objects, max_pixels, resolution):
+            labels[idx] = nsub
+            nsub += 1
+            continue
+        coord = cx[idx] if width >= height else cy[idx]
+        order = np.argsort(coord, kind='stable')
+        split = idx.size // 2
+        todo.append(idx[order[split:]])
+        todo.append(idx[order[:split]])
+    return labels
+
+
+def TileOverBounds(count, width, height, max_size=None, max_objects=None, max_pixels=None, resolution=1.0):
+    # True if a tile of count objects whose bbox is width by height map
+    # units is over any of the given bounds (see SplitTile)
+    if (max_size is not None) and ((width >= max_size) or (height >= max_size)):
+        return True
+    if (max_objects is not None) and (count > max_objects):
+        return True
+    return (max_pixels is not None) and ((width / resolution) * (height / resolution) > max_pixels)
+
+
+def ReadRATChunks(segfile, columns, chunk_size=CHUNK_ROWS, band=1):
+    # Read only the given RAT columns, chunk_size rows at a time, from
+    # a dataset opened read only. Yields (start row, {column: array}).
+    # Raises a KeyError if a column is missing.
+    ratDataset = gdal.Open(segfile, gdal.GA_ReadOnly)
+    gdalrat = ratDataset.GetRasterBand(band).GetDefaultRAT()
+    colidx = {gdalrat.GetNameOfCol(i): i for i in range(gdalrat.GetColumnCount())}
+    for col in columns:
+        if col not in colidx:
+            raise KeyError("Column {} is not in the RAT of {}".format(col, segfile))
+    nrows = gdalrat.GetRowCount()
+    for start in range(0, nrows, chunk_size):
+        length = min(chunk_size, nrows - start)
+        yield start, {col: gdalrat.ReadAsArray(colidx[col], start=start, length=length) for col in columns}
+    ratDataset = None
+
+
+def RATRowCount(segfile, band=1):
+    ratDataset = gdal.Open(segfile, gdal.GA_ReadOnly)
+    nrows = ratDataset.GetRasterBand(band).GetDefaultRAT().GetRowCount()
+    ratDataset = None
+    return nrows
+
+
+def StreamTileExtents(segfile, lut_file, chunk_size=CHUNK_ROWS):
+    # TileExtents over the whole RAT, read in chunks and folded into
+    # per tile aggregates. Only the tiles, Histogram and four used
+    # extent columns are read. Objects are the clumps with pixels
+    # (the background clump 0 is not an object). The clump ID -> tile
+    # lookup (0 = no tile) is written to lut_file as a .npy file.
+    # Returns (tiles, counts, minX, maxX, minY, maxY, nobjects).
+    nrows = RATRowCount(segfile)
+    lut = np.lib.format.open_memmap(lut_file, mode='w+', dtype=np.uint32, shape=(nrows,))
+    size = 0
+    counts = np.zeros(0, dtype=np.int64)
+    minX = np.zeros(0)
+    maxX = np.zeros(0)
+    minY = np.zeros(0)
+    maxY = np.zeros(0)
+    for start, cols in ReadRATChunks(segfile, ["tiles", "Histogram", "MinXX", "MinYY", "MaxXX", "MaxYY"], chunk_size):
+        valid = cols["Histogram"] > 0
+        if start == 0:
+            valid[0] = False
+        TileID = cols["tiles"].astype(np.int64)
+        lut[start:start + TileID.size] = np.where(valid, TileID, 0)
+        tiles, ccounts, cminX, cmaxX, cminY, cmaxY = TileExtents(TileID[valid], cols["MinXX"][valid], cols["MinYY"][valid], cols["MaxXX"][valid], cols["MaxYY"][valid])
+        if tiles.size == 0:
+            continue
+        # Running aggregates indexed directly by tile ID
+        if tiles.max() >= size:
+            grow = int(tiles.max()) + 1 - size
+            counts = np.append(counts, np.zeros(grow, dtype=np.int64))
+            minX = np.append(minX, np.full(grow, np.inf))
+            minY = np.append(minY, np.full(grow, np.inf))
+            maxX = np.append(maxX, np.full(grow, -np.inf))
+            maxY = np.append(maxY, np.full(grow, -np.inf))
+            size = counts.size
+        counts[tiles] += ccounts
+        minX[tiles] = np.minimum(minX[tiles], cminX)
+        minY[tiles] = np.minimum(minY[tiles], cminY)
+        maxX[tiles] = np.maximum(maxX[tiles], cmaxX)
+        maxY[tiles] = np.maximum(maxY[tiles], cmaxY)
+    lut.flush()
+    lut = None
+    tiles = np.flatnonzero(counts)
+    return tiles, counts[tiles], minX[tiles], maxX[tiles], minY[tiles], maxY[tiles], int(counts.sum())
+
+
+def GatherTileObjects(segfile, lut_file, tiles, chunk_size=CHUNK_ROWS):
+    # Clump IDs and extents of the objects of a few tiles (e.g. those
+    # to be split), read in chunks. Returns a dict of tile ->
+    # (clump IDs, MinXX, MinYY, MaxXX, MaxYY).
+    lut = np.load(lut_file, mmap_mode='r')
+    tiles = np.asarray(sorted(tiles), dtype=np.int64)
+    parts = {int(tile): [] for tile in tiles}
+    for start, cols in ReadRATChunks(segfile, ["MinXX", "MinYY", "MaxXX", "MaxYY"], chunk_size):
+        TileID = np.asarray(lut[start:start + cols["MinXX"].size])
+        rows = np.flatnonzero(np.isin(TileID, tiles))
+        for tile in np.unique(TileID[rows]):
+            sel = rows[TileID[rows] == tile]
+            parts[int(tile)].append((sel + start, cols["MinXX"][sel], cols["MinYY"][sel], cols["MaxXX"][sel], cols["MaxYY"][sel]))
+    objects = {}
+    for tile, chunks in parts.items():
+        if chunks:
+            objects[tile] = tuple(np.concatenate(x) for x in zip(*chunks))
+    return objects
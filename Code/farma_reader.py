@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# A windowed raster reader for the populate stage of the FARMA
+# workflow. Only the window of a raster covering the objects being
+# populated is read, decoded blocks are kept in a bounded LRU cache
+# shared by consecutive GPKGs overlapping the same raster blocks, and
+# the window of the next raster can be prefetched on a background
+# thread while the current one is being reduced.
+
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import farma_zonal
+import farma_handles
+
+# Minimum size (pixels) of a cached block. Rasters stored in strips
+# have 1 row blocks, which are merged into larger cache blocks.
+MIN_BLOCK = 256
+# Prefetched windows kept waiting to be read. Older ones (e.g. of a
+# raster that was skipped) are dropped so their arrays are freed.
+MAX_PENDING = 2
+
+
+class WindowReader(object):
+
+    def __init__(self, cache_mb=512):
+        self.max_bytes = cache_mb * 1024 * 1024
+        self.nbytes = 0
+        self.blocks = collections.OrderedDict()
+        self.grids = {}
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.hits = 0
+        self.misses = 0
+
+    def Dataset(self, img):
+        # GDAL datasets must not be shared between threads, so each
+        # thread uses its own handles from the worker's pool
+        return farma_handles.OpenDataset(img)
+
+    def Grid(self, img, band):
+        # (geotransform, wkt_str, xsize, ysize, no_data_val, block size)
+        key = (img, band)
+        with self.lock:
+            if key in self.grids:
+                return self.grids[key]
+        imgDataset = self.Dataset(img)
+        imgBand = imgDataset.GetRasterBand(band)
+        bw, bh = imgBand.GetBlockSize()
+        bw = bw * int(np.ceil(MIN_BLOCK / float(bw)))
+        bh = bh * int(np.ceil(MIN_BLOCK / float(bh)))
+        grid = (imgDataset.GetGeoTransform(), imgDataset.GetProjection(), imgDataset.RasterXSize, imgDataset.RasterYSize, imgBand.GetNoDataValue(), (bw, bh))
+        with self.lock:
+            self.grids[key] = grid
+        return grid
+
+    def Block(self, img, band, bx, by):
+        key = (img, band, bx, by)
+        with self.lock:
+            if key in self.blocks:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                return self.blocks[key]
+            self.misses += 1
+        geotransform, wkt_str, xsize, ysize, no_data_val, (bw, bh) = self.Grid(img, band)
+        xoff = bx * bw
+        yoff = by * bh
+        data = self.Dataset(img).GetRasterBand(band).ReadAsArray(xoff, yoff, min(bw, xsize - xoff), min(bh, ysize - yoff))
+        with self.lock:
+            self.blocks[key] = data
+            self.nbytes += data.nbytes
+            # Evict the least recently used blocks
+            while self.nbytes > self.max_bytes and len(self.blocks) > 1:
+                oldkey, old = self.blocks.popitem(last=False)
+                self.nbytes -= old.nbytes
+        return data
+
+    def ReadNow(self, img, band, window):
+        # Assemble the window (xoff, yoff, width, height) from blocks
+        geotransform, wkt_str, xsize, ysize, no_data_val, (bw, bh) = self.Grid(img, band)
+        xoff, yoff, width, height = window
+        out = None
+        for by in range(yoff // bh, (yoff + height - 1) // bh + 1):
+            for bx in range(xoff // bw, (xoff + width - 1) // bw + 1):
+                data = self.Block(img, band, bx, by)
+                if out is None:
+                    out = np.empty((height, width), dtype=data.dtype)
+                # Overlap of the block and the window
+                x0 = max(xoff, bx * bw)
+                x1 = min(xoff + width, bx * bw + data.shape[1])
+                y0 = max(yoff, by * bh)
+                y1 = min(yoff + height, by * bh + data.shape[0])
+                out[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] = data[y0 - by * bh:y1 - by * bh, x0 - bx * bw:x1 - bx * bw]
+        return out
+
+    def Read(self, img, band, window):
+        # Read a window, waiting for a prefetch of it if one is running
+        key = (img, band, tuple(window))
+        with self.lock:
+            future = self.pending.pop(key, None)
+        if future is not None:
+            return future.result()
+        return self.ReadNow(img, band, window)
+
+    def Prefetch(self, img, band, extent):
+        # Start reading the window of the raster covering the extent
+        # (minX, maxX, minY, maxY) in the background
+        geotransform, wkt_str, xsize, ysize, no_data_val, blocksize = self.Grid(img, band)
+        window = farma_zonal.ExtentWindow(extent, geotransform, xsize, ysize)
+        if window is None:
+            return
+        key = (img, band, tuple(window))
+        with self.lock:
+            if key in self.pending:
+                return
+            # A prefetch of another window of the raster is superseded
+            for old in [k for k in self.pending if k[:2] == key[:2]]:
+                self.pending.pop(old).cancel()
+            while len(self.pending) >= MAX_PENDING:
+                self.pending.popitem(last=False)[1].cancel()
+            self.pending[key] = self.executor.submit(self.ReadFor, farma_handles.Account(), img, band, window)
+
+    def ReadFor(self, account, img, band, window):
+        # A prefetch, its dataset opens counted to the thread it is for
+        with farma_handles.Charging(account):
+            return self.ReadNow(img, band, window)
+
+
+# One reader per worker process
+_reader = None
+
+
+def GetReader(cache_mb=512):
+    global _reader
+    if _reader is None:
+        _reader = WindowReader(cache_mb)
+    return _reader
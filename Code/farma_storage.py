@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Storage of the intermediate files of 2_BoundingBoxes_Docker.py
+# (1_base_tiles/ to 5_seg_msk_lbl_tiles/). The intermediates are
+# written as compressed, chunked KEA without pyramids or colour
+# tables, and once a tile's GPKG has been checked against the object
+# count of the RAT they are removed and the GPKG is recorded in the
+# manifest as made from the tile fingerprint (farma_dirty.py), so a
+# rerun skips the tile without the intermediates. With a disk budget
+# new tiles are not started while the intermediates use most of it.
+
+import os
+import time
+import farma_manifest
+import farma_pipeline
+import farma_vector
+
+# Fraction of the budget above which no new tiles are started, so the
+# tiles already running have room to finish
+HIGH_WATER = 0.9
+# Seconds between measurements of the disk used
+CHECK_SECONDS = 2
+# KEA creation options of the intermediates
+DEFLATE = 1
+BLOCKSIZE = 256
+
+
+def SetKEAOptions(deflate=None, blocksize=None):
+    # Creation options rsgislib uses for the KEA files it writes in
+    # this process and its workers. A deflate level or block size given
+    # explicitly replaces RSGISLIB_IMG_CRT_OPTS_KEA, otherwise a value
+    # already set in the environment is kept (and the defaults used if
+    # it is not set).
+    name = 'RSGISLIB_IMG_CRT_OPTS_KEA'
+    if (deflate is None) and (blocksize is None) and (name in os.environ):
+        print("Using the KEA options of {} from the environment".format(name))
+        return os.environ[name]
+    deflate = DEFLATE if deflate is None else deflate
+    blocksize = BLOCKSIZE if blocksize is None else blocksize
+    os.environ[name] = 'IMAGEBLOCKSIZE={}:DEFLATE={}'.format(blocksize, deflate)
+    return os.environ[name]
+
+
+def KEACreationOptions():
+    # The options of SetKEAOptions as GDAL creation options, for the
+    # KEA files written with GDAL rather than rsgislib
+    value = os.environ.get('RSGISLIB_IMG_CRT_OPTS_KEA', '')
+    return [opt for opt in value.split(':') if opt]
+
+
+def DirBytes(dirs):
+    # Total size of the files in dirs (not recursive)
+    total = 0
+    for path in dirs:
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    total += entry.stat().st_size
+            except OSError:
+                # Removed since it was listed
+                pass
+    return total
+
+
+class DiskBudget(object):
+    # Bytes of the intermediate dirs against a budget, measured at
+    # most every CHECK_SECONDS
+
+    def __init__(self, budget_bytes, dirs, high_water=HIGH_WATER):
+        self.budget = budget_bytes
+        self.dirs = dirs
+        self.high_water = high_water
+        self.used = 0
+        self.peak = 0
+        self.checked = 0
+        self.waits = 0
+
+    def Used(self):
+        if (time.time() - self.checked) > CHECK_SECONDS:
+            self.used = DirBytes(self.dirs)
+            self.peak = max(self.peak, self.used)
+            self.checked = time.time()
+        return self.used
+
+    def CanStart(self):
+        # farma_pipeline.RunTilePipeline can_start
+        if self.Used() < self.high_water * self.budget:
+            return True
+        self.waits += 1
+        return False
+
+
+def VerifiedParams(count, tolerance=None):
+    # Manifest params of a checked GPKG, with its simplification
+    params = {'verified': count}
+    if tolerance is not None:
+        params['simplify'] = float(tolerance)
+    return params
+
+
+def TileComplete(out_vec, fp_file, count, tolerance=None):
+    # True if the GPKG was checked and its intermediates removed since
+    # the tile last changed (or was simplified differently)
+    return farma_manifest.IsDone(out_vec, [fp_file], VerifiedParams(count, tolerance))
+
+
+def CheckTile(tile, out_vec, fp_file, count, tolerance=None):
+    # Stage after the fingerprint: finish the tile if it is complete
+    if TileComplete(out_vec, fp_file, count, tolerance):
+        print('{} complete'.format(out_vec))
+        return farma_pipeline.TILE_DONE
+
+
+def CleanTile(tile, out_vec, layername, count, fp_file, intermediates, tolerance=None):
+    # Last stage: check the GPKG has every object of the tile, then
+    # remove the tile's intermediates. A GPKG short of objects fails
+    # the tile and keeps them to look into.
+    found = farma_vector.CountObjects(out_vec, layername)
+    if found != count:
+        raise Exception("Tile {}: {} of {} objects vectorised, keeping its intermediates".format(tile, found, count))
+    farma_manifest.MarkDone(out_vec, [fp_file], VerifiedParams(count, tolerance))
+    for path in intermediates:
+        farma_manifest.RemoveFile(path)
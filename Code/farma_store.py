@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# A columnar time-series store for the zonal statistics of the FARMA
+# objects. Rather than adding eight columns per date to every GPKG,
+# the statistics are held in one memory mapped numpy array of shape
+# (objects, dates, statistics) with the object rows of each GPKG in a
+# contiguous block, so a date can be appended by writing each GPKG's
+# block in parallel and the whole time series of an object is a single
+# contiguous read. The geometry stays in the GPKGs.
+#
+# Layout of a store directory:
+#   meta.json   statistics, dates (and which are complete), the row
+#               range, row count, key fingerprint and file fingerprint
+#               of each GPKG and the date capacity
+#   keys.npy    object key of each row (int64)
+#   key_order.npy, sorted_keys.npy  rows in key order and the sorted
+#               keys, for looking up objects with a binary search
+#   values.npy  float64 array (objects, date capacity, statistics)
+#   written.npy uint8 array (objects, date capacity), 1 once a row has
+#               been written for a date, so the dates of GPKGs which
+#               changed are recomputed for those GPKGs only
+
+import fcntl
+import hashlib
+import json
+import os
+import numpy as np
+
+STORE_STATS = ['mean', 'min', 'max', 'std', 'sum', 'count', 'mode', 'med']
+
+
+def ReadMeta(store_dir):
+    with open(os.path.join(store_dir, 'meta.json')) as f:
+        return json.load(f)
+
+
+def WriteMeta(store_dir, meta):
+    # Write then rename so the metadata is never half written
+    tmp_file = os.path.join(store_dir, 'meta.json.tmp{}'.format(os.getpid()))
+    with open(tmp_file, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_file, os.path.join(store_dir, 'meta.json'))
+
+
+def KeysFingerprint(keys):
+    return hashlib.sha1(np.ascontiguousarray(keys, dtype=np.int64).tobytes()).hexdigest()
+
+
+def GPKGEntries(gpkg_keys, sources=None):
+    # Row range, row count, key fingerprint and source file fingerprint
+    # (sources: GPKG name -> farma_manifest.Fingerprint) of each GPKG,
+    # the rows of the GPKGs being contiguous blocks in the given order
+    entries = {}
+    start = 0
+    for name, keys in gpkg_keys:
+        entries[name] = {'rows': [start, start + len(keys)], 'count': len(keys), 'keys': KeysFingerprint(keys),
+                         'source': (sources or {}).get(name)}
+        start += len(keys)
+    return entries
+
+
+def WriteKeys(store_dir, gpkg_keys):
+    keys = np.concatenate([np.asarray(keys, dtype=np.int64) for name, keys in gpkg_keys]) if gpkg_keys else np.zeros(0, dtype=np.int64)
+    np.save(os.path.join(store_dir, 'keys.npy'), keys)
+    key_order = np.argsort(keys, kind='stable')
+    np.save(os.path.join(store_dir, 'key_order.npy'), key_order)
+    np.save(os.path.join(store_dir, 'sorted_keys.npy'), keys[key_order])
+    return keys.size
+
+
+def ChangedGPKGs(meta, gpkg_keys, sources=None):
+    # GPKGs which are new or whose rows, keys or file differ from the
+    # store, and the GPKGs of the store which are gone
+    entries = GPKGEntries(gpkg_keys, sources)
+    changed = [name for name in entries if (not isinstance(meta['gpkgs'].get(name), dict)) or
+               any(meta['gpkgs'][name].get(field) != entries[name][field] for field in ['count', 'keys', 'source'])]
+    removed = [name for name in meta['gpkgs'] if name not in entries]
+    return changed, removed
+
+
+def CreateStore(store_dir, gpkg_keys, capacity=8, sources=None):
+    # gpkg_keys: list of (GPKG name, array of object keys in feature
+    # order). An existing store is reused for the GPKGs whose row count,
+    # keys and file are the same, and rebuilt for any other (e.g.
+    # regenerated by 2_BoundingBoxes_Docker.py), whose rows are
+    # invalidated.
+    if os.path.isfile(os.path.join(store_dir, 'meta.json')):
+        meta = ReadMeta(store_dir)
+        changed, removed = ChangedGPKGs(meta, gpkg_keys, sources)
+        if changed or removed:
+            meta = RebuildStore(store_dir, meta, gpkg_keys, changed, sources)
+        return meta
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    nrows = WriteKeys(store_dir, gpkg_keys)
+    values = np.lib.format.open_memmap(os.path.join(store_dir, 'values.npy'), mode='w+', dtype=np.float64, shape=(nrows, capacity, len(STORE_STATS)))
+    values.flush()
+    values = None
+    written = np.lib.format.open_memmap(os.path.join(store_dir, 'written.npy'), mode='w+', dtype=np.uint8, shape=(nrows, capacity))
+    written.flush()
+    written = None
+    meta = {'stats': STORE_STATS, 'dates': [], 'complete': [], 'gpkgs': GPKGEntries(gpkg_keys, sources), 'capacity': capacity}
+    WriteMeta(store_dir, meta)
+    return meta
+
+
+def Written(store_dir, meta, mode='r'):
+    # Whether each row has been written for each date slot (rows, date
+    # capacity). Made from the complete dates for a store without it.
+    written_file = os.path.join(store_dir, 'written.npy')
+    if not os.path.isfile(written_file):
+        nrows = np.load(os.path.join(store_dir, 'values.npy'), mmap_mode='r').shape[0]
+        written = np.lib.format.open_memmap(written_file, mode='w+', dtype=np.uint8, shape=(nrows, meta['capacity']))
+        for date in meta['complete']:
+            written[:, meta['dates'].index(date)] = 1
+        written.flush()
+        written = None
+    return np.load(written_file, mmap_mode=mode)
+
+
+def Relayout(store_dir, name, old, nrows, capacity, blocks, fill):
+    # Rewrite the array name of the store (old: its memmap) with nrows
+    # rows and capacity date slots, copying the (new start, new stop,
+    # old start, old stop) row blocks. Other rows and slots are fill.
+    tmp_file = os.path.join(store_dir, name.replace('.npy', '.tmp.npy'))
+    new = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=old.dtype, shape=(nrows, capacity) + old.shape[2:])
+    new[...] = fill
+    for start, stop, old_start, old_stop in blocks:
+        new[start:stop, :old.shape[1]] = old[old_start:old_stop]
+    new.flush()
+    new = None
+    os.replace(tmp_file, os.path.join(store_dir, name))
+
+
+def RebuildStore(store_dir, meta, gpkg_keys, changed, sources=None):
+    # New row layout for the GPKGs, copying the rows of the unchanged
+    # GPKGs. The rows of the changed GPKGs are NaN and not written, so
+    # their dates are incomplete until they have been written again.
+    print("Rebuilding the store {}: {} GPKGs changed".format(store_dir, len(changed)))
+    entries = GPKGEntries(gpkg_keys, sources)
+    nrows = sum(entry['count'] for entry in entries.values())
+    blocks = [tuple(entry['rows'] + meta['gpkgs'][name]['rows']) for name, entry in entries.items() if name not in changed]
+    old_written = Written(store_dir, meta)
+    old = np.load(os.path.join(store_dir, 'values.npy'), mmap_mode='r')
+    Relayout(store_dir, 'values.npy', old, nrows, meta['capacity'], blocks, np.nan)
+    Relayout(store_dir, 'written.npy', old_written, nrows, meta['capacity'], blocks, 0)
+    old = None
+    old_written = None
+    WriteKeys(store_dir, gpkg_keys)
+    meta['gpkgs'] = entries
+    written = Written(store_dir, meta)
+    meta['complete'] = [date for date in meta['complete'] if written[:, meta['dates'].index(date)].all()]
+    written = None
+    WriteMeta(store_dir, meta)
+    return meta
+
+
+def AddDates(store_dir, dates):
+    # Allocate a slot for each new date, doubling the date capacity
+    # (rewriting values.npy and written.npy) if it is full. Must not be
+    # run while workers are writing to the store.
+    meta = ReadMeta(store_dir)
+    new_dates = [date for date in dates if date not in meta['dates']]
+    needed = len(meta['dates']) + len(new_dates)
+    if needed > meta['capacity']:
+        capacity = meta['capacity']
+        while capacity < needed:
+            capacity *= 2
+        old_written = Written(store_dir, meta)
+        old = np.load(os.path.join(store_dir, 'values.npy'), mmap_mode='r')
+        rows = [(0, old.shape[0], 0, old.shape[0])]
+        Relayout(store_dir, 'values.npy', old, old.shape[0], capacity, rows, 0)
+        Relayout(store_dir, 'written.npy', old_written, old.shape[0], capacity, rows, 0)
+        old = None
+        old_written = None
+        meta['capacity'] = capacity
+    meta['dates'] += new_dates
+    WriteMeta(store_dir, meta)
+    return meta
+
+
+def WriteBlock(store_dir, GPKG, date, values):
+    # Write the statistics (features x STORE_STATS, in feature order)
+    # of one GPKG for one date. Each GPKG has its own rows, so blocks
+    # can be written by many processes at once. The rows are marked
+    # written once their values are flushed.
+    meta = ReadMeta(store_dir)
+    start, stop = meta['gpkgs'][GPKG.split('/')[-1]]['rows']
+    didx = meta['dates'].index(date)
+    store = np.load(os.path.join(store_dir, 'values.npy'), mmap_mode='r+')
+    store[start:stop, didx, :] = values
+    store.flush()
+    store = None
+    written = Written(store_dir, meta, 'r+')
+    written[start:stop, didx] = 1
+    written.flush()
+    written = None
+
+
+def PendingDates(store_dir, dates):
+    # The dates (of those given) still to be written for each GPKG of
+    # the store: new dates and those of GPKGs rebuilt since
+    meta = ReadMeta(store_dir)
+    written = Written(store_dir, meta)
+    pending = {}
+    for name, entry in meta['gpkgs'].items():
+        start, stop = entry['rows']
+        pending[name] = [date for date in dates if (date not in meta['dates']) or (not written[start:stop, meta['dates'].index(date)].all())]
+    return pending
+
+
+def MarkComplete(store_dir, date):
+    # Locked, as dates may be completed by several workers at once. A
+    # date is only complete once every row has been written for it.
+    with open(os.path.join(store_dir, 'meta.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        meta = ReadMeta(store_dir)
+        if not Written(store_dir, meta)[:, meta['dates'].index(date)].all():
+            print("{}: not every object has been written for {}".format(store_dir, date))
+            return
+        if date not in meta['complete']:
+            meta['complete'].append(date)
+        WriteMeta(store_dir, meta)
+
+
+def CompleteDates(store_dir):
+    if not os.path.isfile(os.path.join(store_dir, 'meta.json')):
+        return []
+    return ReadMeta(store_dir)['complete']
+
+
+def ReadObject(store_dir, key):
+    # Time series of an object: (dates, array of shape (rows, dates,
+    # statistics)). An object split into several polygons has a row
+    # per polygon.
+    meta = ReadMeta(store_dir)
+    key_order = np.load(os.path.join(store_dir, 'key_order.npy'), mmap_mode='r')
+    sorted_keys = np.load(os.path.join(store_dir, 'sorted_keys.npy'), mmap_mode='r')
+    rows = np.sort(key_order[np.searchsorted(sorted_keys, key, side='left'):np.searchsorted(sorted_keys, key, side='right')])
+    store = np.load(os.path.join(store_dir, 'values.npy'), mmap_mode='r')
+    didx = [meta['dates'].index(date) for date in meta['complete']]
+    return meta['complete'], np.asarray(store[rows][:, didx, :])
+
+
+def ReadStat(store_dir, stat):
+    # One statistic for every object and complete date: (keys, dates,
+    # array of shape (objects, dates))
+    meta = ReadMeta(store_dir)
+    keys = np.load(os.path.join(store_dir, 'keys.npy'), mmap_mode='r')
+    store = np.load(os.path.join(store_dir, 'values.npy'), mmap_mode='r')
+    didx = [meta['dates'].index(date) for date in meta['complete']]
+    return np.asarray(keys), meta['complete'], np.asarray(store[:, didx, meta['stats'].index(stat)])
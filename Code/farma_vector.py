@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Helper functions for reading and updating the FARMA vector
+# outputs (GPKGs) in place, and for merging the per tile outputs
+# into a single spatially indexed GPKG which replaces them, skipping
+# those merged since they last changed on a rerun.
+
+import os
+import queue
+import threading
+import uuid
+import numpy as np
+import farma_manifest
+from osgeo import ogr
+from osgeo import osr
+
+# Layer metadata item with the ID of a merged GPKG (MergedVectorWriter)
+MERGE_ID = 'FARMA_MERGE_ID'
+# Suffixes of the per date statistics columns written by 3_PopulatePolys.py
+STAT_SUFFIXES = ['_mean', '_min', '_max', '_std', '_sum', '_count', '_mode', '_med']
+
+
+def ExistingDates(vec_file, layername):
+    # Dates which already have every statistics column in the layer
+    vecDataset = ogr.Open(vec_file)
+    veclyr = vecDataset.GetLayerByName(layername)
+    lyrDefn = veclyr.GetLayerDefn()
+    names = set(lyrDefn.GetFieldDefn(i).GetName() for i in range(lyrDefn.GetFieldCount()))
+    vecDataset = None
+    dates = set(name[:-len('_mean')] for name in names if name.endswith('_mean'))
+    return set(date for date in dates if all((date + suffix) in names for suffix in STAT_SUFFIXES))
+
+
+def AppendColumns(vec_file, layername, srclyr, fields):
+    # Add the fields of srclyr (a layer with the same features, by FID,
+    # as the GPKG layer, e.g. an in-memory copy of its source) as new
+    # columns of the GPKG layer. The new columns and every row are
+    # written in one transaction, so an append cut short leaves the
+    # GPKG as it was. Where GDAL can update only some fields of a
+    # feature (UpdateFeature, GDAL >= 3.7) the geometry is neither read
+    # nor rewritten.
+    vecDataset = ogr.Open(vec_file, 1)
+    veclyr = vecDataset.GetLayerByName(layername)
+    partial = hasattr(veclyr, 'UpdateFeature')
+    vecDataset.StartTransaction()
+    try:
+        lyrDefn = veclyr.GetLayerDefn()
+        for fld in fields:
+            if lyrDefn.GetFieldIndex(fld) < 0:
+                veclyr.CreateField(ogr.FieldDefn(fld, ogr.OFTReal))
+        lyrDefn = veclyr.GetLayerDefn()
+        indices = [lyrDefn.GetFieldIndex(fld) for fld in fields]
+        if partial:
+            veclyr.SetIgnoredFields(['OGR_GEOMETRY'])
+        nfeats = 0
+        srclyr.ResetReading()
+        for srcfeat in srclyr:
+            feat = veclyr.GetFeature(srcfeat.GetFID())
+            if feat is None:
+                raise Exception("{} has no feature {} of the source layer".format(vec_file, srcfeat.GetFID()))
+            for i, fld in zip(indices, fields):
+                feat.SetField(i, srcfeat.GetField(fld))
+            if partial:
+                veclyr.UpdateFeature(feat, indices, [], False)
+            else:
+                veclyr.SetFeature(feat)
+            nfeats += 1
+        srclyr.ResetReading()
+        if nfeats != veclyr.GetFeatureCount():
+            raise Exception("{} has {} features but the source layer has {}".format(vec_file, veclyr.GetFeatureCount(), nfeats))
+    except Exception:
+        vecDataset.RollbackTransaction()
+        vecDataset = None
+        raise
+    vecDataset.CommitTransaction()
+    vecDataset = None
+
+
+def CountObjects(vec_file, layername, field='PXLVAL'):
+    # Number of distinct objects (values of field) in a layer
+    vecDataset = ogr.Open(vec_file)
+    result = vecDataset.ExecuteSQL('SELECT COUNT(DISTINCT "{}") FROM "{}"'.format(field, layername))
+    count = result.GetNextFeature().GetField(0)
+    vecDataset.ReleaseResultSet(result)
+    vecDataset = None
+    return count
+
+
+def CountObjectsByTile(vec_file, layername, field='PXLVAL'):
+    # Number of distinct objects (values of field) of each TILE in a
+    # merged layer
+    vecDataset = ogr.Open(vec_file)
+    result = vecDataset.ExecuteSQL('SELECT "TILE", COUNT(DISTINCT "{}") FROM "{}" GROUP BY "TILE"'.format(field, layername))
+    counts = {}
+    for feat in result:
+        counts[feat.GetField(0)] = feat.GetField(1)
+    vecDataset.ReleaseResultSet(result)
+    vecDataset = None
+    return counts
+
+
+class MergedVectorWriter(object):
+    # Streams per tile GPKGs into one GPKG layer as tiles finish. All
+    # writing is done by a single background thread of the main
+    # process, so the pool workers never wait on each other or on the
+    # merged file. Features are written in batched transactions and
+    # the spatial index (and an index on TILE) is built once at the
+    # end. Every feature gets the TILE it came from and, if a clump
+    # ID -> tile lookup is given, GLOBALID: the clump ID of the object
+    # in the segmentation, which is stable between runs.
+    # The merged GPKG is kept between runs. Once the features of a
+    # tile GPKG are committed, a marker of it (MergedMarker) is
+    # recorded in the manifest with the inputs it was made from and
+    # the merge ID of the merged GPKG, so a rerun skips the tiles
+    # merged since they last changed (IsMerged). A tile added again
+    # replaces its features. A tile GPKG added with remove=True is
+    # only the hand-off from its worker and is removed once its marker
+    # is recorded.
+
+    def __init__(self, out_file, wkt_str, lut_file=None, batch_size=50000):
+        self.out_file = out_file
+        self.layername = os.path.basename(out_file).replace('.gpkg', '')
+        self.wkt_str = wkt_str
+        self.lut_file = lut_file
+        self.batch_size = batch_size
+        self.tile_clumps = None
+        self.nfeatures = 0
+        self.keep_tiles = None
+        # Merge ID of the GPKG left by an earlier run, if any (a new
+        # GPKG gets a new ID, so no earlier marker matches it)
+        self.merge_id = MergeID(out_file, self.layername)
+        self.fresh = self.merge_id is None
+        if self.fresh:
+            self.merge_id = uuid.uuid4().hex
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.Run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Add(self, tile, vec_file, layername, remove=False, inputs=(), params=None):
+        # inputs and params: those vec_file was made from and with
+        self.queue.put((tile, vec_file, layername, remove, inputs, params))
+
+    def IsMerged(self, vec_file, inputs=(), params=None):
+        return IsMerged(vec_file, inputs, self.out_file, self.merge_id, params)
+
+    def Close(self, tiles=None):
+        # Features of tiles not in tiles (if given) are removed
+        if tiles is not None:
+            self.keep_tiles = set(int(float(tile)) for tile in tiles)
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        print("Merged {} features into {}".format(self.nfeatures, self.out_file))
+
+    def ClumpIDs(self, tile):
+        if self.lut_file is None:
+            return None
+        if self.tile_clumps is None:
+            self.tile_clumps = TileClumps(self.lut_file)
+        return ClumpIDsOfTile(self.tile_clumps, tile)
+
+    def Open(self):
+        # The merged layer, created (with its merge ID) if new
+        if not self.fresh:
+            outDataset = ogr.Open(self.out_file, 1)
+            outlyr = outDataset.GetLayerByName(self.layername)
+            outDataset.ExecuteSQL('CREATE INDEX IF NOT EXISTS "{0}_tile_idx" ON "{0}" ("TILE")'.format(self.layername))
+            return outDataset, outlyr
+        farma_manifest.RemoveFile(self.out_file)
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(self.wkt_str)
+        outDataset = ogr.GetDriverByName('GPKG').CreateDataSource(self.out_file)
+        outlyr = outDataset.CreateLayer(self.layername, srs, ogr.wkbPolygon, options=['SPATIAL_INDEX=NO'])
+        outlyr.SetMetadataItem(MERGE_ID, self.merge_id)
+        outlyr.CreateField(ogr.FieldDefn('GLOBALID', ogr.OFTInteger64))
+        outlyr.CreateField(ogr.FieldDefn('TILE', ogr.OFTInteger))
+        return outDataset, outlyr
+
+    def Committed(self, merged):
+        # Record the markers of the tiles whose features are committed
+        for vec_file, remove, inputs, params in merged:
+            marker = MergedMarker(vec_file)
+            open(marker, 'w').close()
+            farma_manifest.MarkDone(marker, inputs, MergeParams(self.out_file, self.merge_id, params))
+            if remove:
+                farma_manifest.RemoveFile(vec_file)
+        del merged[:]
+
+    def Run(self):
+        finished = False
+        try:
+            outDataset, outlyr = self.Open()
+            outDefn = outlyr.GetLayerDefn()
+            inbatch = 0
+            merged = []
+            outlyr.StartTransaction()
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    finished = True
+                    break
+                tile, vec_file, layername, remove, inputs, params = item
+                if not self.fresh:
+                    # Replace the features of the tile from an earlier run
+                    outDataset.ExecuteSQL('DELETE FROM "{}" WHERE "TILE" = {}'.format(self.layername, int(float(tile))))
+                clumps = self.ClumpIDs(tile)
+                vecDataset = ogr.Open(vec_file)
+                veclyr = vecDataset.GetLayerByName(layername)
+                inDefn = veclyr.GetLayerDefn()
+                names = [inDefn.GetFieldDefn(i).GetName() for i in range(inDefn.GetFieldCount())]
+                for i, name in enumerate(names):
+                    if outDefn.GetFieldIndex(name) < 0:
+                        outlyr.CreateField(inDefn.GetFieldDefn(i))
+                        outDefn = outlyr.GetLayerDefn()
+                for feat in veclyr:
+                    outFeat = ogr.Feature(outDefn)
+                    outFeat.SetGeometry(feat.GetGeometryRef())
+                    for name in names:
+                        outFeat.SetField(name, feat.GetField(name))
+                    outFeat.SetField('TILE', int(float(tile)))
+                    if (clumps is not None) and ('PXLVAL' in names):
+                        outFeat.SetField('GLOBALID', int(clumps[feat.GetField('PXLVAL') - 1]))
+                    outlyr.CreateFeature(outFeat)
+                    self.nfeatures += 1
+                    inbatch += 1
+                    if inbatch >= self.batch_size:
+                        outlyr.CommitTransaction()
+                        self.Committed(merged)
+                        outlyr.StartTransaction()
+                        inbatch = 0
+                vecDataset = None
+                merged.append((vec_file, remove, inputs, params))
+            if (self.keep_tiles is not None) and not self.fresh:
+                # Tiles which no longer exist
+                result = outDataset.ExecuteSQL('SELECT DISTINCT "TILE" FROM "{}"'.format(self.layername))
+                stale = [feat.GetField(0) for feat in result]
+                outDataset.ReleaseResultSet(result)
+                for tile in stale:
+                    if tile not in self.keep_tiles:
+                        outDataset.ExecuteSQL('DELETE FROM "{}" WHERE "TILE" = {}'.format(self.layername, int(tile)))
+            outlyr.CommitTransaction()
+            self.Committed(merged)
+            result = outDataset.ExecuteSQL("SELECT HasSpatialIndex('{}', '{}')".format(self.layername, outlyr.GetGeometryColumn()))
+            indexed = result.GetNextFeature().GetField(0)
+            outDataset.ReleaseResultSet(result)
+            if not indexed:
+                outDataset.ExecuteSQL("SELECT CreateSpatialIndex('{}', '{}')".format(self.layername, outlyr.GetGeometryColumn()))
+            outDataset.ExecuteSQL('CREATE INDEX IF NOT EXISTS "{0}_tile_idx" ON "{0}" ("TILE")'.format(self.layername))
+            outDataset = None
+        except Exception as e:
+            self.error = e
+            # Keep draining so producers are never blocked
+            while not finished:
+                finished = self.queue.get() is None
+
+
+def MergeID(out_file, layername):
+    # Merge ID of a merged GPKG, or None if there is none
+    if not os.path.isfile(out_file):
+        return None
+    outDataset = ogr.Open(out_file)
+    outlyr = outDataset.GetLayerByName(layername) if outDataset is not None else None
+    merge_id = outlyr.GetMetadataItem(MERGE_ID) if outlyr is not None else None
+    outDataset = None
+    return merge_id
+
+
+def MergeParams(out_file, merge_id, params=None):
+    return {'merged': os.path.abspath(out_file), 'merge_id': merge_id, 'params': params}
+
+
+def MergedMarker(vec_file):
+    # Empty file recorded in the manifest once vec_file is merged
+    return os.path.splitext(vec_file)[0] + '.merged'
+
+
+def IsMerged(vec_file, inputs, out_file, merge_id, params=None):
+    # True if vec_file, made from the inputs as they are now with the
+    # same params, was merged into the merged GPKG with this merge ID
+    return farma_manifest.IsDone(MergedMarker(vec_file), inputs, MergeParams(out_file, merge_id, params))
+
+
+def TileClumps(lut_file):
+    # Clump IDs grouped by tile from a clump ID -> tile lookup
+    lut = np.load(lut_file, mmap_mode='r')
+    order = np.argsort(lut, kind='stable')
+    return order, np.asarray(lut)[order]
+
+
+def ClumpIDsOfTile(tile_clumps, tile):
+    # Clump IDs of a tile in ascending order, which is the order of
+    # the relabelled PXLVAL values (1..n)
+    order, sorted_lut = tile_clumps
+    tile = int(float(tile))
+    start = np.searchsorted(sorted_lut, tile, side='left')
+    end = np.searchsorted(sorted_lut, tile, side='right')
+    return order[start:end]
+
+
+def ObjectKeys(vec_file, layername, tile, tile_clumps=None):
+    # Key of every feature of a tile GPKG (in feature order): the
+    # clump ID of the object if the tile clumps (TileClumps) are
+    # given, otherwise the tile and PXLVAL packed as tile << 32 | PXLVAL
+    vecDataset = ogr.Open(vec_file)
+    veclyr = vecDataset.GetLayerByName(layername)
+    veclyr.SetIgnoredFields(['OGR_GEOMETRY'])
+    pxlvals = np.array([feat.GetField('PXLVAL') for feat in veclyr], dtype=np.int64)
+    vecDataset = None
+    if tile_clumps is not None:
+        return ClumpIDsOfTile(tile_clumps, tile)[pxlvals - 1].astype(np.int64)
+    return (np.int64(int(float(tile))) << 32) | pxlvals
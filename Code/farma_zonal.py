@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# A raster based zonal statistics engine for 3_PopulatePolys.py.
+# The polygons of a layer are rasterized once onto the grid of the
+# raster being summarised and every statistic is then computed for
+# all of the objects together with grouped (sort/bincount) numpy
+# reductions, rather than testing polygons against pixel points
+# one feature at a time. Median and mode are exact by default, which
+# needs every pixel of the window held and sorted. With sketch_bins
+# the window is instead read and rasterized in strips of rows, each
+# strip being added to a ZoneSketch and then dropped, so only one
+# strip and a bounded sketch per object are held (see ZoneSketch for
+# the error bound).
+
+import numpy as np
+import osgeo.gdal as gdal
+from osgeo import ogr
+import farma_handles
+
+# Order of the statistics returned by ZonalStatsArrays
+STATS = ['min', 'max', 'mean', 'std', 'sum', 'count', 'mode', 'median']
+
+# Temporary field used to burn the zone of each feature
+ZONE_FIELD = 'FARMA_ZID'
+
+# Default number of histogram bins per object for the approximate
+# median and mode
+SKETCH_BINS = 256
+# Pixels added to a ZoneSketch at a time (the rows of a strip)
+SKETCH_STRIP_PX = 1 << 18
+# Block entries held before they are merged into a ZoneSketch
+SKETCH_PENDING = 1 << 18
+# Bin exponent of a zone not yet seen
+UNSET = np.iinfo(np.int64).min
+
+
+def ZonalStatsArrays(zones, values, nzones, out_no_data_val=0, weights=None):
+    # zones: integer array of zone IDs (1..nzones, 0 = no zone)
+    # values: array of pixel values the same shape as zones, with
+    # pixels that should be excluded already given zone 0
+    # Returns a dict of arrays of length nzones + 1 (index = zone ID)
+    # matching numpy min, max, mean, std, sum, size, median and the
+    # smallest most common value (as scipy.stats.mode) per zone.
+    # Zones with no valid pixels get out_no_data_val (count of 0).
+    # weights: optional fraction of each pixel covered by its zone;
+    # count, sum, mean and std are then area weighted and median and
+    # mode are the weighted median and the value with most weight.
+    zones = np.asarray(zones).ravel()
+    values = np.asarray(values).ravel()
+    valid = zones > 0
+    z = zones[valid].astype(np.int64)
+    v = values[valid].astype(np.float64)
+    if weights is None:
+        w = np.ones(z.size)
+    else:
+        w = np.asarray(weights).ravel()[valid].astype(np.float64)
+
+    count = np.bincount(z, weights=w, minlength=nzones + 1)
+    has = count > 0
+    stats = {name: np.full(nzones + 1, out_no_data_val, dtype=np.float64) for name in STATS}
+    stats['count'] = count
+    if z.size == 0:
+        return stats
+
+    # Sum, mean and (two pass) population standard deviation
+    zsum = np.bincount(z, weights=w * v, minlength=nzones + 1)
+    mean = np.zeros(nzones + 1)
+    mean[has] = zsum[has] / count[has]
+    sqdev = np.bincount(z, weights=w * (v - mean[z]) ** 2, minlength=nzones + 1)
+    stats['sum'][has] = zsum[has]
+    stats['mean'][has] = mean[has]
+    stats['std'][has] = np.sqrt(sqdev[has] / count[has])
+
+    # Sort by zone then value so each zone is a sorted run
+    order = np.lexsort((v, z))
+    z = z[order]
+    v = v[order]
+    w = w[order]
+    starts = np.flatnonzero(np.concatenate(([True], z[1:] != z[:-1])))
+    ends = np.append(starts[1:], z.size) - 1
+    ids = z[starts]
+    stats['min'][ids] = v[starts]
+    stats['max'][ids] = v[ends]
+    if weights is None:
+        lower = starts + (ends - starts) // 2
+        upper = starts + (ends - starts + 1) // 2
+        stats['median'][ids] = (v[lower] + v[upper]) / 2.0
+    else:
+        # First value at which the cumulative weight of the zone
+        # reaches half of the zone's total weight
+        cumw = np.cumsum(w)
+        before = np.concatenate(([0.0], cumw))[starts]
+        target = before + count[ids] / 2.0
+        stats['median'][ids] = v[np.minimum(np.searchsorted(cumw, target), ends)]
+
+    # Mode: the run of equal values with the most weight (the longest
+    # run if unweighted) in each zone, ties going to the smallest
+    # value (runs are already in value order)
+    run_starts = np.flatnonzero(np.concatenate(([True], (z[1:] != z[:-1]) | (v[1:] != v[:-1]))))
+    run_weight = np.add.reduceat(w, run_starts)
+    run_zone = z[run_starts]
+    run_order = np.lexsort((-run_weight, run_zone))
+    run_zone_sorted = run_zone[run_order]
+    first = np.concatenate(([True], run_zone_sorted[1:] != run_zone_sorted[:-1]))
+    best = run_order[first]
+    stats['mode'][run_zone[best]] = v[run_starts[best]]
+
+    return stats
+
+
+def ReduceBins(z, k, w, v):
+    # Merge the entries (zone, bin key, weight, smallest value) of the
+    # same zone and bin, sorted by zone then bin
+    order = np.lexsort((k, z))
+    z = z[order]
+    k = k[order]
+    starts = np.flatnonzero(np.concatenate(([True], (z[1:] != z[:-1]) | (k[1:] != k[:-1]))))
+    return z[starts], k[starts], np.add.reduceat(w[order], starts), np.minimum.reduceat(v[order], starts)
+
+
+class ZoneSketch(object):
+    # The statistics of ZonalStatsArrays from blocks of pixels added
+    # one at a time, in memory bounded by the number of zones rather
+    # than the pixels. Count, sum, mean and std are merged block by
+    # block (Chan et al.) and min and max are exact. Median and mode
+    # come from a sparse histogram of at most bins entries per zone.
+    # The bins of a zone are 2**e wide, e starting at the precision of
+    # its values (2**-53 of the largest magnitude, or whole values for
+    # integer rasters) and only growing while the zone has more than
+    # bins distinct bins. A bin is represented by its smallest value,
+    # so a zone with at most bins distinct values has an exact
+    # median and mode. Otherwise the median is within one bin width,
+    # less than 2 * (max - min) / (bins - 2), of the exact median and
+    # the mode is the bin with most weight. The sketch holds at most
+    # bins entries of 32 bytes per zone (fewer for zones with fewer
+    # distinct values) plus up to SKETCH_PENDING entries of blocks not
+    # yet merged.
+
+    def __init__(self, nzones, bins=SKETCH_BINS, weighted=False):
+        self.nzones = nzones
+        self.bins = bins
+        self.weighted = weighted
+        self.integer = None
+        self.count = np.zeros(nzones + 1)
+        self.sum = np.zeros(nzones + 1)
+        self.mean = np.zeros(nzones + 1)
+        self.m2 = np.zeros(nzones + 1)
+        self.lo = np.full(nzones + 1, np.inf)
+        self.hi = np.full(nzones + 1, -np.inf)
+        self.exp = np.full(nzones + 1, UNSET, dtype=np.int64)
+        self.entries = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0))
+        self.pending = []
+        self.npending = 0
+
+    def Add(self, zones, values, weights=None):
+        # zones and values as for ZonalStatsArrays (excluded pixels
+        # already given zone 0)
+        zones = np.asarray(zones).ravel()
+        values = np.asarray(values).ravel()
+        valid = zones > 0
+        z = zones[valid].astype(np.int64)
+        if z.size == 0:
+            return
+        if self.integer is None:
+            self.integer = np.issubdtype(values.dtype, np.integer)
+        v = values[valid].astype(np.float64)
+        if weights is None:
+            w = np.ones(z.size)
+        else:
+            w = np.asarray(weights).ravel()[valid].astype(np.float64)
+        size = self.nzones + 1
+
+        # Merge the count, mean and squared deviations of the block
+        n = np.bincount(z, weights=w, minlength=size)
+        has = n > 0
+        zsum = np.bincount(z, weights=w * v, minlength=size)
+        mean = np.zeros(size)
+        mean[has] = zsum[has] / n[has]
+        m2 = np.bincount(z, weights=w * (v - mean[z]) ** 2, minlength=size)
+        total = self.count + n
+        frac = np.zeros(size)
+        frac[has] = n[has] / total[has]
+        delta = mean - self.mean
+        self.m2 += m2 + delta ** 2 * self.count * frac
+        self.mean += delta * frac
+        self.count = total
+        self.sum += zsum
+        np.minimum.at(self.lo, z, v)
+        np.maximum.at(self.hi, z, v)
+
+        # Bins at least as wide as the precision of the values
+        if self.integer:
+            need = np.zeros(size, dtype=np.int64)
+        else:
+            mag = np.zeros(size)
+            np.maximum.at(mag, z, np.abs(v))
+            need = np.frexp(mag)[1].astype(np.int64) - 53
+        need[~has] = UNSET
+        if ((need > self.exp) & (self.exp != UNSET)).any():
+            # Wider bins for zones already sketched
+            self.Compress()
+            exp = np.maximum(self.exp, need)
+            shift = np.where(self.exp == UNSET, 0, exp - self.exp)
+            ez, k, ew, es = self.entries
+            self.entries = ReduceBins(ez, k >> shift[ez], ew, es)
+        self.exp = np.maximum(self.exp, need)
+        k = np.floor(np.ldexp(v, -self.exp[z])).astype(np.int64)
+        block = ReduceBins(z, k, w, v)
+        self.pending.append(block)
+        self.npending += block[0].size
+        if self.npending > max(SKETCH_PENDING, self.entries[0].size):
+            self.Compress()
+
+    def Compress(self):
+        # Merge the pending entries into the sketch, widening the bins
+        # of any zone left with more than bins of them
+        parts = [self.entries] + self.pending
+        z, k, w, v = [np.concatenate([part[i] for part in parts]) for i in range(4)]
+        self.pending = []
+        self.npending = 0
+        while True:
+            z, k, w, v = ReduceBins(z, k, w, v)
+            over = np.bincount(z, minlength=self.nzones + 1) > self.bins
+            if not over.any():
+                break
+            starts = np.flatnonzero(np.concatenate(([True], z[1:] != z[:-1])))
+            ends = np.append(starts[1:], z.size) - 1
+            span = np.zeros(self.nzones + 1)
+            span[z[starts]] = k[ends] - k[starts] + 1
+            shift = np.zeros(self.nzones + 1, dtype=np.int64)
+            shift[over] = np.maximum(1, np.ceil(np.log2(span[over] / self.bins))).astype(np.int64)
+            self.exp[over] += shift[over]
+            k = k >> shift[z]
+        self.entries = (z, k, w, v)
+
+    def Stats(self, out_no_data_val=0):
+        # Dict of arrays as returned by ZonalStatsArrays
+        self.Compress()
+        count = self.count
+        has = count > 0
+        stats = {name: np.full(self.nzones + 1, out_no_data_val, dtype=np.float64) for name in STATS}
+        stats['count'] = count.copy()
+        stats['sum'][has] = self.sum[has]
+        stats['mean'][has] = self.mean[has]
+        stats['std'][has] = np.sqrt(np.maximum(self.m2[has], 0) / count[has])
+        stats['min'][has] = self.lo[has]
+        stats['max'][has] = self.hi[has]
+        z, k, w, value = self.entries
+        if z.size == 0:
+            return stats
+        starts = np.flatnonzero(np.concatenate(([True], z[1:] != z[:-1])))
+        ends = np.append(starts[1:], z.size) - 1
+        ids = z[starts]
+        cumw = np.cumsum(w)
+        before = np.concatenate(([0.0], cumw))[starts]
+        if self.weighted:
+            # First bin at which the cumulative weight reaches half
+            target = before + count[ids] / 2.0
+            stats['median'][ids] = value[np.minimum(np.searchsorted(cumw, target), ends)]
+        else:
+            # Bins holding the lower and upper middle values
+            n = np.rint(count[ids])
+            lower = np.minimum(np.searchsorted(cumw, before + (n - 1) // 2, side='right'), ends)
+            upper = np.minimum(np.searchsorted(cumw, before + n // 2, side='right'), ends)
+            stats['median'][ids] = (value[lower] + value[upper]) / 2.0
+        # Bin with the most weight, ties to the smallest
+        order = np.lexsort((-w, z))
+        first = np.concatenate(([True], z[order][1:] != z[order][:-1]))
+        stats['mode'][z[order][first]] = value[order][first]
+        return stats
+
+
+def SketchZonalStats(veclyr, nzones, input_img, img_band, geotransform, wkt_str, window, minthresh, maxthresh, no_data_val=None, out_no_data_val=0, bins=SKETCH_BINS, reader=None):
+    # ZonalStatsArrays of the window with the median and mode sketched
+    # (ZoneSketch), rasterizing and reading it a strip of rows at a
+    # time. Only the features over each strip are burned.
+    sketch = ZoneSketch(nzones, bins)
+    xoff, yoff, width, height = window
+    rows = max(1, SKETCH_STRIP_PX // width)
+    minX = geotransform[0] + xoff * geotransform[1]
+    maxX = minX + width * geotransform[1]
+    for row in range(yoff, yoff + height, rows):
+        strip = (xoff, row, width, min(rows, yoff + height - row))
+        top = geotransform[3] + row * geotransform[5]
+        bottom = top + strip[3] * geotransform[5]
+        veclyr.SetSpatialFilterRect(minX, min(top, bottom), maxX, max(top, bottom))
+        zones = RasterizeZones(veclyr, geotransform, wkt_str, strip)
+        values = ReadWindow(input_img, img_band, strip, reader)
+        sketch.Add(ValidPixels(zones, values, minthresh, maxthresh, no_data_val), values)
+    veclyr.SetSpatialFilter(None)
+    return sketch.Stats(out_no_data_val)
+
+
+def LayerWindow(veclyr, geotransform, xsize, ysize):
+    # Pixel window (xoff, yoff, width, height) of the raster covering
+    # the extent of the layer, clipped to the raster. None if the
+    # layer does not overlap the raster.
+    return ExtentWindow(veclyr.GetExtent(), geotransform, xsize, ysize)
+
+
+def ExtentWindow(extent, geotransform, xsize, ysize):
+    # As LayerWindow for a (minX, maxX, minY, maxY) extent
+    minX, maxX, minY, maxY = extent
+    xoff = int(np.floor((minX - geotransform[0]) / geotransform[1]))
+    xend = int(np.ceil((maxX - geotransform[0]) / geotransform[1]))
+    yoff = int(np.floor((maxY - geotransform[3]) / geotransform[5]))
+    yend = int(np.ceil((minY - geotransform[3]) / geotransform[5]))
+    xoff = max(xoff, 0)
+    yoff = max(yoff, 0)
+    xend = min(xend, xsize)
+    yend = min(yend, ysize)
+    if (xend <= xoff) or (yend <= yoff):
+        return None
+    return xoff, yoff, xend - xoff, yend - yoff
+
+
+def NumberZones(veclyr):
+    # Give every feature a zone ID (1..n) in the temporary zone field
+    # Returns the list of feature IDs in zone order
+    if veclyr.GetLayerDefn().GetFieldIndex(ZONE_FIELD) < 0:
+        veclyr.CreateField(ogr.FieldDefn(ZONE_FIELD, ogr.OFTInteger))
+    fids = []
+    veclyr.ResetReading()
+    veclyr.StartTransaction()
+    for feat in veclyr:
+        fids.append(feat.GetFID())
+        feat.SetField(ZONE_FIELD, len(fids))
+        veclyr.SetFeature(feat)
+    veclyr.CommitTransaction()
+    veclyr.ResetReading()
+    return fids
+
+
+def RemoveZones(veclyr):
+    idx = veclyr.GetLayerDefn().GetFieldIndex(ZONE_FIELD)
+    if idx >= 0:
+        veclyr.DeleteField(idx)
+
+
+def RasterizeZones(veclyr, geotransform, wkt_str, window):
+    # Burn the zone ID of each feature onto the raster window. As with
+    # the point-in-polygon test, a pixel belongs to a polygon if its
+    # centre falls inside it.
+    xoff, yoff, width, height = window
+    memDataset = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_UInt32)
+    memDataset.SetGeoTransform((geotransform[0] + xoff * geotransform[1], geotransform[1], 0, geotransform[3] + yoff * geotransform[5], 0, geotransform[5]))
+    memDataset.SetProjection(wkt_str)
+    gdal.RasterizeLayer(memDataset, [1], veclyr, options=['ATTRIBUTE={}'.format(ZONE_FIELD)])
+    zones = memDataset.GetRasterBand(1).ReadAsArray()
+    memDataset = None
+    return zones
+
+
+def ValidPixels(zones, values, minthresh, maxthresh, no_data_val=None):
+    # Exclude pixels outside of the thresholds (exclusive, as in
+    # rsgislib.zonalstats), non finite values and the image no data
+    valid = (zones > 0) & np.isfinite(values) & (values > minthresh) & (values < maxthresh)
+    if no_data_val is not None:
+        valid &= values != no_data_val
+    return np.where(valid, zones, 0)
+
+
+def WriteZonalStats(veclyr, fids, stats, fields):
+    # fields: dict of statistic name -> output field name (or None)
+    fields = {name: fld for name, fld in fields.items() if fld is not None}
+    lyrDefn = veclyr.GetLayerDefn()
+    for name, fld in fields.items():
+        if lyrDefn.GetFieldIndex(fld) < 0:
+            veclyr.CreateField(ogr.FieldDefn(fld, ogr.OFTReal))
+    veclyr.StartTransaction()
+    for zone, fid in enumerate(fids, start=1):
+        feat = veclyr.GetFeature(fid)
+        for name, fld in fields.items():
+            feat.SetField(fld, float(stats[name][zone]))
+        veclyr.SetFeature(feat)
+    veclyr.CommitTransaction()
+
+
+def RasterGrid(input_img, img_band, reader=None):
+    # (geotransform, wkt_str, xsize, ysize, no_data_val) of a raster band
+    if reader is not None:
+        return reader.Grid(input_img, img_band)[:5]
+    imgDataset = farma_handles.OpenDataset(input_img)
+    return (imgDataset.GetGeoTransform(), imgDataset.GetProjection(), imgDataset.RasterXSize, imgDataset.RasterYSize, imgDataset.GetRasterBand(img_band).GetNoDataValue())
+
+
+def ReadWindow(input_img, img_band, window, reader=None):
+    # Read a (xoff, yoff, width, height) window of a raster band,
+    # through the reader (farma_reader.WindowReader) if given
+    if reader is not None:
+        return reader.Read(input_img, img_band, window)
+    return farma_handles.OpenDataset(input_img).GetRasterBand(img_band).ReadAsArray(*window)
+
+
+def CalcZonalBandStats(veclyr, input_img, img_band, minthresh, maxthresh, out_no_data_val=0, min_field=None, max_field=None, mean_field=None, stddev_field=None, sum_field=None, count_field=None, mode_field=None, median_field=None, reader=None, sketch_bins=None):
+    # Drop in replacement for rsgislib.zonalstats.calc_zonal_band_stats_test_poly_pts
+    fids = NumberZones(veclyr)
+    geotransform, wkt_str, xsize, ysize, no_data_val = RasterGrid(input_img, img_band, reader)
+    window = LayerWindow(veclyr, geotransform, xsize, ysize)
+    if (window is not None) and sketch_bins:
+        stats = SketchZonalStats(veclyr, len(fids), input_img, img_band, geotransform, wkt_str, window, minthresh, maxthresh, no_data_val, out_no_data_val, sketch_bins, reader)
+    else:
+        if window is None:
+            zones = np.zeros((1, 1), dtype=np.uint32)
+            values = np.zeros((1, 1))
+        else:
+            zones = RasterizeZones(veclyr, geotransform, wkt_str, window)
+            values = ReadWindow(input_img, img_band, window, reader)
+            zones = ValidPixels(zones, values, minthresh, maxthresh, no_data_val)
+        stats = ZonalStatsArrays(zones, values, len(fids), out_no_data_val)
+    fields = {'min': min_field, 'max': max_field, 'mean': mean_field, 'std': stddev_field, 'sum': sum_field, 'count': count_field, 'mode': mode_field, 'median': median_field}
+    RemoveZones(veclyr)
+    WriteZonalStats(veclyr, fids, stats, fields)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Tests of the crash safe outputs (farma_manifest.py): an output is
+# only done while it and its inputs match the manifest with the same
+# parameters, a partial output never appears under its final name,
+# and the temporary files of dead processes are swept.
+
+import json
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code'))
+import farma_manifest
+
+
+def Write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def Touch(path, mtime_ns):
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_is_done(tmp_path):
+    src = str(tmp_path / 'in.kea')
+    out = str(tmp_path / 'out.gpkg')
+    Write(src, 'input')
+    Write(out, 'output')
+    assert not farma_manifest.IsDone(out, [src], {'simplify': 1.0})
+    farma_manifest.MarkDone(out, [src], {'simplify': 1.0})
+    assert farma_manifest.IsDone(out, [src], {'simplify': 1.0})
+    # Other parameters or inputs
+    assert not farma_manifest.IsDone(out, [src], {'simplify': 2.0})
+    assert not farma_manifest.IsDone(out, [src, out], {'simplify': 1.0})
+    assert not farma_manifest.IsDone(out, [], {'simplify': 1.0})
+    # Read back from the file rather than the cache of this process
+    assert farma_manifest.IsDone(out, [src], {'simplify': 1.0}, reload=True)
+
+
+def test_not_done_once_changed(tmp_path):
+    src = str(tmp_path / 'in.kea')
+    out = str(tmp_path / 'out.gpkg')
+    Write(src, 'input')
+    Write(out, 'output')
+    farma_manifest.MarkDone(out, [src])
+    # An input rewritten with the same size within the same second
+    Touch(src, os.stat(src).st_mtime_ns + 1000)
+    assert not farma_manifest.IsDone(out, [src])
+    farma_manifest.MarkDone(out, [src])
+    assert farma_manifest.IsDone(out, [src])
+    # The output changed or removed
+    Write(out, 'changed')
+    assert not farma_manifest.IsDone(out, [src])
+    farma_manifest.MarkDone(out, [src])
+    os.remove(src)
+    assert not farma_manifest.IsDone(out, [src])
+    os.remove(out)
+    assert not farma_manifest.IsDone(out, [])
+
+
+def test_manifest_cut_short(tmp_path):
+    out = str(tmp_path / 'out.gpkg')
+    Write(out, 'output')
+    farma_manifest.MarkDone(out)
+    # The last record of a killed worker, cut short
+    record = {'output': 'other.gpkg', 'fingerprint': None, 'inputs': {}, 'params': None}
+    with open(farma_manifest.ManifestFile(out), 'a') as f:
+        f.write(json.dumps(record)[:20])
+    assert farma_manifest.IsDone(out, reload=True)
+    assert farma_manifest.Record(str(tmp_path / 'other.gpkg'), reload=True) is None
+
+
+def test_atomic_output(tmp_path):
+    out = str(tmp_path / 'out.gpkg')
+    with farma_manifest.AtomicOutput(out) as tmp:
+        assert os.path.dirname(tmp) == os.path.dirname(out)
+        Write(tmp, 'first')
+        assert not os.path.exists(out)
+    assert open(out).read() == 'first'
+    assert os.listdir(str(tmp_path)) == ['out.gpkg']
+
+
+def test_atomic_output_failed(tmp_path):
+    out = str(tmp_path / 'out.gpkg')
+    Write(out, 'first')
+    with pytest.raises(ValueError):
+        with farma_manifest.AtomicOutput(out) as tmp:
+            Write(tmp, 'partial')
+            raise ValueError('killed')
+    # The earlier output is kept and the partial one removed
+    assert open(out).read() == 'first'
+    assert os.listdir(str(tmp_path)) == ['out.gpkg']
+
+
+def test_sweep_tmp(tmp_path):
+    out = str(tmp_path / 'out.gpkg')
+    live = farma_manifest.TmpPath(out)
+    Write(live, 'running')
+    # A PID above the kernel limit is never running
+    dead = str(tmp_path / '.tmp{}_{}.out2.gpkg'.format(2**22 + 1, farma_manifest.HOST))
+    other_node = str(tmp_path / '.tmp{}_othernode.out3.gpkg'.format(2**22 + 1))
+    Write(dead, 'killed')
+    Write(other_node, 'elsewhere')
+    assert farma_manifest.SweepTmp([str(tmp_path), str(tmp_path / 'missing')]) == 1
+    assert sorted(os.listdir(str(tmp_path))) == sorted(os.path.basename(x) for x in [live, other_node])
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Tests of the schedulers (farma_pipeline.py) with a pool of worker
+# processes: each tile goes through its stages in order and a started
+# tile is finished before new tiles are begun, each group is merged
+# once all of its units are done and ahead of the remaining units,
+# and a failure stops only its own tile or group.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code'))
+import farma_pipeline
+
+
+def Record(log_file, name):
+    # Append a line per task run (O_APPEND, so the workers' lines
+    # never interleave)
+    fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, (name + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+def Runs(log_file):
+    if not os.path.isfile(log_file):
+        return []
+    with open(log_file) as f:
+        return f.read().split()
+
+
+def Stage(log_file, name, fail=False, result=None):
+    Record(log_file, name)
+    if fail:
+        raise ValueError(name)
+    return result
+
+
+def Other(log_file, name):
+    Record(log_file, 'other.' + name)
+
+
+def TileStages(log_file, fail=(), done=()):
+    # Stages a, b and c of each tile, failing at b for the tiles in
+    # fail and finishing at a for the tiles in done
+    return [('a', Stage, lambda tile: (log_file, tile + '.a', False, farma_pipeline.TILE_DONE if tile in done else None)),
+            ('b', Stage, lambda tile: (log_file, tile + '.b', tile in fail)),
+            ('c', Stage, lambda tile: (log_file, tile + '.c'))]
+
+
+def test_tile_stages_in_order(tmp_path):
+    log_file = str(tmp_path / 'runs.txt')
+    finished = []
+    failed = farma_pipeline.RunTilePipeline(['1', '2', '3'], TileStages(log_file), 1, on_done=finished.append)
+    assert failed == []
+    # One worker: each tile is finished before the next is begun
+    assert Runs(log_file) == ['1.a', '1.b', '1.c', '2.a', '2.b', '2.c', '3.a', '3.b', '3.c']
+    assert finished == ['1', '2', '3']
+
+
+def test_tile_stages_in_order_parallel(tmp_path):
+    log_file = str(tmp_path / 'runs.txt')
+    tiles = [str(tile) for tile in range(20)]
+    finished = []
+    failed = farma_pipeline.RunTilePipeline(tiles, TileStages(log_file), 4, on_done=finished.append)
+    assert failed == []
+    runs = Runs(log_file)
+    assert sorted(runs) == sorted(tile + '.' + name for tile in tiles for name in 'abc')
+    for tile in tiles:
+        assert runs.index(tile + '.a') < runs.index(tile + '.b') < runs.index(tile + '.c')
+    assert sorted(finished) == sorted(tiles)
+
+
+def test_tile_failure(tmp_path):
+    log_file = str(tmp_path / 'runs.txt')
+    finished = []
+    failed = farma_pipeline.RunTilePipeline(['1', '2', '3'], TileStages(log_file, fail=['2']), 2, on_done=finished.append)
+    # Tile 2 stops at its failed stage, the others are finished
+    assert [(tile, name) for tile, name, err in failed] == [('2', 'b')]
+    assert isinstance(failed[0][2], ValueError)
+    assert sorted(Runs(log_file)) == ['1.a', '1.b', '1.c', '2.a', '2.b', '3.a', '3.b', '3.c']
+    assert sorted(finished) == ['1', '3']
+
+
+def test_tile_done(tmp_path):
+    log_file = str(tmp_path / 'runs.txt')
+    finished = []
+    failed = farma_pipeline.RunTilePipeline(['1', '2'], TileStages(log_file, done=['2']), 2, on_done=finished.append)
+    # Tile 2 is finished after its first stage
+    assert failed == []
+    assert sorted(Runs(log_file)) == ['1.a', '1.b', '1.c', '2.a']
+    assert sorted(finished) == ['1', '2']
+
+
+def test_units_merged_once_done(tmp_path):
+    log_file = str(tmp_path / 'runs.txt')
+    # Group x has the costliest unit, z has no units
+    units = [('x', 5, (log_file, 'x.1')), ('x', 1, (log_file, 'x.2')), ('y', 3, (log_file, 'y.1')), ('y', 2, (log_file, 'y.2'))]
+    merges = {group: (log_file, group + '.merge') for group in 'xyz'}
+    merged = []
+    failed = farma_pipeline.RunUnitsWithMerge(units, Stage, Stage, merges, 1, on_done=merged.append)
+    assert failed == []
+    # One worker: units by cost, each merge ahead of the units left
+    assert Runs(log_file) == ['z.merge', 'x.1', 'y.1', 'y.2', 'y.merge', 'x.2', 'x.merge']
+    assert merged == ['z', 'y', 'x']
+
+
+def test_units_failure(tmp_path):
+    log_file = str(tmp_path / 'runs.txt')
+    units = [('x', 2, (log_file, 'x.1')), ('x', 1, (log_file, 'x.2', True)), ('y', 1, (log_file, 'y.1'))]
+    merges = {group: (log_file, group + '.merge') for group in 'xy'}
+    merged = []
+    failed = farma_pipeline.RunUnitsWithMerge(units, Stage, Stage, merges, 2, on_done=merged.append)
+    # Group x has a failed unit so is not merged, y is
+    assert [(group, args) for group, args, err in failed] == [('x', (log_file, 'x.2', True))]
+    assert sorted(Runs(log_file)) == ['x.1', 'x.2', 'y.1', 'y.merge']
+    assert merged == ['y']
+
+
+def test_merge_failure(tmp_path):
+    log_file = str(tmp_path / 'runs.txt')
+    units = [('x', 1, (log_file, 'x.1')), ('y', 1, (log_file, 'y.1'))]
+    merges = {'x': (log_file, 'x.merge', True), 'y': (log_file, 'y.merge')}
+    merged = []
+    failed = farma_pipeline.RunUnitsWithMerge(units, Stage, Stage, merges, 2, on_done=merged.append)
+    assert [(group, args) for group, args, err in failed] == [('x', 'merge')]
+    assert sorted(Runs(log_file)) == ['x.1', 'x.merge', 'y.1', 'y.merge']
+    assert merged == ['y']
+
+
+def test_unit_and_merge_funcs(tmp_path):
+    log_file = str(tmp_path / 'runs.txt')
+    # Unit x.1 and the merge of x run Other rather than Stage
+    units = [('x', 1, (log_file, 'x.1'), Other), ('y', 1, (log_file, 'y.1'))]
+    merges = {group: (log_file, group + '.merge') for group in 'xy'}
+    failed = farma_pipeline.RunUnitsWithMerge(units, Stage, Stage, merges, 2, merge_funcs={'x': Other})
+    assert failed == []
+    assert sorted(Runs(log_file)) == ['other.x.1', 'other.x.merge', 'y.1', 'y.merge']
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Tests of the vertex reduced polygonisation (farma_polygonise.py):
+# the boundary between two fields is simplified once and used by
+# both, so their polygons still share it exactly, and a boundary with
+# a clump of another tile is not simplified.
+
+import os
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code'))
+import farma_polygonise
+
+
+def Edges(rings):
+    # Undirected edges of the rings
+    edges = set()
+    for ring in rings:
+        for a, b in zip(ring[:-1].tolist(), ring[1:].tolist()):
+            edges.add(tuple(sorted((tuple(a), tuple(b)))))
+    return edges
+
+
+def test_staircase_boundary_is_shared():
+    # Two labels either side of a one pixel staircase
+    size = 12
+    yy, xx = np.mgrid[0:size, 0:size]
+    lbl = np.where(xx < yy, 1, 2).astype(np.uint32)
+    ids = np.full((size + 2, size + 2), farma_polygonise.OUTSIDE, dtype=np.int64)
+    ids[1:-1, 1:-1] = lbl
+    nodes = farma_polygonise.NodeGrid(ids)
+    polygons = farma_polygonise.PixelPolygons(lbl)
+    rings = farma_polygonise.SimplifyPolygons(polygons, nodes, (0, 0), 1.5)
+    assert sorted(label for label, poly in polygons) == [1, 2]
+
+    # The edges both polygons have are one path between the two nodes
+    # where the staircase meets the window edge
+    shared = Edges(rings[0]) & Edges(rings[1])
+    ends = set((int(x), int(y)) for y, x in np.argwhere(nodes))
+    assert len(ends) == 2
+    degree = {}
+    for edge in shared:
+        for point in edge:
+            degree[point] = degree.get(point, 0) + 1
+    assert len(shared) == len(degree) - 1
+    assert set(point for point, n in degree.items() if n == 1) == ends
+    assert all(n <= 2 for n in degree.values())
+    # and the staircase has been simplified
+    assert len(shared) < 2 * (size - 1)
+
+
+def test_boundary_with_other_tile_is_exact():
+    # The same staircase with label 2 in another tile: the boundary is
+    # kept exact, as the other tile sees it
+    size = 12
+    yy, xx = np.mgrid[0:size, 0:size]
+    clumps = np.where(xx < yy, 1, 2)
+    ids = np.full((size + 2, size + 2), farma_polygonise.OUTSIDE, dtype=np.int64)
+    ids[1:-1, 1:-1] = clumps
+    lbl = np.where(clumps == 1, 1, 0).astype(np.uint32)
+    nodes = farma_polygonise.NodeGrid(ids)
+    polygons = farma_polygonise.PixelPolygons(lbl)
+    foreign = farma_polygonise.ForeignPixels(lbl, ids)
+    rings = farma_polygonise.SimplifyPolygons(polygons, nodes, (0, 0), 1.5, foreign=foreign)
+    exact = farma_polygonise.SimplifyPolygons(polygons, nodes, (0, 0), 0)
+    assert Edges(rings[0]) == Edges(exact[0])
+    assert len(rings[0][0]) == len(exact[0][0])
+
+
+def test_crossing_arcs():
+    arcs = [np.array([[0, 0], [4, 4]]), np.array([[0, 4], [4, 0]]), np.array([[4, 4], [8, 0]])]
+    # Arcs meeting only at a shared end point do not cross
+    assert farma_polygonise.CrossingArcs([arcs[0], arcs[2]]) == set()
+    assert farma_polygonise.CrossingArcs(arcs[:2]) == {0, 1}
+    # Two arcs between the same nodes simplified to the same segment
+    assert farma_polygonise.CrossingArcs([arcs[0], np.array([[0, 0], [2, 2], [4, 4]])]) == {0, 1}
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Tests of the work queue (farma_queue.py) with worker processes on a
+# temporary dir: every task completes exactly once, the lease of a
+# killed worker expires and its task is claimed again, a task which
+# keeps killing its worker is failed after MAX_ATTEMPTS, and a failed
+# or changed task is run again when it is submitted again.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code'))
+import farma_queue
+
+LEASE = 1
+POLL = 0.1
+
+
+def Record(log_file, task_id):
+    # Append a line per run of a task (O_APPEND, so the workers' lines
+    # never interleave)
+    fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, (task_id + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+def Runs(log_file):
+    if not os.path.isfile(log_file):
+        return []
+    with open(log_file) as f:
+        return f.read().split()
+
+
+def Work(log_file, task_id):
+    Record(log_file, task_id)
+
+
+def DieOnce(log_file, task_id):
+    # Kill the worker the first time the task runs
+    runs = Runs(log_file)
+    Record(log_file, task_id)
+    if task_id not in runs:
+        os._exit(1)
+
+
+def Die(log_file, task_id):
+    Record(log_file, task_id)
+    os._exit(1)
+
+
+def Fail(log_file, task_id):
+    Record(log_file, task_id)
+    raise ValueError(task_id)
+
+
+FUNCS = {'Work': Work, 'DieOnce': DieOnce, 'Die': Die, 'Fail': Fail}
+
+
+def Run(queue_dir, tasks, nworkers):
+    # Submit (task ID, function name, log file) tasks and run workers
+    # until the queue is drained
+    wq = farma_queue.WorkQueue(queue_dir, LEASE)
+    for order, (task_id, func, log_file) in enumerate(tasks):
+        wq.Submit(task_id, func, [log_file, task_id], order)
+    farma_queue.RunWorkers(queue_dir, FUNCS, nworkers, LEASE, POLL)
+    assert wq.Drained()
+    return wq
+
+
+def test_each_task_once(tmp_path):
+    log_file = str(tmp_path / 'runs.txt')
+    task_ids = ['t{:02d}'.format(i) for i in range(20)]
+    wq = Run(str(tmp_path / 'queue'), [(task_id, 'Work', log_file) for task_id in task_ids], 4)
+    assert sorted(Runs(log_file)) == task_ids
+    assert wq.Status() == (20, 20, 0, 0)
+
+
+def test_killed_worker_reclaimed(tmp_path):
+    log_file = str(tmp_path / 'runs.txt')
+    tasks = [('a', 'Work', log_file), ('b', 'DieOnce', log_file), ('c', 'Work', log_file)]
+    wq = Run(str(tmp_path / 'queue'), tasks, 2)
+    assert sorted(Runs(log_file)) == ['a', 'b', 'b', 'c']
+    assert wq.Status() == (3, 3, 0, 0)
+    assert not wq.Failures()
+
+
+def test_failed_after_max_attempts(tmp_path):
+    log_file = str(tmp_path / 'runs.txt')
+    # One worker per lost attempt, plus one to find the last lease expired
+    wq = Run(str(tmp_path / 'queue'), [('a', 'Die', log_file), ('b', 'Work', log_file)], farma_queue.MAX_ATTEMPTS + 1)
+    assert Runs(log_file).count('a') == farma_queue.MAX_ATTEMPTS
+    assert Runs(log_file).count('b') == 1
+    failures = wq.Failures()
+    assert list(failures) == ['a']
+    assert 'Lost its worker' in failures['a']['error']
+
+
+def test_resubmit(tmp_path):
+    queue_dir = str(tmp_path / 'queue')
+    fail_log = str(tmp_path / 'fail.txt')
+    work_log = str(tmp_path / 'work.txt')
+    wq = Run(queue_dir, [('a', 'Fail', fail_log), ('b', 'Work', work_log)], 2)
+    assert list(wq.Failures()) == ['a']
+    # The same tasks again: the failed task is retried, the done one kept
+    wq = Run(queue_dir, [('a', 'Fail', fail_log), ('b', 'Work', work_log)], 2)
+    assert Runs(fail_log) == ['a', 'a']
+    assert Runs(work_log) == ['b']
+    # Changed tasks are replaced and run again
+    wq = Run(queue_dir, [('a', 'Work', work_log), ('b', 'Work', fail_log)], 2)
+    assert sorted(Runs(work_log)) == ['a', 'b']
+    assert Runs(fail_log) == ['a', 'a', 'b']
+    assert wq.Status() == (2, 2, 0, 0)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Tests of the RAT helpers (farma_rat.py): the per tile extents
+# against a plain loop over the tiles (also when the RAT is streamed
+# in chunks), and the adaptive tiles and sub-tiles within their
+# bounds.
+
+import os
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code'))
+import farma_rat
+
+
+def RandomObjects(n, ntiles, seed=1):
+    # Tile IDs and extents of n random objects
+    rng = np.random.default_rng(seed)
+    TileID = rng.integers(1, ntiles + 1, size=n)
+    MinXX = rng.uniform(0, 1000, size=n)
+    MinYY = rng.uniform(0, 1000, size=n)
+    MaxXX = MinXX + rng.uniform(1, 50, size=n)
+    MaxYY = MinYY + rng.uniform(1, 50, size=n)
+    return TileID, MinXX, MinYY, MaxXX, MaxYY
+
+
+def NaiveExtents(TileID, MinXX, MinYY, MaxXX, MaxYY):
+    # The extent of each tile one at a time
+    tiles = np.unique(TileID)
+    rows = []
+    for tile in tiles:
+        sel = TileID == tile
+        rows.append((sel.sum(), MinXX[sel].min(), MaxXX[sel].max(), MinYY[sel].min(), MaxYY[sel].max()))
+    counts, minX, maxX, minY, maxY = (np.array(x) for x in zip(*rows))
+    return tiles, counts, minX, maxX, minY, maxY
+
+
+@pytest.mark.parametrize('ntiles', [1, 7, 70000])
+def test_tile_extents_match_loop(ntiles):
+    # 70000 tiles takes the general sort rather than the 16 bit one
+    objects = RandomObjects(5000, ntiles)
+    for got, expected in zip(farma_rat.TileExtents(*objects), NaiveExtents(*objects)):
+        np.testing.assert_array_equal(got, expected)
+
+
+def test_tile_extents_empty():
+    tiles, counts, minX, maxX, minY, maxY = farma_rat.TileExtents(np.array([], dtype=np.int64), [], [], [], [])
+    assert tiles.size == counts.size == minX.size == maxY.size == 0
+
+
+@pytest.mark.parametrize('max_objects,max_pixels', [(100, None), (None, 20000), (100, 20000)])
+def test_adaptive_tiles_within_bounds(max_objects, max_pixels):
+    rng = np.random.default_rng(2)
+    # Clustered centroids, so the tiles differ in size
+    cx = np.concatenate([rng.normal(100, 10, 2000), rng.uniform(0, 1000, 1000)])
+    cy = np.concatenate([rng.normal(100, 10, 2000), rng.uniform(0, 1000, 1000)])
+    pixels = rng.integers(1, 100, size=cx.size)
+    TileID = farma_rat.AdaptiveTiles(cx, cy, max_objects, pixels, max_pixels)
+    # Every object in a tile, numbered 1..ntiles
+    tiles = np.unique(TileID)
+    np.testing.assert_array_equal(tiles, np.arange(1, tiles.size + 1))
+    counts = np.bincount(TileID)[1:]
+    tile_pixels = np.bincount(TileID, weights=pixels)[1:]
+    if max_objects is not None:
+        assert counts.max() <= max_objects
+    if max_pixels is not None:
+        assert np.all((tile_pixels <= max_pixels) | (counts == 1))
+    assert tiles.size > 1
+
+
+def test_adaptive_tiles_needs_a_bound():
+    with pytest.raises(Exception):
+        farma_rat.AdaptiveTiles([0, 1], [0, 1])
+
+
+@pytest.mark.parametrize('bounds', [(100.0, None, None), (None, 50, None), (None, None, 40000), (150.0, 80, 30000)])
+def test_split_tile_within_bounds(bounds):
+    TileID, MinXX, MinYY, MaxXX, MaxYY = RandomObjects(2000, 1, seed=3)
+    max_size, max_objects, max_pixels = bounds
+    resolution = 2.0
+    labels = farma_rat.SplitTile(MinXX, MinYY, MaxXX, MaxYY, max_size, max_objects, max_pixels, resolution)
+    # Each object in exactly one sub-tile, numbered 0..n-1
+    assert labels.size == MinXX.size
+    subs = np.unique(labels)
+    np.testing.assert_array_equal(subs, np.arange(subs.size))
+    assert subs.size > 1
+    subs, counts, minX, maxX, minY, maxY = farma_rat.TileExtents(labels, MinXX, MinYY, MaxXX, MaxYY)
+    for count, width, height in zip(counts, maxX - minX, maxY - minY):
+        # Only a single object may be left over the bounds
+        assert (count == 1) or not farma_rat.TileOverBounds(count, width, height, max_size, max_objects, max_pixels, resolution)
+
+
+def test_tile_over_bounds():
+    assert not farma_rat.TileOverBounds(10, 50, 50)
+    assert farma_rat.TileOverBounds(10, 100, 50, max_size=100)
+    assert not farma_rat.TileOverBounds(10, 99, 99, max_size=100)
+    assert farma_rat.TileOverBounds(11, 1, 1, max_objects=10)
+    # 50 x 50 map units at 2 map units a pixel is 625 pixels
+    assert not farma_rat.TileOverBounds(10, 50, 50, max_pixels=625, resolution=2.0)
+    assert farma_rat.TileOverBounds(10, 50, 50, max_pixels=624, resolution=2.0)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000, 5000])
+def test_stream_tile_extents_match_loop(tmp_path, monkeypatch, chunk_size):
+    TileID, MinXX, MinYY, MaxXX, MaxYY = RandomObjects(3000, 40, seed=5)
+    Histogram = np.random.default_rng(6).integers(0, 5, size=TileID.size)
+    # Row 0 is the background clump, which is never an object
+    Histogram[0] = 100
+    rat = {'tiles': TileID.astype(np.float64), 'Histogram': Histogram, 'MinXX': MinXX, 'MinYY': MinYY, 'MaxXX': MaxXX, 'MaxYY': MaxYY}
+
+    def ReadRATChunks(segfile, columns, chunk_size=farma_rat.CHUNK_ROWS, band=1):
+        # The RAT held in memory
+        for start in range(0, TileID.size, chunk_size):
+            yield start, {col: rat[col][start:start + chunk_size] for col in columns}
+    monkeypatch.setattr(farma_rat, 'ReadRATChunks', ReadRATChunks)
+    monkeypatch.setattr(farma_rat, 'RATRowCount', lambda segfile, band=1: TileID.size)
+
+    lut_file = str(tmp_path / 'tile_lut.npy')
+    result = farma_rat.StreamTileExtents('segs.kea', lut_file, chunk_size)
+    valid = Histogram > 0
+    valid[0] = False
+    expected = NaiveExtents(TileID[valid], MinXX[valid], MinYY[valid], MaxXX[valid], MaxYY[valid])
+    for got, exp in zip(result[:6], expected):
+        np.testing.assert_array_equal(got, exp)
+    assert result[6] == valid.sum()
+    np.testing.assert_array_equal(np.load(lut_file), np.where(valid, TileID, 0))
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Tests of the time-series store (farma_store.py): a GPKG which
+# changes between runs has its rows rebuilt and every date refreshed,
+# while the rows of the other GPKGs are kept.
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code'))
+import farma_store
+
+DATES = ['20200101', '20200201']
+
+
+def Populate(store_dir, gpkg_values):
+    # Write every pending (GPKG, date) block, then complete the dates
+    pending = farma_store.PendingDates(store_dir, DATES)
+    for name, dates in pending.items():
+        for date in dates:
+            farma_store.WriteBlock(store_dir, name, date, gpkg_values[name] + DATES.index(date))
+    for date in DATES:
+        farma_store.MarkComplete(store_dir, date)
+    return pending
+
+
+def Rows(store_dir, name):
+    meta = farma_store.ReadMeta(store_dir)
+    start, stop = meta['gpkgs'][name]['rows']
+    values = np.load(os.path.join(store_dir, 'values.npy'))
+    return values[start:stop, [meta['dates'].index(date) for date in DATES], :]
+
+
+def test_changed_tile_is_refreshed(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    nstats = len(farma_store.STORE_STATS)
+    keys = {'tile_1.gpkg': np.arange(3), 'tile_2.gpkg': np.arange(100, 104)}
+    sources = {'tile_1.gpkg': [10, 1], 'tile_2.gpkg': [20, 1]}
+    first = {'tile_1.gpkg': np.full((3, nstats), 1.0), 'tile_2.gpkg': np.full((4, nstats), 2.0)}
+    farma_store.CreateStore(store_dir, list(keys.items()), sources=sources)
+    farma_store.AddDates(store_dir, DATES)
+    assert Populate(store_dir, first) == {'tile_1.gpkg': DATES, 'tile_2.gpkg': DATES}
+    assert farma_store.CompleteDates(store_dir) == DATES
+
+    # Nothing changed: nothing to redo
+    farma_store.CreateStore(store_dir, list(keys.items()), sources=sources)
+    assert farma_store.PendingDates(store_dir, DATES) == {'tile_1.gpkg': [], 'tile_2.gpkg': []}
+
+    # Tile 2 re-segmented with one more object
+    keys['tile_2.gpkg'] = np.arange(100, 105)
+    sources['tile_2.gpkg'] = [25, 2]
+    second = {'tile_1.gpkg': np.full((3, nstats), -1.0), 'tile_2.gpkg': np.full((5, nstats), 5.0)}
+    farma_store.CreateStore(store_dir, list(keys.items()), sources=sources)
+    assert farma_store.CompleteDates(store_dir) == []
+    assert Populate(store_dir, second) == {'tile_1.gpkg': [], 'tile_2.gpkg': DATES}
+    assert farma_store.CompleteDates(store_dir) == DATES
+    # Only tile 2 was recomputed, for every date
+    assert np.all(Rows(store_dir, 'tile_1.gpkg') == np.array([1.0, 2.0])[None, :, None])
+    assert np.all(Rows(store_dir, 'tile_2.gpkg') == np.array([5.0, 6.0])[None, :, None])
+
+
+def test_same_rows_new_file_is_refreshed(tmp_path):
+    # Keys and row count unchanged (objects relabelled 1..n) but the
+    # GPKG was rewritten: its rows are still refreshed
+    store_dir = str(tmp_path / 'store')
+    nstats = len(farma_store.STORE_STATS)
+    keys = [('tile_1.gpkg', np.arange(3)), ('tile_2.gpkg', np.arange(3))]
+    farma_store.CreateStore(store_dir, keys, sources={'tile_1.gpkg': [1, 1], 'tile_2.gpkg': [1, 1]})
+    farma_store.AddDates(store_dir, DATES)
+    Populate(store_dir, {'tile_1.gpkg': np.zeros((3, nstats)), 'tile_2.gpkg': np.zeros((3, nstats))})
+    farma_store.CreateStore(store_dir, keys, sources={'tile_1.gpkg': [1, 1], 'tile_2.gpkg': [1, 2]})
+    assert farma_store.PendingDates(store_dir, DATES) == {'tile_1.gpkg': [], 'tile_2.gpkg': DATES}
+    assert np.all(np.isnan(Rows(store_dir, 'tile_2.gpkg')))
+
+
+def test_date_not_complete_until_written(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    nstats = len(farma_store.STORE_STATS)
+    farma_store.CreateStore(store_dir, [('tile_1.gpkg', np.arange(2)), ('tile_2.gpkg', np.arange(2))])
+    farma_store.AddDates(store_dir, DATES[:1])
+    farma_store.WriteBlock(store_dir, 'tile_1.gpkg', DATES[0], np.zeros((2, nstats)))
+    farma_store.MarkComplete(store_dir, DATES[0])
+    assert farma_store.CompleteDates(store_dir) == []
+    assert farma_store.PendingDates(store_dir, DATES[:1]) == {'tile_1.gpkg': [], 'tile_2.gpkg': DATES[:1]}
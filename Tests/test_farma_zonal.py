@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+''' Author: Nathan Thomas
+    Email: nathan.m.thomas@nasa.gov, @DrNASApants
+    Date: 11/26/2020
+    Version: 2.0
+    Copyright 2020 Nathan M Thomas
+    
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+    
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+    
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.'''
+
+# Tests of the raster zonal statistics engine (farma_zonal.py): the
+# grouped reductions against a plain numpy loop over the zones.
+
+import os
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code'))
+import farma_zonal
+
+
+def Naive(zones, values, nzones, out_no_data_val=0):
+    # The statistics of each zone one at a time
+    stats = {name: np.full(nzones + 1, out_no_data_val, dtype=np.float64) for name in farma_zonal.STATS}
+    stats['count'] = np.zeros(nzones + 1)
+    for zone in range(1, nzones + 1):
+        v = values[zones == zone].astype(np.float64)
+        stats['count'][zone] = v.size
+        if v.size == 0:
+            continue
+        uniq, counts = np.unique(v, return_counts=True)
+        for name, value in [('min', v.min()), ('max', v.max()), ('mean', v.mean()), ('std', v.std()), ('sum', v.sum()), ('median', np.median(v)), ('mode', uniq[np.argmax(counts)])]:
+            stats[name][zone] = value
+    return stats
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.float32])
+def test_zonal_stats_match_numpy(dtype):
+    rng = np.random.default_rng(4)
+    nzones = 40
+    # Zone 0 is no zone and the last zones have no pixels
+    zones = rng.integers(0, nzones - 2, size=(120, 90))
+    values = rng.integers(-50, 50, size=zones.shape).astype(dtype)
+    stats = farma_zonal.ZonalStatsArrays(zones, values, nzones, out_no_data_val=-9)
+    expected = Naive(zones, values, nzones, out_no_data_val=-9)
+    for name in farma_zonal.STATS:
+        assert np.allclose(stats[name], expected[name]), name
+    assert stats['median'][nzones] == -9
+    assert stats['count'][nzones] == 0
+
+
+def test_no_pixels():
+    stats = farma_zonal.ZonalStatsArrays(np.zeros((2, 2), dtype=np.uint32), np.ones((2, 2)), 3, out_no_data_val=-1)
+    assert np.all(stats['count'] == 0)
+    assert np.all(stats['mean'] == -1)
+
+
+def test_valid_pixels():
+    zones = np.array([1, 1, 2, 2, 3])
+    values = np.array([0.5, np.nan, 5.0, -9.0, 1.0])
+    # Thresholds are exclusive, and the no data value is excluded
+    assert farma_zonal.ValidPixels(zones, values, 0.0, 5.0, no_data_val=-9.0).tolist() == [1, 0, 0, 0, 3]
+
+
+def test_extent_window():
+    geotransform = (100.0, 10.0, 0, 500.0, 0, -10.0)
+    assert farma_zonal.ExtentWindow((115.0, 155.0, 420.0, 480.0), geotransform, 50, 50) == (1, 2, 5, 6)
+    # Clipped to the raster, or None off it
+    assert farma_zonal.ExtentWindow((50.0, 155.0, 420.0, 520.0), geotransform, 50, 50) == (0, 0, 6, 8)
+    assert farma_zonal.ExtentWindow((1000.0, 1100.0, 420.0, 480.0), geotransform, 50, 50) is None
+
+
+def Sketched(zones, values, nzones, bins, weights=None, nblocks=5):
+    # The ZoneSketch statistics of the pixels added in blocks
+    sketch = farma_zonal.ZoneSketch(nzones, bins, weights is not None)
+    for block in np.array_split(np.arange(zones.size), nblocks):
+        sketch.Add(zones.ravel()[block], values.ravel()[block], None if weights is None else weights.ravel()[block])
+    return sketch.Stats(-9)
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_sketch_exact_for_few_values(weighted):
+    # Zones with at most bins distinct values have the exact median
+    # and mode, and the other statistics always match
+    rng = np.random.default_rng(5)
+    nzones = 30
+    zones = rng.integers(0, nzones + 1, size=20000)
+    values = rng.integers(100, 160, size=zones.size).astype(np.int16)
+    weights = rng.uniform(0.1, 1.0, size=zones.size) if weighted else None
+    exact = farma_zonal.ZonalStatsArrays(zones, values, nzones, -9, weights)
+    sketch = Sketched(zones, values, nzones, 64, weights)
+    for name in farma_zonal.STATS:
+        assert np.allclose(sketch[name], exact[name]), name
+    floats = rng.choice([0.1, 0.25, -2.5], size=zones.size).astype(np.float32)
+    exact = farma_zonal.ZonalStatsArrays(zones, floats, nzones, -9, weights)
+    sketch = Sketched(zones, floats, nzones, 8, weights)
+    assert np.array_equal(sketch['median'], exact['median'])
+    assert np.array_equal(sketch['mode'], exact['mode'])
+
+
+def test_sketch_median_bound():
+    # The median is within 2 * (max - min) / (bins - 2), whatever the
+    # magnitude of the blocks added later
+    rng = np.random.default_rng(6)
+    nzones = 50
+    bins = 32
+    zones = rng.integers(1, nzones + 1, size=40000)
+    values = np.concatenate([rng.normal(0.4, 0.1, 20000), rng.normal(0, 1000.0, 20000)])
+    exact = farma_zonal.ZonalStatsArrays(zones, values, nzones, -9)
+    sketch = Sketched(zones, values, nzones, bins)
+    bound = 2 * (exact['max'] - exact['min']) / (bins - 2)
+    assert np.all(np.abs(sketch['median'] - exact['median']) <= bound)
+    assert np.allclose(sketch['std'], exact['std'])
+    # At most bins entries are kept per zone
+    assert np.bincount(SketchEntries(zones, values, nzones, bins)).max() <= bins
+
+
+def SketchEntries(zones, values, nzones, bins):
+    sketch = farma_zonal.ZoneSketch(nzones, bins)
+    sketch.Add(zones, values)
+    sketch.Compress()
+    return sketch.entries[0]